@@ -0,0 +1,174 @@
+"""
+Activity log of the likes, comments and follows a user received.
+
+Model code calls ``record`` with ``(recipient, kind, actor, image)`` entries,
+written in bulk once the transaction commits. Entries are aggregated when
+written: an entry joins the recipient's latest unread row of the same kind
+and image if it is younger than ``ACTIVITY_AGGREGATE_WINDOW`` seconds, which
+then reads "<actor> and <actor_count - 1> others liked your photo". The
+distinct actors of a row are kept in ``ActivityActor``, so a user liking,
+unliking and liking again is counted once. Rows the recipient has read are
+never changed again.
+
+A user's rows are read newest first by keyset over ``(recipient, updated,
+id)``. Rows updated after ``Creator.activity_read_at`` are unread, and their
+number is kept in ``Creator.unread_activity_count``.
+"""
+from collections import Counter, OrderedDict, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery
+from django.utils import timezone
+
+from . import counters, models
+from .transactions import write_atomic
+
+
+def record(*entries):
+    """
+    Add ``(recipient id, kind, actor id, image id)`` entries once the
+    transaction commits. Actions of users on their own content are left out.
+    """
+    entries = [entry for entry in entries if entry[0] != entry[2]]
+    if entries:
+        transaction.on_commit(lambda: write(entries))
+
+
+def find_open(groups, read_at, cutoff, chunk_size=100):
+    """
+    Return ``{(recipient id, kind, image id): row}`` of the unread rows that
+    ``groups`` can still be aggregated into.
+    """
+    groups = list(groups)
+    found = {}
+    for start in range(0, len(groups), chunk_size):
+        condition = Q()
+        for recipient_id, kind, image_id in groups[start : start + chunk_size]:
+            condition |= Q(
+                recipient_id=recipient_id,
+                kind=kind,
+                image_id=image_id,
+                updated__gt=max(cutoff, read_at[recipient_id] or cutoff),
+            )
+        rows = models.Activity.objects.filter(condition).order_by("updated", "id")
+        for row in rows.only("recipient_id", "kind", "image_id", "actor_id"):
+            found[(row.recipient_id, row.kind, row.image_id)] = row
+    return found
+
+
+def write(entries):
+    # (recipient id, kind, image id) -> actor ids, oldest first
+    groups = OrderedDict()
+    for recipient_id, kind, actor_id, image_id in entries:
+        actors = groups.setdefault((recipient_id, kind, image_id), [])
+        if actor_id not in actors:
+            actors.append(actor_id)
+
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=settings.ACTIVITY_AGGREGATE_WINDOW)
+    with write_atomic():
+        read_at = dict(
+            models.Creator.objects.filter(
+                pk__in={recipient_id for recipient_id, _kind, _image_id in groups}
+            ).values_list("pk", "activity_read_at")
+        )
+        image_ids = set(
+            models.Image.objects.filter(
+                pk__in={image_id for _recipient_id, _kind, image_id in groups}
+            ).values_list("pk", flat=True)
+        )
+        # Drop entries about users and images deleted since
+        groups = OrderedDict(
+            (key, actors)
+            for key, actors in groups.items()
+            if key[0] in read_at and (key[2] is None or key[2] in image_ids)
+        )
+
+        # open row id -> actor ids
+        open_rows = {
+            row.pk: groups.pop(key)
+            for key, row in find_open(groups, read_at, cutoff).items()
+        }
+        known = set(
+            models.ActivityActor.objects.filter(activity__in=open_rows).values_list(
+                "activity_id", "actor_id"
+            )
+        )
+        links = [
+            (pk, actor_id)
+            for pk, actors in open_rows.items()
+            for actor_id in actors
+            if (pk, actor_id) not in known
+        ]
+
+        created = []
+        unread = Counter()
+        for (recipient_id, kind, image_id), actors in groups.items():
+            created.append(
+                models.Activity(
+                    recipient_id=recipient_id,
+                    kind=kind,
+                    image_id=image_id,
+                    actor_id=actors[-1],
+                    actor_count=len(actors),
+                    created=now,
+                    updated=now,
+                )
+            )
+            unread[recipient_id] += 1
+        models.Activity.objects.bulk_create(created)
+        if created:
+            # SQLite does not return the ids of bulk inserted rows
+            created_ids = models.Activity.objects.filter(
+                recipient_id__in=unread, created=now
+            ).values_list("pk", "recipient_id", "kind", "image_id")
+            for pk, recipient_id, kind, image_id in created_ids:
+                actors = groups.get((recipient_id, kind, image_id), ())
+                links += [(pk, actor_id) for actor_id in actors]
+
+        models.ActivityActor.objects.bulk_create(
+            [
+                models.ActivityActor(activity_id=pk, actor_id=actor_id)
+                for pk, actor_id in links
+            ],
+            ignore_conflicts=True,
+        )
+        grown = {pk for pk, _actor_id in links if pk in open_rows}
+        if grown:
+            actors = models.ActivityActor.objects.filter(activity=OuterRef("pk"))
+            # Counted, not incremented: concurrent writers may link the same actor
+            models.Activity.objects.filter(pk__in=grown).update(
+                actor_id=Subquery(actors.order_by("-pk").values("actor_id")[:1]),
+                actor_count=counters.count_of(
+                    models.ActivityActor.objects.all(), "activity"
+                ),
+                updated=now,
+            )
+        add_unread(unread)
+
+
+def add_unread(unread):
+    """
+    Apply ``{creator id: new unread rows}`` with one UPDATE per distinct count.
+
+    Activity state is not part of the cached profile, see CreatorSerializer,
+    so neither the version nor the cached representation of a creator change.
+    """
+    by_count = defaultdict(list)
+    for creator_id, count in unread.items():
+        by_count[count].append(creator_id)
+    for count, creator_ids in by_count.items():
+        models.Creator.objects.filter(pk__in=creator_ids).update(
+            unread_activity_count=F("unread_activity_count") + count
+        )
+
+
+def mark_read(creator_id):
+    """
+    Mark every activity row of a user as read.
+    """
+    models.Creator.objects.filter(pk=creator_id).update(
+        activity_read_at=timezone.now(), unread_activity_count=0
+    )
@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.core import checks
 
 
 class ImagesConfig(AppConfig):
     name = "images"
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .cache import check_object_cache
+
+        checks.register(check_object_cache)
@@ -0,0 +1,171 @@
+"""
+Stateless signed bearer tokens.
+
+A token is ``<user id>.<expiry>.<version>.<signature>``, the signature being an
+HMAC-SHA256 of the rest keyed with ``SECRET_KEY``. The version is a digest of
+the user's password hash, so changing the password invalidates every token
+issued before.
+
+Checking a token costs one HMAC. Users are kept in an in-process LRU cache for
+``AUTH_TOKEN_USER_CACHE_TIMEOUT`` seconds and dropped from it when saved.
+Revoked tokens are mirrored from ``RevokedToken`` in memory and reloaded every
+``AUTH_REVOCATION_REFRESH_INTERVAL`` seconds.
+"""
+import base64
+import copy
+import hashlib
+import hmac
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+
+from .cache import LRUBackend
+from .models import Creator, RevokedToken
+
+
+def sign(payload):
+    key = hashlib.sha256(("images.authentication" + settings.SECRET_KEY).encode())
+    digest = hmac.new(key.digest(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def get_version(user):
+    digest = hashlib.sha256((settings.SECRET_KEY + user.password).encode())
+    return digest.hexdigest()[:12]
+
+
+def issue_token(user, lifetime=None):
+    """
+    Return a signed token of ``user`` and its expiry as a Unix timestamp.
+    """
+    if lifetime is None:
+        lifetime = settings.AUTH_TOKEN_LIFETIME
+    expires = int(time.time()) + lifetime
+    payload = "%d.%d.%s" % (user.pk, expires, get_version(user))
+    return "%s.%s" % (payload, sign(payload)), expires
+
+
+def parse_token(token):
+    """
+    Split a token into (user id, expiry, version, signature), None if malformed.
+    """
+    parts = token.split(".")
+    if len(parts) != 4:
+        return None
+    try:
+        return int(parts[0]), int(parts[1]), parts[2], parts[3]
+    except ValueError:
+        return None
+
+
+user_cache = LRUBackend(
+    settings.AUTH_TOKEN_USER_CACHE_SIZE, settings.AUTH_TOKEN_USER_CACHE_TIMEOUT
+)
+
+
+def get_user(user_id):
+    """
+    Return ``(user, version)``, ``(None, None)`` for unknown users.
+    """
+    found = user_cache.get_many([user_id])
+    if user_id in found:
+        return found[user_id]
+    user = Creator.objects.filter(pk=user_id).first()
+    entry = (user, get_version(user)) if user is not None else (None, None)
+    user_cache.set_many({user_id: entry})
+    return entry
+
+
+def forget_user(user_id):
+    user_cache.delete_many([user_id])
+
+
+class Revocations:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # signature -> expiry timestamp
+        self.signatures = {}
+        self.loaded = None
+
+    def refresh(self):
+        rows = RevokedToken.objects.filter(expires__gt=timezone.now()).values_list(
+            "signature", "expires"
+        )
+        signatures = {signature: expires.timestamp() for signature, expires in rows}
+        with self.lock:
+            self.signatures = signatures
+            self.loaded = time.monotonic()
+
+    def ensure_fresh(self):
+        interval = settings.AUTH_REVOCATION_REFRESH_INTERVAL
+        if self.loaded is None or time.monotonic() - self.loaded > interval:
+            self.refresh()
+
+    def is_revoked(self, signature):
+        self.ensure_fresh()
+        return signature in self.signatures
+
+    def revoke(self, token):
+        """
+        Refuse ``token`` from now on, returning False if it is not a token.
+        """
+        parsed = parse_token(token)
+        if parsed is None:
+            return False
+        _user_id, expires, _version, signature = parsed
+        RevokedToken.objects.filter(expires__lte=timezone.now()).delete()
+        RevokedToken.objects.get_or_create(
+            signature=signature,
+            defaults={"expires": datetime.fromtimestamp(expires, timezone.utc)},
+        )
+        with self.lock:
+            self.signatures[signature] = expires
+        return True
+
+
+revocations = Revocations()
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    """
+    Authenticate ``Authorization: Bearer <token>`` headers carrying signed
+    tokens. Other bearer tokens, such as OAuth2 ones, are left to the next
+    authentication class.
+    """
+
+    keyword = b"bearer"
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if len(auth) != 2 or auth[0].lower() != self.keyword:
+            return None
+        try:
+            token = auth[1].decode()
+        except UnicodeError:
+            return None
+        parsed = parse_token(token)
+        if parsed is None:
+            return None
+        return self.authenticate_credentials(token, *parsed)
+
+    def authenticate_credentials(self, token, user_id, expires, version, signature):
+        if not hmac.compare_digest(signature, sign(token.rsplit(".", 1)[0])):
+            raise exceptions.AuthenticationFailed("Invalid token.")
+        if expires < time.time():
+            raise exceptions.AuthenticationFailed("Token has expired.")
+        if revocations.is_revoked(signature):
+            raise exceptions.AuthenticationFailed("Token has been revoked.")
+
+        user, current_version = get_user(user_id)
+        if user is None or not user.is_active or version != current_version:
+            raise exceptions.AuthenticationFailed("Invalid token.")
+        # The cached instance is shared between requests
+        return copy.copy(user), token
+
+    def authenticate_header(self, request):
+        return 'Bearer realm="api"'
@@ -0,0 +1,191 @@
+"""
+In-process prefix index for username autocomplete.
+
+Usernames are kept lower-cased in a sorted list, so the creators matching a
+prefix are one contiguous slice found with two binary searches. Matches are
+ranked by ``followers_count``; the best matches of every one and two letter
+prefix, whose slices are the largest, are kept precomputed.
+
+The index is loaded from the database on first use, so processes that never
+autocomplete never load it. It follows ``Creator`` saves and deletes of its
+own process, and the follows and unfollows of its own process through
+``count_followers``, since ``followers_count`` is updated without saving the
+creator. Changes made by other workers are picked up when the index is
+reloaded in the background, every ``AUTOCOMPLETE_REBUILD_INTERVAL`` seconds,
+so until then their rankings may be that old.
+"""
+import heapq
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import transaction
+
+from . import derivatives, tasks
+from .models import Creator
+
+CACHED_PREFIX_LENGTH = 2
+
+
+def prefix_end(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class PrefixIndex:
+    def __init__(self, limit=None):
+        self.limit = limit or settings.AUTOCOMPLETE_LIMIT
+        self.lock = threading.RLock()
+        self.keys = []
+        self.ids = []
+        # id -> (followers_count, username, name, thumbnail)
+        self.entries = {}
+        self.top = {}
+        self.built = None
+
+    def load(self, rows):
+        """
+        Replace the contents with (id, username, name, thumbnail, followers) rows.
+        """
+        entries = {}
+        for pk, username, name, thumbnail, followers_count in rows:
+            entries[pk] = (followers_count, username, name, thumbnail)
+        ordered = sorted((entries[pk][1].lower(), pk) for pk in entries)
+
+        keys = [key for key, _pk in ordered]
+        ids = [pk for _key, pk in ordered]
+        top = {}
+        for key, pk in ordered:
+            for length in range(1, min(len(key), CACHED_PREFIX_LENGTH) + 1):
+                top.setdefault(key[:length], []).append(pk)
+        for prefix, matches in top.items():
+            top[prefix] = self.best(matches, entries)
+
+        with self.lock:
+            self.keys, self.ids, self.entries, self.top = keys, ids, entries, top
+            self.built = time.monotonic()
+
+    def best(self, ids, entries=None):
+        entries = entries if entries is not None else self.entries
+        return heapq.nlargest(self.limit, ids, key=lambda pk: entries[pk][0])
+
+    def add(self, pk, username, name, thumbnail, followers_count):
+        with self.lock:
+            self.remove(pk)
+            key = username.lower()
+            position = bisect_left(self.keys, key)
+            self.keys.insert(position, key)
+            self.ids.insert(position, pk)
+            self.entries[pk] = (followers_count, username, name, thumbnail)
+            self.invalidate(key)
+
+    def remove(self, pk):
+        with self.lock:
+            entry = self.entries.pop(pk, None)
+            if entry is None:
+                return
+            key = entry[1].lower()
+            position = bisect_left(self.keys, key)
+            while self.ids[position] != pk:
+                position += 1
+            del self.keys[position]
+            del self.ids[position]
+            self.invalidate(key)
+
+    def add_followers(self, deltas):
+        """
+        Add ``{pk: delta}`` to the follower counts the matches are ranked by.
+        """
+        with self.lock:
+            for pk, delta in deltas.items():
+                entry = self.entries.get(pk)
+                if entry is None:
+                    continue
+                self.entries[pk] = (entry[0] + delta,) + entry[1:]
+                self.invalidate(entry[1].lower())
+
+    def invalidate(self, key):
+        for length in range(1, min(len(key), CACHED_PREFIX_LENGTH) + 1):
+            self.top.pop(key[:length], None)
+
+    def search(self, prefix):
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+        with self.lock:
+            matches = self.top.get(prefix)
+            if matches is None:
+                start = bisect_left(self.keys, prefix)
+                end = bisect_left(self.keys, prefix_end(prefix), start)
+                matches = self.best(self.ids[start:end])
+                if len(prefix) <= CACHED_PREFIX_LENGTH:
+                    self.top[prefix] = matches
+            return [(pk,) + self.entries[pk][1:] for pk in matches]
+
+
+def thumbnail_url(source, variants):
+    if not source:
+        return None
+    thumbnail = derivatives.load(source, variants).get("thumbnail", {})
+    name = thumbnail.get("name", source)
+    return Creator._meta.get_field("profile_image").storage.url(name)
+
+
+def creator_rows(creators):
+    rows = creators.values_list(
+        "pk",
+        "username",
+        "name",
+        "profile_image",
+        "profile_image_variants",
+        "followers_count",
+    )
+    for pk, username, name, source, variants, followers_count in rows.iterator():
+        yield pk, username, name, thumbnail_url(source, variants), followers_count
+
+
+class CreatorIndex(PrefixIndex):
+    rebuilding = False
+
+    def rebuild(self):
+        try:
+            self.load(creator_rows(Creator.objects.all()))
+        finally:
+            self.rebuilding = False
+
+    def ensure_fresh(self):
+        if self.built is None:
+            with self.lock:
+                if self.built is None:
+                    self.rebuild()
+        elif (
+            not self.rebuilding
+            and time.monotonic() - self.built > settings.AUTOCOMPLETE_REBUILD_INTERVAL
+        ):
+            self.rebuilding = True
+            tasks.submit(self.rebuild)
+
+    def search(self, prefix):
+        self.ensure_fresh()
+        return super(CreatorIndex, self).search(prefix)
+
+    def update(self, creator):
+        if self.built is None:
+            return
+        self.add(
+            creator.pk,
+            creator.username,
+            creator.name,
+            thumbnail_url(creator.profile_image.name, creator.profile_image_variants),
+            creator.followers_count,
+        )
+
+    def count_followers(self, deltas):
+        """
+        Apply follower count changes once the transaction making them commits.
+        """
+        if self.built is not None and deltas:
+            transaction.on_commit(lambda: self.add_followers(deltas))
+
+
+creator_index = CreatorIndex()
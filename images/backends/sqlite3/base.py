@@ -0,0 +1,92 @@
+"""
+SQLite backend for several worker processes writing to one database.
+
+Every new connection applies the ``pragmas`` option over ``PRAGMAS``:
+write-ahead logging lets readers run while one process writes, and with it
+``synchronous=NORMAL`` only syncs the log at checkpoints rather than on every
+commit. Connections are kept between requests with ``CONN_MAX_AGE``.
+
+Transactions begun by ``images.transactions.write_atomic`` start with
+``BEGIN IMMEDIATE`` and take the write lock up front, waiting up to the
+``timeout`` option for it. A deferred ``BEGIN`` fails with "database is
+locked" as soon as its first write finds that another process committed since
+it started reading, and nothing waits in that case. Other transactions, which
+only read, keep the deferred ``BEGIN`` so they do not queue for the write
+lock; the ``immediate`` option makes every transaction immediate. A ``BEGIN``
+that times out is retried ``lock_retries`` times with exponential backoff;
+the transaction has not run anything yet, so that is always safe.
+"""
+import random
+import time
+
+from django.db.backends.sqlite3 import base
+from django.db.utils import OperationalError
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    # Negative sizes are in KiB
+    "cache_size": -64 * 1024,
+    "temp_store": "MEMORY",
+}
+
+# Options of this backend, the others are passed to sqlite3.connect()
+BACKEND_OPTIONS = {
+    "pragmas": {},
+    "immediate": False,
+    "lock_retries": 3,
+    "lock_backoff": 0.05,
+}
+
+
+# Result code of a lock that could not be taken in time
+SQLITE_BUSY = 5
+
+
+def is_locked(error):
+    """
+    Whether ``error`` is SQLite giving up waiting for a lock.
+    """
+    # Django chains the sqlite3 error, which has the result code on Python
+    # 3.11 and later; extended codes keep the primary code in the low byte
+    code = getattr(error.__cause__ or error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF == SQLITE_BUSY
+    return str(error) == "database is locked"
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    # Set by write_atomic for the transaction it begins
+    begin_immediate = False
+
+    def get_option(self, name):
+        return self.settings_dict["OPTIONS"].get(name, BACKEND_OPTIONS[name])
+
+    def get_connection_params(self):
+        params = super(DatabaseWrapper, self).get_connection_params()
+        for name in BACKEND_OPTIONS:
+            params.pop(name, None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super(DatabaseWrapper, self).get_new_connection(conn_params)
+        pragmas = dict(PRAGMAS, **self.get_option("pragmas"))
+        for name, value in pragmas.items():
+            conn.execute("PRAGMA %s = %s" % (name, value))
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        immediate = self.begin_immediate or self.get_option("immediate")
+        statement = "BEGIN IMMEDIATE" if immediate else "BEGIN"
+        retries = self.get_option("lock_retries")
+        for attempt in range(retries + 1):
+            try:
+                self.cursor().execute(statement)
+                return
+            except OperationalError as error:
+                if attempt == retries or not is_locked(error):
+                    raise
+            # Jitter keeps the waiting processes from retrying in step
+            backoff = self.get_option("lock_backoff") * 2 ** attempt
+            time.sleep(backoff * random.uniform(0.5, 1.5))
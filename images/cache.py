@@ -0,0 +1,208 @@
+"""
+Versioned read-through cache of serialized objects.
+
+Every cached object has a version token stored next to it. Serialized data
+is kept under ``(kind, pk, version)``, so invalidating an object only means
+replacing its version token: ``post_save``/``post_delete`` signals and
+counter updates call ``invalidate``. Version tokens are random, so a token lost to
+eviction can never bring back data cached under an older one.
+
+``OBJECT_CACHE["BACKEND"]`` selects where entries live: ``LRUBackend`` keeps
+them in process memory, ``DjangoCacheBackend`` in one of Django's caches,
+which is shared between worker processes with the file, memcached or redis
+backends. Invalidations only reach the process that made them when entries
+are kept in process memory, so the ``images.W001`` check warns about it.
+"""
+import random
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+
+class LRUBackend:
+    is_local = True
+
+    def __init__(self, max_entries=10000, timeout=300):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                if entry[1] < now:
+                    del self.entries[key]
+                    continue
+                self.entries.move_to_end(key)
+                found[key] = entry[0]
+        return found
+
+    def set_many(self, mapping):
+        expires = time.monotonic() + self.timeout
+        with self.lock:
+            for key, value in mapping.items():
+                self.entries[key] = (value, expires)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+
+class DjangoCacheBackend:
+    def __init__(self, alias="default", timeout=300):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    @property
+    def is_local(self):
+        return isinstance(self.cache, LocMemCache)
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set_many(self, mapping):
+        self.cache.set_many(mapping, self.timeout)
+
+    def delete_many(self, keys):
+        self.cache.delete_many(keys)
+
+
+def new_version():
+    return "%x" % random.getrandbits(63)
+
+
+class ObjectCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def version_key(self, kind, pk):
+        return "version:%s:%s" % (kind, pk)
+
+    def get_versions(self, kind, pks):
+        keys = {pk: self.version_key(kind, pk) for pk in pks}
+        found = self.backend.get_many(list(keys.values()))
+        versions = {pk: found.get(key) for pk, key in keys.items()}
+        created = {pk: new_version() for pk in versions if not versions[pk]}
+        if created:
+            self.backend.set_many(
+                {keys[pk]: version for pk, version in created.items()}
+            )
+            versions.update(created)
+        return versions
+
+    def bump(self, kind, *pks):
+        """
+        Replace the versions of ``pks``, returning ``{pk: new version}``.
+        """
+        versions = {pk: new_version() for pk in pks}
+        self.backend.set_many(
+            {self.version_key(kind, pk): version for pk, version in versions.items()}
+        )
+        return versions
+
+    def invalidate(self, kind, *pks):
+        """
+        Bump the versions now and again once the current transaction commits.
+
+        Call it after the write: outside a transaction the write is committed
+        by then, inside one the second bump drops data that a concurrent reader
+        cached from the rows as they were before the commit.
+        """
+        self.bump(kind, *pks)
+        if transaction.get_connection().in_atomic_block:
+            transaction.on_commit(lambda: self.bump(kind, *pks))
+
+    def get_many(self, kind, pks, render, namespace=""):
+        """
+        Return ``{pk: data}``, calling ``render(missing_pks)`` for the misses.
+
+        ``render`` returns ``{pk: data}`` and may leave out deleted objects.
+        """
+        versions = self.get_versions(kind, pks)
+        keys = {
+            pk: "object:%s:%s:%s:%s" % (kind, pk, version, namespace)
+            for pk, version in versions.items()
+        }
+        found = self.backend.get_many(list(keys.values()))
+
+        result = {pk: found[key] for pk, key in keys.items() if key in found}
+        missing = [pk for pk in keys if pk not in result]
+        with self.lock:
+            self.hits[kind] += len(result)
+            self.misses[kind] += len(missing)
+
+        if missing:
+            rendered = render(missing)
+            self.backend.set_many(
+                {keys[pk]: data for pk, data in rendered.items()}
+            )
+            result.update(rendered)
+        return result
+
+    def get(self, kind, pk, render, namespace=""):
+        """
+        Return the data of one object, ``render()`` returns None if it is gone.
+        """
+
+        def render_one(pks):
+            data = render()
+            return {} if data is None else {pk: data}
+
+        return self.get_many(kind, [pk], render_one, namespace).get(pk)
+
+    def get_stats(self):
+        with self.lock:
+            kinds = set(self.hits) | set(self.misses)
+            return {
+                kind: {"hits": self.hits[kind], "misses": self.misses[kind]}
+                for kind in sorted(kinds)
+            }
+
+
+def get_object_cache():
+    config = settings.OBJECT_CACHE
+    backend = import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+    return ObjectCache(backend)
+
+
+object_cache = get_object_cache()
+
+
+def check_object_cache(app_configs, **kwargs):
+    if not object_cache.backend.is_local:
+        return []
+    return [
+        checks.Warning(
+            "OBJECT_CACHE keeps serialized objects in process memory.",
+            hint=(
+                "Other worker processes keep serving objects changed by one of "
+                "them. Use a DjangoCacheBackend over a shared cache unless the "
+                "site runs a single process."
+            ),
+            id="images.W001",
+        )
+    ]
+
+
+def kind_of(model):
+    return model._meta.label_lower
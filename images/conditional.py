@@ -0,0 +1,154 @@
+"""
+Conditional GET for the read endpoints and uploaded media.
+
+API ETags are digests of the ``version`` columns of the objects a response is
+made of, which change with every write of their row, so an unchanged resource
+is answered with 304 before anything is serialized. Sharded counters and
+buffered likes change the representation without writing the row and are
+added to the digest. Media files are validated by their
+modification time and size and can be requested by byte range.
+"""
+import hashlib
+import mimetypes
+import posixpath
+import re
+from pathlib import Path
+
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from . import counters
+from .likebuffer import like_buffer
+from .models import Image
+
+BYTE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def versions_etag(model, pks, *extra):
+    """
+    Weak ETag of the stored state of ``pks`` and any ``extra`` values.
+    """
+    versions = dict(model.objects.filter(pk__in=pks).values_list("pk", "version"))
+    return state_etag(model, {pk: versions.get(pk) for pk in pks}, *extra)
+
+
+def state_etag(model, versions, *extra):
+    """
+    ``versions_etag`` of the ``{pk: version}`` already read with a page.
+    """
+    pks = list(versions)
+    unstored = [
+        counters.get_shard_totals(model, field, pks)
+        for field in counters.sharded_fields(model)
+    ]
+    if model is Image:
+        unstored.append(like_buffer.get_like_deltas(pks))
+    state = [(pk, versions.get(pk), [part.get(pk) for part in unstored]) for pk in pks]
+    digest = hashlib.md5(repr((state, extra)).encode()).hexdigest()
+    return 'W/"%s"' % digest
+
+
+def page_etag(paginator, model, objects, *extra):
+    return versions_etag(
+        model,
+        [obj.pk for obj in objects],
+        paginator.get_next_link(),
+        paginator.get_previous_link(),
+        *extra
+    )
+
+
+def conditional(request, etag, render):
+    """
+    Answer 304 when ``If-None-Match`` has ``etag``, otherwise call ``render()``.
+    """
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = render()
+    response["ETag"] = etag
+    return response
+
+
+def parse_range(header, size):
+    """
+    Return the (first, last) byte of a single range, None to send everything.
+
+    Raises ValueError when the range lies outside of the file.
+    """
+    match = BYTE_RANGE.match(header.strip())
+    if match is None or match.groups() == ("", ""):
+        # Malformed or several ranges, which may be answered in full
+        return None
+    first, last = match.groups()
+    if not first:
+        if not int(last):
+            raise ValueError(header)
+        return max(size - int(last), 0), size - 1
+    if last and int(last) < int(first):
+        return None
+    if int(first) >= size:
+        raise ValueError(header)
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+def read_range(path, first, last, chunk_size=FileResponse.block_size):
+    with open(path, "rb") as source:
+        source.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = source.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def serve_media(request, path, document_root=None):
+    """
+    Serve an uploaded file like ``django.views.static.serve``, also answering
+    ``If-None-Match`` and single ``Range`` requests.
+    """
+    path = posixpath.normpath(path).lstrip("/")
+    fullpath = Path(safe_join(document_root, path))
+    if not fullpath.is_file():
+        raise Http404('"%s" does not exist' % path)
+
+    stat = fullpath.stat()
+    etag = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+    last_modified = http_date(stat.st_mtime)
+    response = get_conditional_response(
+        request, etag=etag, last_modified=int(stat.st_mtime)
+    )
+    if response is not None:
+        response["ETag"] = etag
+        return response
+
+    content_type, encoding = mimetypes.guess_type(str(fullpath))
+    content_type = content_type or "application/octet-stream"
+    byte_range = None
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if "HTTP_RANGE" in request.META and if_range in (None, etag, last_modified):
+        try:
+            byte_range = parse_range(request.META["HTTP_RANGE"], stat.st_size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = "bytes */%d" % stat.st_size
+            return response
+
+    if byte_range is None:
+        response = FileResponse(fullpath.open("rb"), content_type=content_type)
+    else:
+        first, last = byte_range
+        response = StreamingHttpResponse(
+            read_range(fullpath, first, last), status=206, content_type=content_type
+        )
+        response["Content-Length"] = last - first + 1
+        response["Content-Range"] = "bytes %d-%d/%d" % (first, last, stat.st_size)
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Last-Modified"] = last_modified
+    if encoding:
+        response["Content-Encoding"] = encoding
+    return response
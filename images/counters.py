@@ -0,0 +1,153 @@
+"""
+Race-free denormalized counters.
+
+Every change is a single ``UPDATE ... SET field = field + n`` so concurrent
+writers never lose updates. Counters listed in ``COUNTER_SHARDS`` are hot:
+their increments are spread over several ``CounterShard`` rows, which are
+added to the value stored on the model row when the counter is read.
+"""
+import random
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from . import models
+from .cache import kind_of, object_cache
+from .transactions import write_atomic
+
+
+def counter_name(model, field):
+    return "%s.%s" % (model._meta.label_lower, field)
+
+
+def shard_count(model, field):
+    return settings.COUNTER_SHARDS.get(counter_name(model, field), 0)
+
+
+def versioned(model):
+    """
+    The update changing the ``version`` column of ``model``, if it has one.
+    """
+    if any(field.name == "version" for field in model._meta.concrete_fields):
+        return {"version": F("version") + 1}
+    return {}
+
+
+def touch(model, *pks):
+    """
+    Change the ``version`` of rows whose representation changed otherwise.
+    """
+    model.objects.filter(pk__in=pks).update(**versioned(model))
+
+
+def increment(model, pk, field, delta=1):
+    if not delta:
+        return
+    if not shard_count(model, field):
+        model.objects.filter(pk=pk).update(
+            **{field: F(field) + delta}, **versioned(model)
+        )
+    else:
+        add_to_shard(model, pk, field, delta)
+    # After the write, see ObjectCache.invalidate
+    object_cache.invalidate(kind_of(model), pk)
+
+
+def add_to_shard(model, pk, field, delta):
+    shard = dict(
+        counter=counter_name(model, field),
+        object_id=pk,
+        shard=random.randrange(shard_count(model, field)),
+    )
+    if models.CounterShard.objects.filter(**shard).update(value=F("value") + delta):
+        return
+    try:
+        with write_atomic():
+            models.CounterShard.objects.create(value=delta, **shard)
+    except IntegrityError:
+        # Another writer created the shard first
+        models.CounterShard.objects.filter(**shard).update(value=F("value") + delta)
+
+
+def increment_many(model, field, deltas):
+    """
+    Apply ``{pk: delta}`` with one UPDATE per distinct delta.
+
+    Sharded counters add every delta to the same random shard of each
+    object, creating the missing shards with one bulk insert first.
+    """
+    by_delta = defaultdict(list)
+    for pk, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(pk)
+    changed = [pk for pks in by_delta.values() for pk in pks]
+    if not changed:
+        return
+
+    if shard_count(model, field):
+        shard = dict(
+            counter=counter_name(model, field),
+            shard=random.randrange(shard_count(model, field)),
+        )
+        models.CounterShard.objects.bulk_create(
+            [models.CounterShard(object_id=pk, value=0, **shard) for pk in changed],
+            ignore_conflicts=True,
+        )
+        for delta, pks in by_delta.items():
+            models.CounterShard.objects.filter(object_id__in=pks, **shard).update(
+                value=F("value") + delta
+            )
+    else:
+        for delta, pks in by_delta.items():
+            model.objects.filter(pk__in=pks).update(
+                **{field: F(field) + delta}, **versioned(model)
+            )
+    object_cache.invalidate(kind_of(model), *changed)
+
+
+def sharded_fields(model):
+    """
+    The counters of ``model`` kept in shards, which leave its row untouched.
+    """
+    prefix = model._meta.label_lower + "."
+    return sorted(
+        name[len(prefix) :]
+        for name, shards in settings.COUNTER_SHARDS.items()
+        if name.startswith(prefix) and shards
+    )
+
+
+def get_shard_totals(model, field, pks):
+    """
+    Return ``{pk: sum of shards}`` for the given objects in one query.
+    """
+    if not shard_count(model, field) or not pks:
+        return {}
+    shards = models.CounterShard.objects.filter(
+        counter=counter_name(model, field), object_id__in=pks
+    )
+    return dict(shards.values_list("object_id").annotate(Sum("value")).order_by())
+
+
+def get_value(instance, field):
+    totals = get_shard_totals(type(instance), field, [instance.pk])
+    return getattr(instance, field) + totals.get(instance.pk, 0)
+
+
+def count_of(queryset, field):
+    """
+    Correlated ``COUNT(*)`` of ``queryset`` rows whose ``field`` is the outer row.
+
+    Used to recompute a counter column for a whole table in one UPDATE.
+    """
+    counted = (
+        queryset.filter(**{field: OuterRef("pk")})
+        .order_by()
+        .values(field)
+        .annotate(total=Count("pk"))
+        .values("total")
+    )
+    return Coalesce(Subquery(counted), 0)
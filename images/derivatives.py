@@ -0,0 +1,203 @@
+"""
+Resized and re-encoded variants of uploaded pictures.
+
+After an upload the original is read on a background thread and decoded,
+resized and encoded in a process pool, one task per picture, following the
+``IMAGE_VARIANTS`` settings. Re-encoding drops EXIF metadata; the EXIF
+orientation is applied to the pixels first. Uploads carrying EXIF, which can
+hold the GPS position, are re-encoded the same way before the original is
+stored. The stored names and sizes are
+kept as JSON on the model next to the name of the file they were made from,
+so a replaced upload is detected and processed again.
+"""
+import io
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image as PILImage
+from PIL import ImageOps
+
+from . import counters, storage, tasks
+from .cache import kind_of, object_cache
+
+EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=settings.IMAGE_VARIANT_WORKERS)
+        return _pool
+
+
+def render(data, specs):
+    """
+    Encode every variant of the picture in ``data``.
+
+    Runs in a worker process, returns ``{name: (bytes, width, height)}``.
+    """
+    with PILImage.open(io.BytesIO(data)) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ("RGB", "RGBA", "L"):
+            original = original.convert("RGBA" if "A" in original.mode else "RGB")
+
+        rendered = {}
+        for name, spec in specs.items():
+            if spec.get("crop"):
+                picture = ImageOps.fit(
+                    original, (spec["width"], spec["height"]), PILImage.LANCZOS
+                )
+            else:
+                picture = original.copy()
+                picture.thumbnail(
+                    (spec["width"], spec.get("height", spec["width"] * 4)),
+                    PILImage.LANCZOS,
+                )
+            if spec["format"] == "JPEG" and picture.mode != "RGB":
+                picture = picture.convert("RGB")
+
+            output = io.BytesIO()
+            picture.save(output, spec["format"], quality=spec.get("quality", 85))
+            rendered[name] = (output.getvalue(), picture.width, picture.height)
+        return rendered
+
+
+def strip_exif(field):
+    """
+    Re-encode a new upload of ``field`` without its EXIF metadata.
+
+    Runs before the upload is stored; uploads without EXIF are kept as is.
+    """
+    if not field or field._committed:
+        return
+    upload = field.file
+    upload.seek(0)
+    try:
+        with PILImage.open(upload) as picture:
+            if not picture.info.get("exif") or picture.format not in EXTENSIONS:
+                return
+            image_format = picture.format
+            icc_profile = picture.info.get("icc_profile")
+            picture = ImageOps.exif_transpose(picture)
+            output = io.BytesIO()
+            picture.save(output, image_format, quality=95, icc_profile=icc_profile)
+    except (OSError, SyntaxError, ValueError):
+        # Not a picture PIL can rewrite, ImageField validation decides
+        return
+    finally:
+        upload.seek(0)
+    field.file = ContentFile(output.getvalue(), name=field.name)
+
+
+def load(source, raw):
+    """
+    Return the stored variants made from ``source``, or {} if missing or stale.
+    """
+    try:
+        variants = json.loads(raw) if raw else {}
+    except ValueError:
+        return {}
+    if not source or variants.get("source") != source:
+        return {}
+    return variants
+
+
+def stored_names(raw):
+    """
+    Names of all the variants recorded in ``raw``, fresh or stale.
+    """
+    try:
+        variants = json.loads(raw) if raw else {}
+    except ValueError:
+        return []
+    return [variant["name"] for key, variant in variants.items() if key != "source"]
+
+
+def variant_name(source, name, image_format):
+    # Variants live next to the upload_to directory, not in storage shards
+    directory = source.split("/", 1)[0] if "/" in source else ""
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return os.path.join(
+        directory, "variants", "%s_%s.%s" % (stem, name, EXTENSIONS[image_format])
+    )
+
+
+def process(model, pk, field_name, variants_field, force=False):
+    """
+    Build and store the variants of one picture, skipping fresh ones unless
+    ``force`` is set.
+    """
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None:
+        return
+    field = getattr(instance, field_name)
+    previous = getattr(instance, variants_field)
+    if not field or (load(field.name, previous) and not force):
+        return
+
+    with field.open("rb") as source:
+        data = source.read()
+    specs = settings.IMAGE_VARIANTS
+    rendered = get_pool().submit(render, data, specs).result()
+
+    variants = {"source": field.name}
+    for name, (content, width, height) in rendered.items():
+        stored = field.storage.save(
+            variant_name(field.name, name, specs[name]["format"]), ContentFile(content)
+        )
+        variants[name] = {"name": stored, "width": width, "height": height}
+
+    # Only record the variants if the upload and its variants were not
+    # replaced meanwhile, and release the references of those replaced
+    replaced = model.objects.filter(
+        pk=pk, **{field_name: field.name, variants_field: previous}
+    ).update(**{variants_field: json.dumps(variants)}, **counters.versioned(model))
+    if replaced:
+        storage.discard(field.storage, stored_names(previous))
+        object_cache.invalidate(kind_of(model), pk)
+    else:
+        storage.discard(field.storage, stored_names(json.dumps(variants)))
+
+
+def schedule(instance, field_name, variants_field):
+    field = getattr(instance, field_name)
+    if field and not load(field.name, getattr(instance, variants_field)):
+        tasks.defer(process, type(instance), instance.pk, field_name, variants_field)
+
+
+def represent(field, raw, request=None):
+    """
+    Serialize the variants of ``field``, falling back to the original.
+    """
+    if not field:
+        return None
+    return represent_name(field.storage, field.name, raw, request)
+
+
+def represent_name(storage, source, raw, request=None):
+    """
+    ``represent`` for a stored file name, as read with ``.values()``.
+    """
+    if not source:
+        return None
+    variants = load(source, raw)
+    represented = {}
+    for name in settings.IMAGE_VARIANTS:
+        variant = variants.get(name)
+        if variant is None:
+            url, width, height = storage.url(source), None, None
+        else:
+            url = storage.url(variant["name"])
+            width, height = variant["width"], variant["height"]
+        if request is not None:
+            url = request.build_absolute_uri(url)
+        represented[name] = {"url": url, "width": width, "height": height}
+    return represented
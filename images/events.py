@@ -0,0 +1,207 @@
+"""
+Publish/subscribe of live events for the ASGI event stream.
+
+Events are ``(topic, type, data)`` triples. ``user:<id>`` topics carry the
+likes and comments on a user's images and its own follows; ``creator:<id>``
+topics carry new images of a creator. Model code calls ``publish``, which
+hands the events to the ``EVENTS_BROKER`` once the transaction commits. With
+``EVENTS_ENABLED`` off, as when no ASGI stream is deployed, events are dropped
+so no write pays for an unread event.
+
+Every process serving streams has one ``Hub``. The broker delivers events to
+it, and the hub writes each event once as a Server-Sent Events frame shared
+by all of its subscribers. An idle subscriber is a small ``__slots__`` object
+with no queue until an event arrives.
+"""
+import abc
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+
+def encode(event_id, kind, data):
+    frame = "id: %d\nevent: %s\ndata: %s\n\n" % (event_id, kind, json.dumps(data))
+    return frame.encode()
+
+
+class Subscriber:
+    __slots__ = ("topics", "frames", "waiter")
+
+    def __init__(self):
+        self.topics = set()
+        self.frames = None
+        self.waiter = None
+
+    def push(self, frame):
+        if self.frames is None:
+            self.frames = deque(maxlen=settings.EVENTS_QUEUE_SIZE)
+        self.frames.append(frame)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def wait(self):
+        self.waiter = asyncio.get_event_loop().create_future()
+        if self.frames:
+            self.waiter.set_result(None)
+        return self.waiter
+
+    def drain(self):
+        frames, self.frames = self.frames or (), None
+        return b"".join(frames)
+
+
+class Hub:
+    def __init__(self):
+        # topic -> set of subscribers
+        self.topics = {}
+
+    def subscribe(self, subscriber, topics):
+        for topic in topics:
+            # One string per topic, however many connections subscribe to it
+            topic = sys.intern(topic)
+            self.topics.setdefault(topic, set()).add(subscriber)
+            subscriber.topics.add(topic)
+
+    def unsubscribe(self, subscriber, topics=None):
+        for topic in list(subscriber.topics if topics is None else topics):
+            subscribers = self.topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.topics[topic]
+            subscriber.topics.discard(topic)
+
+    def dispatch(self, events):
+        """
+        Deliver ``(id, topic, type, data)`` events to their subscribers.
+        """
+        for event_id, topic, kind, data in events:
+            subscribers = self.topics.get(topic)
+            if not subscribers:
+                continue
+            frame = encode(event_id, kind, data)
+            for subscriber in list(subscribers):
+                # Streams follow the follows of their user
+                if kind == "follow":
+                    self.subscribe(subscriber, ["creator:%d" % data["user"]])
+                elif kind == "unfollow":
+                    self.unsubscribe(subscriber, ["creator:%d" % data["user"]])
+                subscriber.push(frame)
+
+
+hub = Hub()
+
+
+class Broker(abc.ABC):
+    """
+    Carries published events to the hub of every process serving streams.
+
+    ``publish`` runs in the processes serving the API, ``run`` in those
+    serving streams.
+    """
+
+    @abc.abstractmethod
+    def publish(self, events):
+        """
+        Send ``(topic, type, data)`` events, called once their transaction
+        commits.
+        """
+
+    @abc.abstractmethod
+    async def run(self, hub):
+        """
+        Deliver the published events to ``hub`` until cancelled.
+        """
+
+
+class DatabaseBroker(Broker):
+    """
+    Shares events between processes through the ``StreamEvent`` table, polled
+    every ``EVENTS_POLL_INTERVAL`` seconds.
+
+    Rows older than ``EVENTS_RETENTION`` seconds are purged by the publishing
+    processes, so the table stays bounded whether or not streams are served.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.purged = time.monotonic()
+
+    def publish(self, events):
+        models.StreamEvent.objects.bulk_create(
+            [
+                models.StreamEvent(topic=topic, kind=kind, data=json.dumps(data))
+                for topic, kind, data in events
+            ]
+        )
+        with self.lock:
+            due = time.monotonic() - self.purged > settings.EVENTS_RETENTION
+            if due:
+                self.purged = time.monotonic()
+        if due:
+            self.purge()
+
+    def latest(self):
+        return models.StreamEvent.objects.aggregate(Max("pk"))["pk__max"] or 0
+
+    def fetch(self, after, limit=1000):
+        rows = models.StreamEvent.objects.filter(pk__gt=after).order_by("pk")[:limit]
+        return [
+            (pk, topic, kind, json.loads(data))
+            for pk, topic, kind, data in rows.values_list("pk", "topic", "kind", "data")
+        ]
+
+    def purge(self):
+        expired = timezone.now() - timedelta(seconds=settings.EVENTS_RETENTION)
+        models.StreamEvent.objects.filter(created__lt=expired).delete()
+
+    def poll(self, after):
+        """
+        Return the last event id and the events after ``after``, starting from
+        the latest event when ``after`` is None.
+        """
+        try:
+            if after is None:
+                return self.latest(), []
+            events = self.fetch(after)
+            return (events[-1][0] if events else after), events
+        finally:
+            connection.close_if_unusable_or_obsolete()
+
+    async def run(self, hub):
+        loop = asyncio.get_event_loop()
+        last = None
+        while True:
+            try:
+                last, events = await loop.run_in_executor(None, self.poll, last)
+                hub.dispatch(events)
+            except Exception:
+                # Failed polls are retried, the events wait in the table
+                logger.exception("Polling stream events failed")
+            await asyncio.sleep(settings.EVENTS_POLL_INTERVAL)
+
+
+broker = import_string(settings.EVENTS_BROKER)()
+
+
+def publish(*events):
+    """
+    Send ``(topic, type, data)`` events once the transaction commits.
+    """
+    if events and settings.EVENTS_ENABLED:
+        transaction.on_commit(lambda: broker.publish(events))
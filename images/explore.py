@@ -0,0 +1,138 @@
+"""
+Explore ranking of creators and images.
+
+Every like, follow and post adds its ``EXPLORE_WEIGHTS`` weight to the score
+of the creators and images it concerns, halving every ``EXPLORE_HALF_LIFE``
+seconds. A score is stored as ``log(sum(weight * 2 ** ((t - EPOCH) / half
+life)))`` over its events: all scores decay at the same rate, so ordering by
+the stored value ranks by the current decayed score, and new events only add
+to the rows they concern.
+
+``update`` reads the rows added to the source tables since its last run,
+remembered in ``ExploreCheckpoint``, and drops scores that decayed below
+``EXPLORE_MIN_SCORE``. Removed likes and follows are not subtracted; they
+fade out with the rest.
+"""
+import math
+from collections import defaultdict
+from datetime import datetime
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import CreatorFollower, ExploreCheckpoint, ExploreScore, Image, Like
+from .transactions import write_atomic
+
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+# source -> (model, weight, (kind, field) of every object scored by a row)
+SOURCES = {
+    "likes": (
+        Like,
+        "like",
+        (("image", "image_id"), ("creator", "image__creator_id")),
+    ),
+    "follows": (CreatorFollower, "follow", (("creator", "creator_id"),)),
+    "posts": (Image, "post", (("image", "pk"), ("creator", "creator_id"))),
+}
+
+
+def logaddexp(a, b):
+    """
+    ``log(exp(a) + exp(b))`` without overflowing.
+    """
+    if a < b:
+        a, b = b, a
+    if b == -math.inf:
+        return a
+    return a + math.log1p(math.exp(b - a))
+
+
+def growth(moment):
+    """
+    Log of the factor by which an event at ``moment`` outweighs one at EPOCH.
+    """
+    elapsed = (moment - EPOCH).total_seconds()
+    return elapsed * math.log(2) / settings.EXPLORE_HALF_LIFE
+
+
+def add_scores(deltas):
+    """
+    Merge ``{(kind, object id): log score}`` into the stored scores.
+    """
+    by_kind = defaultdict(list)
+    for kind, object_id in deltas:
+        by_kind[kind].append(object_id)
+
+    changed = []
+    for kind, object_ids in by_kind.items():
+        for row in ExploreScore.objects.filter(kind=kind, object_id__in=object_ids):
+            row.score = logaddexp(row.score, deltas.pop((kind, row.object_id)))
+            changed.append(row)
+    ExploreScore.objects.bulk_update(changed, ["score"], batch_size=500)
+    ExploreScore.objects.bulk_create(
+        [
+            ExploreScore(kind=kind, object_id=object_id, score=score)
+            for (kind, object_id), score in deltas.items()
+        ],
+        batch_size=500,
+    )
+
+
+def update_source(source, batch_size):
+    """
+    Score the next ``batch_size`` rows of a source, returning how many were read.
+    """
+    model, weight_name, targets = SOURCES[source]
+    weight = math.log(settings.EXPLORE_WEIGHTS[weight_name])
+    fields = [field for _kind, field in targets]
+
+    with write_atomic():
+        checkpoint, _created = ExploreCheckpoint.objects.get_or_create(source=source)
+        rows = list(
+            model.objects.filter(pk__gt=checkpoint.last_id)
+            .order_by("pk")
+            .values_list("pk", "created", *fields)[:batch_size]
+        )
+        if not rows:
+            return 0
+
+        deltas = {}
+        for _pk, created, *object_ids in rows:
+            value = weight + growth(created)
+            for (kind, _field), object_id in zip(targets, object_ids):
+                key = (kind, object_id)
+                deltas[key] = logaddexp(deltas.get(key, -math.inf), value)
+        add_scores(deltas)
+
+        checkpoint.last_id = rows[-1][0]
+        checkpoint.save(update_fields=["last_id"])
+    return len(rows)
+
+
+def prune(now=None):
+    threshold = growth(now or timezone.now()) + math.log(settings.EXPLORE_MIN_SCORE)
+    return ExploreScore.objects.filter(score__lt=threshold).delete()[0]
+
+
+def update(batch_size=1000):
+    """
+    Add every new source row to the scores, returning ``{source: rows read}``.
+    """
+    counts = {}
+    for source in SOURCES:
+        counts[source] = 0
+        while True:
+            read = update_source(source, batch_size)
+            counts[source] += read
+            if read < batch_size:
+                break
+    prune()
+    return counts
+
+
+def rebuild(batch_size=1000):
+    with write_atomic():
+        ExploreScore.objects.all().delete()
+        ExploreCheckpoint.objects.all().delete()
+    return update(batch_size)
@@ -0,0 +1,176 @@
+"""
+Home feed storage.
+
+New images are pushed into each follower's ``TimelineEntry`` inbox when they
+are written, so reading a feed page is one range scan over the reader's own
+inbox. Creators with more than ``FEED_FANOUT_THRESHOLD`` followers are not
+fanned out; their images are pulled and merged in when the feed is read.
+Creators that drop back to the threshold have their latest images pushed to
+all followers, as those they posted while above it were never pushed.
+"""
+import heapq
+from itertools import islice
+
+from django.conf import settings
+
+from .models import Creator, CreatorFollower, Image, TimelineEntry
+from .pagination import keyset_filter, reverse_ordering
+
+INBOX_ORDERING = ("-created", "-image_id")
+IMAGE_ORDERING = ("-created", "-id")
+
+
+def is_fanned_out(creator):
+    return creator.followers_count <= settings.FEED_FANOUT_THRESHOLD
+
+
+def push(images, owner_ids):
+    """
+    Insert ``images`` into the inboxes of ``owner_ids`` in batches.
+    """
+    batch_size = settings.FEED_FANOUT_BATCH_SIZE
+    owner_ids = iter(owner_ids)
+    while True:
+        owners = list(islice(owner_ids, batch_size))
+        if not owners:
+            return
+        TimelineEntry.objects.bulk_create(
+            [
+                TimelineEntry(
+                    owner_id=owner_id,
+                    image_id=image.id,
+                    creator_id=image.creator_id_id,
+                    created=image.created,
+                )
+                for owner_id in owners
+                for image in images
+            ],
+            ignore_conflicts=True,
+        )
+
+
+def fan_out(image_id):
+    image = Image.objects.select_related("creator_id").filter(pk=image_id).first()
+    if image is None or not is_fanned_out(image.creator_id):
+        return
+    follower_ids = (
+        CreatorFollower.objects.filter(creator=image.creator_id)
+        .values_list("follower_id", flat=True)
+        .iterator()
+    )
+    push([image], follower_ids)
+
+
+def recent_images(creator_id):
+    return list(
+        Image.objects.filter(creator_id=creator_id)
+        .order_by(*IMAGE_ORDERING)
+        .only("id", "creator_id", "created")[: settings.FEED_BACKFILL_SIZE]
+    )
+
+
+def backfill_timeline(owner_id, creator_id):
+    """
+    Copy the latest images of a newly followed creator into the inbox.
+    """
+    creator = Creator.objects.filter(pk=creator_id).first()
+    if creator is None or not is_fanned_out(creator):
+        return
+    follows = CreatorFollower.objects.filter(creator=creator, follower_id=owner_id)
+    if not follows.exists():
+        return
+    push(recent_images(creator_id), [owner_id])
+
+
+def dropped_to_threshold(creator_ids):
+    """
+    Return those of ``creator_ids`` that one unfollow took back to the
+    threshold, to be called after decrementing their ``followers_count``.
+    """
+    return list(
+        Creator.objects.filter(
+            pk__in=creator_ids, followers_count=settings.FEED_FANOUT_THRESHOLD
+        ).values_list("pk", flat=True)
+    )
+
+
+def backfill_followers(creator_id):
+    """
+    Push the latest images of a creator that is fanned out again to all of
+    its followers.
+    """
+    creator = Creator.objects.filter(pk=creator_id).first()
+    if creator is None or not is_fanned_out(creator):
+        return
+    images = recent_images(creator_id)
+    if images:
+        follows = CreatorFollower.objects.filter(creator_id=creator_id)
+        push(images, follows.values_list("follower_id", flat=True).iterator())
+
+
+def rebuild_timelines(owner_ids=None):
+    """
+    Backfill inboxes from the follow graph, optionally for some owners only.
+    """
+    creators = Creator.objects.filter(
+        followers_count__lte=settings.FEED_FANOUT_THRESHOLD, post_count__gt=0
+    )
+    if owner_ids is not None:
+        creators = creators.filter(creator__follower__in=owner_ids).distinct()
+
+    pushed = 0
+    for creator_id in creators.values_list("pk", flat=True).iterator():
+        follows = CreatorFollower.objects.filter(creator_id=creator_id)
+        if owner_ids is not None:
+            follows = follows.filter(follower__in=owner_ids)
+        images = recent_images(creator_id)
+        if images:
+            push(images, follows.values_list("follower_id", flat=True).iterator())
+            pushed += 1
+    return pushed
+
+
+class Timeline:
+    """
+    Keyset-paginated view of a user's home feed.
+
+    Merges the materialized inbox with images pulled from followed creators
+    that are above the fan-out threshold.
+    """
+
+    model = Image
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def pulled_creators(self):
+        return CreatorFollower.objects.filter(
+            follower=self.owner,
+            creator__followers_count__gt=settings.FEED_FANOUT_THRESHOLD,
+        ).values("creator")
+
+    def page(self, position, reverse, limit):
+        inbox_ordering = reverse_ordering(INBOX_ORDERING) if reverse else INBOX_ORDERING
+        image_ordering = reverse_ordering(IMAGE_ORDERING) if reverse else IMAGE_ORDERING
+
+        inbox = TimelineEntry.objects.filter(owner=self.owner)
+        pulled = Image.objects.filter(creator_id__in=self.pulled_creators())
+        if position is not None:
+            inbox = inbox.filter(keyset_filter(INBOX_ORDERING, position, reverse))
+            pulled = pulled.filter(keyset_filter(IMAGE_ORDERING, position, reverse))
+
+        inbox = inbox.order_by(*inbox_ordering).values_list("created", "image_id")
+        pulled = pulled.order_by(*image_ordering).values_list("created", "id")
+        merged = heapq.merge(inbox[:limit], pulled[:limit], reverse=not reverse)
+
+        image_ids = []
+        for _created, image_id in merged:
+            # A creator that crossed the threshold can be in both sources
+            if image_id not in image_ids:
+                image_ids.append(image_id)
+            if len(image_ids) == limit:
+                break
+
+        # The page is serialized from the cache by id, only the cursor is read
+        images = Image.objects.only("created").in_bulk(image_ids)
+        return [images[image_id] for image_id in image_ids if image_id in images]
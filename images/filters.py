@@ -17,6 +17,8 @@ class CreatorFilter(django_filters.FilterSet):
 
 
 class ImageFilter(django_filters.FilterSet):
+    tag = django_filters.CharFilter(field_name="hashtags__name")
+
     class Meta:
         model = Image
         fields = ["id", "caption", "like_count", "tags"]
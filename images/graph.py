@@ -0,0 +1,63 @@
+"""
+Compact follow graph and friends-of-friends scoring.
+
+The graph is stored CSR-style in two ``array`` objects: the accounts followed
+by user ``u`` are ``targets[offsets[u]:offsets[u + 1]]``, indexed directly by
+user id. Both arrays are handed once to every process of the pool, which
+then scores chunks of users with ``suggest_many``.
+"""
+import heapq
+from array import array
+from collections import Counter
+
+graph = None
+
+
+def build(edges, size):
+    """
+    Build ``(offsets, targets)`` from (follower, followed) pairs sorted by
+    follower, for user ids below ``size``.
+    """
+    offsets = array("l", [0])
+    targets = array("l")
+    for source, target in edges:
+        while len(offsets) <= source:
+            offsets.append(len(targets))
+        targets.append(target)
+    while len(offsets) <= size:
+        offsets.append(len(targets))
+    return offsets, targets
+
+
+def suggest(offsets, targets, user, limit, max_degree):
+    """
+    Return the ``limit`` best ``(user id, mutual count)`` suggestions of
+    ``user``: the accounts followed by the most of the accounts it follows.
+
+    Accounts following more than ``max_degree`` others are not counted as
+    mutual, they would only add noise at a great cost.
+    """
+    if user + 1 >= len(offsets):
+        return []
+    following = targets[offsets[user] : offsets[user + 1]]
+    overlap = Counter()
+    for friend in following:
+        start, end = offsets[friend], offsets[friend + 1]
+        if end - start <= max_degree:
+            overlap.update(targets[start:end])
+    for followed in following:
+        overlap.pop(followed, None)
+    overlap.pop(user, None)
+    return heapq.nlargest(limit, overlap.items(), key=lambda item: (item[1], -item[0]))
+
+
+def init_worker(offsets, targets):
+    global graph
+    graph = (offsets, targets)
+
+
+def suggest_many(users, limit, max_degree):
+    offsets, targets = graph
+    return [
+        (user, suggest(offsets, targets, user, limit, max_degree)) for user in users
+    ]
@@ -0,0 +1,205 @@
+"""
+Write-behind buffer for like traffic.
+
+With ``LIKE_WRITE_BEHIND`` enabled the like endpoints only record the intent
+of each (image, person) pair in process memory. A flusher thread applies the
+buffered intents every ``LIKE_BUFFER_FLUSH_INTERVAL`` seconds, or as soon as
+``LIKE_BUFFER_BATCH_SIZE`` are pending, with one bulk insert, one bulk delete
+and one counter update per image.
+
+Reads overlay the intents that are not flushed yet so users see their own
+writes. The buffer is per process; other workers see a like once flushed.
+"""
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+
+from . import activity, counters, events, likefilter
+from .cache import kind_of, object_cache
+from .models import Image, Like, like_event
+from .transactions import write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class LikeBuffer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # (image_id, person_id) -> (liked, liked in the database)
+        self.pending = {}
+        self.flushing = {}
+        self.flusher = None
+
+    def record(self, image_id, person_id, liked):
+        """
+        Buffer a like or unlike, raising ``Image.DoesNotExist`` for unknown images.
+        """
+        key = (image_id, person_id)
+        with self.lock:
+            if key in self.pending:
+                stored = self.pending[key][1]
+            elif key in self.flushing:
+                # Stored once the flush commits, see restore otherwise
+                stored = self.flushing[key][0]
+            else:
+                stored = None
+        if stored is None:
+            stored = (
+                Image.objects.filter(pk=image_id)
+                .annotate(
+                    liked=Exists(
+                        Like.objects.filter(image=OuterRef("pk"), person_id=person_id)
+                    )
+                )
+                .values_list("liked", flat=True)
+                .get()
+            )
+
+        with self.lock:
+            self.pending[key] = (liked, stored)
+            size = len(self.pending)
+        object_cache.invalidate(kind_of(Image), image_id)
+
+        self.start()
+        if size >= settings.LIKE_BUFFER_BATCH_SIZE:
+            self.wakeup.set()
+
+    def entries(self):
+        with self.lock:
+            entries = dict(self.flushing)
+            entries.update(self.pending)
+        return entries
+
+    def get_like_deltas(self, image_ids):
+        """
+        Return ``{image_id: change of like_count}`` not yet in the database.
+        """
+        image_ids = set(image_ids)
+        deltas = defaultdict(int)
+        for (image_id, _person_id), (liked, stored) in self.entries().items():
+            if image_id in image_ids and liked != stored:
+                deltas[image_id] += 1 if liked else -1
+        return deltas
+
+    def is_liked(self, image_id, person_id):
+        """
+        Return the buffered state of a like, or None when nothing is pending.
+        """
+        entry = self.entries().get((image_id, person_id))
+        return None if entry is None else entry[0]
+
+    def start(self):
+        if self.flusher is not None:
+            return
+        with self.lock:
+            if self.flusher is None:
+                self.flusher = threading.Thread(
+                    target=self.run, name="like-buffer", daemon=True
+                )
+                self.flusher.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(settings.LIKE_BUFFER_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Flushing buffered likes failed")
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                self.flushing, self.pending = self.pending, {}
+            if not self.flushing:
+                return
+            try:
+                apply(self.flushing)
+            except Exception:
+                self.restore()
+                raise
+            with self.lock:
+                self.flushing = {}
+
+    def restore(self):
+        """
+        Put back the intents of a failed flush, which rolled back entirely.
+
+        Intents recorded since then are newer and win, but were recorded
+        assuming the flush would succeed, so they get the stored state back.
+        """
+        with self.lock:
+            for key, (liked, stored) in self.flushing.items():
+                newer = self.pending.get(key)
+                self.pending[key] = (liked if newer is None else newer[0], stored)
+            self.flushing = {}
+
+
+def apply(entries):
+    """
+    Write buffered intents with bulk queries and aggregated counter updates.
+
+    Returns ``{(image_id, person_id): changed}``, leaving out unknown images.
+    """
+    image_ids = {image_id for image_id, _person_id in entries}
+    person_ids = {person_id for _image_id, person_id in entries}
+
+    with write_atomic():
+        owners = dict(
+            Image.objects.filter(pk__in=image_ids).values_list("pk", "creator_id")
+        )
+        existing = {
+            (image_id, person_id): like_id
+            for like_id, image_id, person_id in Like.objects.filter(
+                image_id__in=owners, person_id__in=person_ids
+            ).values_list("pk", "image_id", "person_id")
+        }
+
+        deltas = defaultdict(int)
+        created, deleted = [], []
+        changed = {}
+        for key, (liked, _stored) in entries.items():
+            image_id, person_id = key
+            if image_id not in owners:
+                continue
+            changed[key] = liked != (key in existing)
+            if liked and key not in existing:
+                created.append(Like(image_id=image_id, person_id=person_id))
+                deltas[image_id] += 1
+            elif not liked and key in existing:
+                deleted.append(existing[key])
+                deltas[image_id] -= 1
+
+        Like.objects.bulk_create(created, ignore_conflicts=True)
+        Like.objects.filter(pk__in=deleted).delete()
+        counters.increment_many(Image, "like_count", deltas)
+        # Deleted likes invalidated the filters of their people already
+        added = defaultdict(list)
+        for like in created:
+            added[like.person_id].append(like.image_id)
+        for person_id, liked_ids in added.items():
+            likefilter.add(person_id, *liked_ids)
+        activity.record(
+            *[
+                (owners[like.image_id], "like", like.person_id, like.image_id)
+                for like in created
+            ]
+        )
+        events.publish(
+            *[
+                like_event(owners[like.image_id], like)
+                for like in created
+                if owners[like.image_id] != like.person_id
+            ]
+        )
+    return changed
+
+
+like_buffer = LikeBuffer()
+atexit.register(like_buffer.flush)
@@ -0,0 +1,208 @@
+"""
+Which images of a page the viewer has liked.
+
+Most images on a page are not liked by the viewer, so each user's liked
+image ids are summarized in a Bloom filter: about ``BITS_PER_LIKE`` bits per
+like and a false positive rate near 1%, never a false negative. Every process
+keeps the filters of up to ``MAX_FILTERS`` recent users in memory, each built
+with one query and kept for ``FILTER_TIMEOUT`` seconds at most.
+
+Filters are checked against a version token per user in the object cache,
+shared between worker processes. A like adds itself to the filter of the
+process that made it and moves the token on; an unlike, which a Bloom filter
+cannot forget, only moves the token. Other processes see a token they did not
+build their filter at and rebuild it on its next use.
+
+``liked_image_ids`` checks only the images the filter may contain with one
+``IN`` query, which a page the user liked nothing on skips entirely. Intents
+waiting in the write-behind like buffer take precedence over both.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.db import transaction
+
+from . import likebuffer
+from .cache import object_cache
+from .models import Like
+
+# Object cache kind of the filter versions, keyed by user id
+KIND = "images.liked"
+
+BITS_PER_LIKE = 10
+HASHES = 7
+MAX_FILTERS = 10000
+FILTER_TIMEOUT = 5 * 60
+
+
+class BloomFilter:
+    """
+    Set of integers answering "maybe" or "certainly not".
+    """
+
+    def __init__(self, size, hashes=HASHES):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray((size + 7) // 8)
+
+    @classmethod
+    def build(cls, items, capacity=0):
+        items = list(items)
+        bloom = cls(max(64, max(capacity, len(items)) * BITS_PER_LIKE))
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+    def positions(self, item):
+        # Double hashing, every position derived from one digest
+        digest = hashlib.blake2b(b"%d" % item, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return [(first + index * step) % self.size for index in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(item)
+        )
+
+
+class Entry:
+    __slots__ = ("version", "expires", "bloom", "room")
+
+    def __init__(self, version, bloom, room):
+        self.version = version
+        self.expires = time.monotonic() + FILTER_TIMEOUT
+        self.bloom = bloom
+        # Likes that can be added before the false positive rate degrades
+        self.room = room
+
+
+class FilterCache:
+    """
+    Bloom filters of the users this process served, least recent first out.
+    """
+
+    def __init__(self, max_entries=MAX_FILTERS):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get_current(self, person_id, version):
+        with self.lock:
+            entry = self.entries.get(person_id)
+            if entry is None:
+                return None
+            if entry.version != version or entry.expires < time.monotonic():
+                del self.entries[person_id]
+                return None
+            self.entries.move_to_end(person_id)
+            return entry
+
+    def set(self, person_id, entry):
+        with self.lock:
+            self.entries[person_id] = entry
+            self.entries.move_to_end(person_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def grow(self, person_id, current, version, image_ids):
+        """
+        Add likes to the filter built at version ``current``, if it has room.
+        """
+        with self.lock:
+            entry = self.entries.get(person_id)
+            if entry is None or entry.version != current:
+                return
+            if entry.room < len(image_ids):
+                del self.entries[person_id]
+                return
+            for image_id in image_ids:
+                entry.bloom.add(image_id)
+            entry.room -= len(image_ids)
+            entry.version = version
+
+    def discard(self, *person_ids):
+        with self.lock:
+            for person_id in person_ids:
+                self.entries.pop(person_id, None)
+
+
+filters = FilterCache()
+
+
+def get_version(person_id):
+    return object_cache.get_versions(KIND, [person_id])[person_id]
+
+
+def get_filter(person_id):
+    # Read before the likes: a like made meanwhile moves it on
+    version = get_version(person_id)
+    entry = filters.get_current(person_id, version)
+    if entry is None:
+        image_ids = list(
+            Like.objects.filter(person_id=person_id).values_list("image_id", flat=True)
+        )
+        # Room for new likes, added in place until it runs out
+        capacity = len(image_ids) + max(16, len(image_ids) // 2)
+        bloom = BloomFilter.build(image_ids, capacity)
+        entry = Entry(version, bloom, bloom.size // BITS_PER_LIKE - len(image_ids))
+        filters.set(person_id, entry)
+    return entry.bloom
+
+
+def add_now(person_id, image_ids):
+    current = get_version(person_id)
+    version = object_cache.bump(KIND, person_id)[person_id]
+    filters.grow(person_id, current, version, image_ids)
+
+
+def add(person_id, *image_ids):
+    """
+    Record new likes of ``person_id``, see ``invalidate`` for unlikes.
+
+    Like ``ObjectCache.invalidate`` this runs again once the transaction
+    commits, so no other process keeps a filter built before the commit.
+    """
+    add_now(person_id, image_ids)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: add_now(person_id, image_ids))
+
+
+def invalidate(*person_ids):
+    if person_ids:
+        filters.discard(*person_ids)
+        object_cache.invalidate(KIND, *person_ids)
+
+
+def liked_image_ids(person, image_ids):
+    """
+    Return the ids among ``image_ids`` that ``person`` likes.
+    """
+    if not person.is_authenticated or not image_ids:
+        return set()
+    bloom = get_filter(person.pk)
+    candidates = [image_id for image_id in image_ids if image_id in bloom]
+    liked = set()
+    if candidates:
+        liked.update(
+            Like.objects.filter(
+                person_id=person.pk, image_id__in=candidates
+            ).values_list("image_id", flat=True)
+        )
+
+    image_ids = set(image_ids)
+    pending = likebuffer.like_buffer.entries()
+    for (image_id, person_id), (buffered, _stored) in pending.items():
+        if person_id == person.pk and image_id in image_ids:
+            if buffered:
+                liked.add(image_id)
+            else:
+                liked.discard(image_id)
+    return liked
@@ -0,0 +1,64 @@
+import base64
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from images.authentication import issue_token
+from images.models import Creator
+
+USERNAME = "bench-auth"
+PASSWORD = "bench-auth-password"
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare requests per second of one process for Basic, session and "
+        "signed token authentication"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500)
+        # Accepts all the compared classes and does little work of its own
+        parser.add_argument("--path", default="/users/token/")
+
+    def handle(self, *args, **options):
+        # Lets the test client through ALLOWED_HOSTS
+        setup_test_environment()
+        try:
+            self.run(options)
+        finally:
+            teardown_test_environment()
+
+    def run(self, options):
+        # The benchmark user and its session are rolled back afterwards
+        with transaction.atomic():
+            user = Creator.objects.create_user(username=USERNAME, password=PASSWORD)
+
+            basic = base64.b64encode(("%s:%s" % (USERNAME, PASSWORD)).encode())
+            session = Client()
+            session.force_login(user)
+            token, _expires = issue_token(user)
+            clients = (
+                ("basic", Client(HTTP_AUTHORIZATION="Basic %s" % basic.decode())),
+                ("session", session),
+                ("token", Client(HTTP_AUTHORIZATION="Bearer %s" % token)),
+            )
+
+            for name, client in clients:
+                self.stdout.write(
+                    "%-8s %8.1f requests/s"
+                    % (name, self.measure(client, options["path"], options["requests"]))
+                )
+            transaction.set_rollback(True)
+
+    def measure(self, client, path, requests):
+        response = client.post(path)
+        if response.status_code != 200:
+            raise RuntimeError("%s answered %d" % (path, response.status_code))
+        started = time.process_time()
+        for _ in range(requests):
+            client.post(path)
+        return requests / (time.process_time() - started)
@@ -0,0 +1,54 @@
+import random
+import string
+import time
+
+from django.core.management.base import BaseCommand
+
+from images.autocomplete import PrefixIndex
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class Command(BaseCommand):
+    help = "Measure autocomplete latency on a synthetic in-memory index"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--creators", type=int, default=1000000)
+        parser.add_argument("--queries", type=int, default=20000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        alphabet = string.ascii_lowercase + string.digits + "_"
+
+        def rows():
+            for pk in range(1, options["creators"] + 1):
+                length = rng.randint(4, 14)
+                username = "".join(rng.choice(alphabet) for _ in range(length))
+                followers = int(rng.paretovariate(1.2))
+                yield pk, username, username.title(), None, followers
+
+        index = PrefixIndex()
+        started = time.perf_counter()
+        index.load(rows())
+        self.stdout.write(
+            "Built index of %d creators in %.2fs"
+            % (len(index.keys), time.perf_counter() - started)
+        )
+
+        # Queries are prefixes of existing names, as typed one key at a time
+        samples = []
+        for _ in range(options["queries"]):
+            username = index.keys[rng.randrange(len(index.keys))]
+            prefix = username[: rng.randint(1, min(6, len(username)))]
+            started = time.perf_counter()
+            index.search(prefix)
+            samples.append(time.perf_counter() - started)
+
+        samples.sort()
+        for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            latency = percentile(samples, fraction) * 1000
+            self.stdout.write("%s %.3f ms" % (name, latency))
+        self.stdout.write("max %.3f ms" % (samples[-1] * 1000))
@@ -0,0 +1,363 @@
+import json
+import os
+import random
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Q
+from django.test import Client, override_settings
+from django.test.utils import (
+    CaptureQueriesContext,
+    setup_test_environment,
+    teardown_test_environment,
+)
+from django.urls import URLPattern, get_resolver, resolve
+
+from images.authentication import issue_token
+from images.cache import LRUBackend, object_cache
+from images.management.commands.bench_sqlite_writers import copy_database
+from images.management.commands.seed_data import PASSWORD
+from images.models import Comment, Creator, CreatorFollower, Image, Like, Tag
+
+# name -> (method, path, data, expected status, query budget). Paths and data
+# are formatted with the context of ``get_context``; list values rotate between
+# requests. Budgets include the work of on_commit hooks and background tasks.
+ENDPOINTS = {
+    "users.explore": ("get", "/users/explore/", None, 200, 6),
+    "users.search": ("get", "/users/search/?username={username}", None, 200, 5),
+    "users.login": (
+        "post",
+        "/users/login/",
+        {"username": "{username}", "password": PASSWORD, "token": "1"},
+        200,
+        3,
+    ),
+    "users.token": ("post", "/users/token/", None, 200, 2),
+    "users.token.revoke": ("post", "/users/token/revoke/", None, 200, 7),
+    "users.autocomplete": ("get", "/users/autocomplete/?q={prefix}", None, 200, 3),
+    "users.following.status": (
+        "get",
+        "/users/following/status/?ids={creator_ids}",
+        None,
+        200,
+        3,
+    ),
+    "users.suggestions": ("get", "/users/suggestions/", None, 200, 7),
+    "users.detail": ("get", "/users/{username}/", None, 200, 6),
+    "users.follow": ("post", "/users/follow/{other_id}/", None, 200, 24),
+    "users.unfollow": ("post", "/users/unfollow/{other_id}/", None, 200, 16),
+    "users.followers": ("get", "/users/{username}/followers/", None, 200, 4),
+    "users.following": ("get", "/users/{username}/following/", None, 200, 4),
+    "comments.list": ("get", "/images/{image_id}/comments/", None, 200, 3),
+    "comments.create": (
+        "post",
+        "/images/{image_id}/comments/",
+        {"message": "benchmark"},
+        201,
+        15,
+    ),
+    "comments.delete": (
+        "delete",
+        "/images/{image_id}/comments/{comment_id}",
+        None,
+        204,
+        8,
+    ),
+    "comments.delete.short": (
+        "delete",
+        "/images/comments/{comment_id}",
+        None,
+        204,
+        8,
+    ),
+    "likes.create": ("post", "/images/{image_id}/likes/", None, 201, 18),
+    "likes.list": ("get", "/images/{image_id}/likes/", None, 200, 4),
+    "likes.delete": ("delete", "/images/{image_id}/unlikes/", None, 204, 10),
+    "images.feed": ("get", "/images/", None, 200, 12),
+    "images.search": ("get", "/images/search/?tags={tag}", None, 200, 8),
+    "images.explore": ("get", "/images/explore/", None, 200, 9),
+    "images.tag": ("get", "/images/tags/{tag}/", None, 200, 10),
+    "images.detail": ("get", "/images/{image_id}/", None, 200, 7),
+    "search.images": ("get", "/search/?q={tag}", None, 200, 9),
+    "search.users": ("get", "/search/?type=users&q={username}", None, 200, 6),
+    "cache.stats": ("get", "/cache/stats/", None, 200, 2),
+    "activity.list": ("get", "/activity/", None, 200, 5),
+    "activity.read": ("post", "/activity/read/", None, 200, 3),
+    "batch.likes": (
+        "post",
+        "/batch/likes/",
+        {"like": "{image_ids}", "unlike": ""},
+        200,
+        20,
+    ),
+    "batch.follows": (
+        "post",
+        "/batch/follows/",
+        {"follow": "{other_ids}", "unfollow": ""},
+        200,
+        113,
+    ),
+    "batch.users": ("get", "/batch/users/?ids={creator_ids}", None, 200, 5),
+    "batch.images": ("get", "/batch/images/?ids={image_ids}", None, 200, 8),
+    "metrics": ("get", "/metrics", None, 200, 2),
+}
+
+# Routes left out on purpose, with the reason
+SKIPPED = {
+    "users/register/": "uploads a profile picture",
+    "images/": "POST uploads a picture, GET is images.feed",
+    "^media/(?P<path>.*)$": "serves uploaded files in DEBUG only",
+}
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def format_value(value, context, index):
+    if isinstance(value, dict):
+        return {key: format_value(item, context, index) for key, item in value.items()}
+    current = {
+        key: item[index % len(item)] if isinstance(item, list) else item
+        for key, item in context.items()
+    }
+    return value.format(**current)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure latency and SQL queries of every API endpoint against seeded "
+        "data, failing on query budget overruns and latency regressions"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=20)
+        parser.add_argument("--baseline", default="bench_endpoints.json")
+        parser.add_argument(
+            "--save", action="store_true", help="Write the results as the baseline"
+        )
+        # Allowed slowdown of the median latency over the baseline, as a
+        # fraction and in milliseconds, which keeps fast endpoints from
+        # failing on noise
+        parser.add_argument("--threshold", type=float, default=0.5)
+        parser.add_argument("--min-slowdown", type=float, default=2.0)
+        parser.add_argument(
+            "endpoints", nargs="*", help="Only measure these endpoints"
+        )
+
+    def handle(self, *args, **options):
+        names = options["endpoints"] or list(ENDPOINTS)
+        unknown = set(names) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError("Unknown endpoints: %s" % ", ".join(sorted(unknown)))
+
+        if connection.vendor != "sqlite":
+            raise CommandError("Only SQLite databases can be benchmarked")
+        source = connection.settings_dict["NAME"]
+        connections.close_all()
+
+        # Lets the test client through ALLOWED_HOSTS
+        setup_test_environment()
+        shared_cache = object_cache.backend
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                results = self.run_on_copy(
+                    names, options["requests"], source, directory
+                )
+        finally:
+            object_cache.backend = shared_cache
+            teardown_test_environment()
+
+        baseline = {}
+        if os.path.exists(options["baseline"]):
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+        failures = self.report(
+            results, baseline, options["threshold"], options["min_slowdown"]
+        )
+        self.report_coverage()
+
+        if options["save"]:
+            with open(options["baseline"], "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write("Saved baseline to %s" % options["baseline"])
+        if failures:
+            raise CommandError(
+                "%d endpoints failed: %s" % (len(failures), ", ".join(failures))
+            )
+
+    def get_user(self):
+        """
+        The seeded creator following the most others, as a superuser.
+        """
+        user = Creator.objects.order_by("-following_count", "pk").first()
+        if user is None or not user.following_count:
+            raise CommandError("No follows to measure, run seed_data first")
+        user.is_superuser = True
+        user.set_password(PASSWORD)
+        user.save()
+        return user
+
+    def get_context(self, user, size, batch_size=20):
+        """
+        Values for ``size`` requests, each given an image and creator of its
+        own, and ``batch_size`` of them for the batch endpoints.
+        """
+        following = CreatorFollower.objects.filter(follower=user)
+        images = list(
+            Image.objects.filter(creator_id__in=following.values("creator"))
+            .exclude(like__person=user)
+            .order_by("-like_count", "-pk")
+            .values_list("pk", flat=True)[:size]
+        )
+        others = list(
+            Creator.objects.exclude(Q(pk=user.pk) | Q(creator__follower=user))
+            .order_by("-followers_count", "pk")
+            .values_list("pk", flat=True)[:size]
+        )
+        creators = list(following.values_list("creator_id", flat=True)[:batch_size])
+        tag = Tag.objects.order_by("-image_count").values_list("name", flat=True)
+        return {
+            "username": user.username,
+            "prefix": user.username[:3],
+            "image_id": images,
+            "image_ids": ",".join(map(str, images[:batch_size])),
+            "other_id": others,
+            "other_ids": ",".join(map(str, others[:batch_size])),
+            "creator_ids": ",".join(map(str, creators)),
+            "tag": tag.first() or "",
+        }
+
+    def prepare(self, name, user, context, index):
+        """
+        Create what one request consumes, returning extra client arguments.
+        """
+        image_id = context["image_id"][index % len(context["image_id"])]
+        if name == "users.token.revoke":
+            # Tokens issued within a second with one lifetime are the same
+            token, _expires = issue_token(user, 60 * 60 + index)
+            return {"HTTP_AUTHORIZATION": "Bearer %s" % token}
+        if name.startswith("comments.delete"):
+            comment = Comment.objects.create(
+                image_id_id=image_id, creator=user, message="benchmark"
+            )
+            context["comment_id"] = comment.pk
+        if name == "likes.delete":
+            Like.objects.create(image_id=image_id, person=user)
+        return {}
+
+    def run_on_copy(self, names, requests, source, directory):
+        """
+        Run against a copy of the database, committing what the endpoints
+        write, so the work they hand to on_commit hooks and background tasks
+        runs in the request and is measured too.
+        """
+        path = os.path.join(directory, "bench.sqlite3")
+        copy_database(source, path, "WAL")
+        # Objects of the copy stay out of the cache shared with the site
+        object_cache.backend = LRUBackend()
+        connection.settings_dict["NAME"] = path
+        try:
+            with override_settings(BACKGROUND_TASKS_EAGER=True):
+                return self.run(names, requests)
+        finally:
+            connections.close_all()
+            connection.settings_dict["NAME"] = source
+
+    def run(self, names, requests):
+        # Sharded counters pick random shards, creating those not used yet
+        random.seed(0)
+        user = self.get_user()
+        client = Client()
+        client.force_login(user)
+        self.routes = set()
+        results = {}
+        for name in names:
+            method, path, data, expected, budget = ENDPOINTS[name]
+            context = self.get_context(user, requests + 1)
+            if not context["image_id"] or not context["other_id"]:
+                raise CommandError("Not enough seeded data, run seed_data first")
+            durations, queries, statuses = [], [], set()
+            for index in range(requests + 1):
+                extra = self.prepare(name, user, context, index)
+                url = format_value(path, context, index)
+                payload = format_value(data, context, index) if data else None
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    response = getattr(client, method)(url, payload, **extra)
+                    elapsed = time.perf_counter() - started
+                statuses.add(response.status_code)
+                queries.append(len(captured))
+                # The first request fills the caches
+                if index:
+                    durations.append(elapsed)
+            self.routes.add(resolve(url.split("?")[0]).route)
+            durations.sort()
+            results[name] = {
+                "p50": percentile(durations, 0.5) * 1000,
+                "p90": percentile(durations, 0.9) * 1000,
+                "p99": percentile(durations, 0.99) * 1000,
+                "queries": max(queries),
+                "budget": budget,
+                "expected": expected,
+                "statuses": sorted(statuses),
+            }
+        return results
+
+    def report(self, results, baseline, threshold, min_slowdown):
+        """
+        Print every endpoint, returning the names of those that failed.
+        """
+        failures = []
+        self.stdout.write(
+            "%-24s %9s %9s %9s %7s %7s  %s"
+            % ("endpoint", "p50 ms", "p90 ms", "p99 ms", "queries", "budget", "status")
+        )
+        for name, result in results.items():
+            problems = []
+            if result["queries"] > result["budget"]:
+                problems.append("over query budget")
+            if result["statuses"] != [result["expected"]]:
+                problems.append("expected status %d" % result["expected"])
+            previous = baseline.get(name)
+            if previous is not None:
+                if (
+                    result["p50"] > previous["p50"] * (1 + threshold)
+                    and result["p50"] - previous["p50"] > min_slowdown
+                ):
+                    slower = result["p50"] / previous["p50"] - 1
+                    problems.append("%.0f%% slower" % (slower * 100))
+                if result["queries"] > previous["queries"]:
+                    more = result["queries"] - previous["queries"]
+                    problems.append("%d more queries" % more)
+            if problems:
+                failures.append(name)
+            self.stdout.write(
+                "%-24s %9.2f %9.2f %9.2f %7d %7d  %s%s"
+                % (
+                    name,
+                    result["p50"],
+                    result["p90"],
+                    result["p99"],
+                    result["queries"],
+                    result["budget"],
+                    ",".join(map(str, result["statuses"])),
+                    "  FAIL: " + "; ".join(problems) if problems else "",
+                )
+            )
+        return failures
+
+    def report_coverage(self):
+        """
+        Warn about routes of the URLconf that no measured endpoint requests.
+        """
+        routes = [
+            str(pattern.pattern)
+            for pattern in get_resolver().url_patterns
+            if isinstance(pattern, URLPattern)
+        ]
+        for route in routes:
+            if route not in self.routes and route not in SKIPPED:
+                self.stdout.write("Not measured: %s" % route)
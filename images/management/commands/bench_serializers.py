@@ -0,0 +1,98 @@
+import time
+from functools import partial
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework import serializers
+
+from images.models import Creator, Image
+from images.serializers import (
+    CreatorRowSerializer,
+    CreatorSerializer,
+    ImageRowSerializer,
+    ImageSerializer,
+)
+
+
+class OriginalCreatorSerializer(serializers.ModelSerializer):
+    """
+    ``CreatorSerializer`` as it was before the public profile was trimmed, the
+    baseline the other creator serializers are measured against.
+    """
+
+    password = serializers.CharField(write_only=True, required=True)
+
+    class Meta:
+        model = Creator
+        fields = "__all__"
+
+
+# name -> (model, model serializers, row serializer)
+SERIALIZERS = {
+    "creators": (
+        Creator,
+        (OriginalCreatorSerializer, CreatorSerializer),
+        CreatorRowSerializer,
+    ),
+    "images": (Image, (ImageSerializer,), ImageRowSerializer),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the throughput of the model serializers with the values()-based "
+        "row serializers on pages of seeded data"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--page-size", type=int, default=50)
+        parser.add_argument("--pages", type=int, default=20)
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            "%-10s %-26s %12s %14s" % ("kind", "serializer", "rows/s", "queries/page")
+        )
+        for name, (model, model_serializers, row_serializer) in SERIALIZERS.items():
+            pks = list(
+                model.objects.order_by("-pk").values_list("pk", flat=True)[
+                    : options["page_size"] * options["pages"]
+                ]
+            )
+            if not pks:
+                raise CommandError("No %s to serialize, run seed_data first" % name)
+            pages = [
+                pks[start : start + options["page_size"]]
+                for start in range(0, len(pks), options["page_size"])
+            ]
+
+            def full(model_serializer, page):
+                objects = model.objects.filter(pk__in=page)
+                return model_serializer(objects, many=True).data
+
+            def rows(page):
+                return row_serializer().load(page)
+
+            measured = [
+                (serializer.__name__, partial(full, serializer))
+                for serializer in model_serializers
+            ]
+            measured.append((row_serializer.__name__, rows))
+            for label, serialize in measured:
+                rate, queries = self.measure(serialize, pages)
+                self.stdout.write(
+                    "%-10s %-26s %12.0f %14.1f" % (name, label, rate, queries)
+                )
+
+    def measure(self, serialize, pages):
+        """
+        Return the rows serialized per second and the queries per page.
+        """
+        count, elapsed = 0, 0.0
+        with CaptureQueriesContext(connection) as captured:
+            for page in pages:
+                started = time.perf_counter()
+                serialize(page)
+                elapsed += time.perf_counter() - started
+                count += len(page)
+        return count / elapsed, len(captured) / len(pages)
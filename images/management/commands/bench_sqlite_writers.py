@@ -0,0 +1,150 @@
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, OperationalError, connection, connections
+
+from images.backends.sqlite3.base import is_locked
+from images.models import Creator, Image, Like
+
+# mode -> (engine, options, write queue)
+MODES = {
+    "stock": ("django.db.backends.sqlite3", {"timeout": 5}, False),
+    "tuned": ("images.backends.sqlite3", {"timeout": 5}, False),
+    "queued": ("images.backends.sqlite3", {"timeout": 5}, True),
+}
+
+
+def copy_database(source, target, journal_mode):
+    with sqlite3.connect(source) as original, sqlite3.connect(target) as copy:
+        original.backup(copy)
+        copy.execute("PRAGMA journal_mode = %s" % journal_mode)
+    copy.close()
+    original.close()
+
+
+def toggle_likes(user_id, image_ids, deadline, counts, lock):
+    """
+    Like or unlike random images as one user until ``deadline``.
+    """
+    rng = random.Random(user_id)
+    local = Counter()
+    try:
+        while time.time() < deadline:
+            image_id = rng.choice(image_ids)
+            try:
+                like = Like.objects.filter(image_id=image_id, person_id=user_id).first()
+                if like is None:
+                    Like(image_id=image_id, person_id=user_id).save()
+                else:
+                    like.delete()
+                local["writes"] += 1
+            except OperationalError as error:
+                local["locked" if is_locked(error) else "failed"] += 1
+            except IntegrityError:
+                local["failed"] += 1
+    finally:
+        connection.close()
+        with lock:
+            counts.update(local)
+
+
+def work(mode, path, user_ids, image_ids, start, deadline):
+    """
+    Run one thread per user in a forked process, returning the counts.
+    """
+    engine, options, queued = MODES[mode]
+    database = connections.databases["default"]
+    database.update(ENGINE=engine, NAME=path, OPTIONS=options, CONN_MAX_AGE=0)
+    settings.SQLITE_WRITE_QUEUE = queued
+
+    counts, lock = Counter(), threading.Lock()
+    time.sleep(max(0, start - time.time()))
+    threads = [
+        threading.Thread(
+            target=toggle_likes, args=(user_id, image_ids, deadline, counts, lock)
+        )
+        for user_id in user_ids
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure like and unlike transactions per second of concurrent writer "
+        "processes with stock SQLite settings, images.backends.sqlite3 and the "
+        "write queue, each on a copy of the database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=4)
+        parser.add_argument("--threads", type=int, default=4)
+        parser.add_argument("--seconds", type=float, default=5)
+        parser.add_argument("--images", type=int, default=200)
+        parser.add_argument(
+            "modes", nargs="*", help="Only measure these of %s" % ", ".join(MODES)
+        )
+
+    def handle(self, *args, **options):
+        modes = options["modes"] or list(MODES)
+        unknown = set(modes) - set(MODES)
+        if unknown:
+            raise CommandError("Unknown modes: %s" % ", ".join(sorted(unknown)))
+        writers = options["processes"] * options["threads"]
+        user_ids = list(
+            Creator.objects.order_by("pk").values_list("pk", flat=True)[:writers]
+        )
+        image_ids = list(
+            Image.objects.order_by("-pk").values_list("pk", flat=True)[
+                : options["images"]
+            ]
+        )
+        if len(user_ids) < writers or not image_ids:
+            raise CommandError("Not enough seeded data, run seed_data first")
+        source = connection.settings_dict["NAME"]
+        connections.close_all()
+
+        self.stdout.write(
+            "%-8s %10s %10s %8s %8s"
+            % ("mode", "writes", "writes/s", "locked", "failed")
+        )
+        for mode in modes:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "bench.sqlite3")
+                copy_database(source, path, "DELETE" if mode == "stock" else "WAL")
+                counts = self.run(mode, path, user_ids, image_ids, options)
+            self.stdout.write(
+                "%-8s %10d %10.1f %8d %8d"
+                % (
+                    mode,
+                    counts["writes"],
+                    counts["writes"] / options["seconds"],
+                    counts["locked"],
+                    counts["failed"],
+                )
+            )
+
+    def run(self, mode, path, user_ids, image_ids, options):
+        # Every process starts writing at the same time, once all are forked
+        start = time.time() + 1
+        deadline = start + options["seconds"]
+        threads = options["threads"]
+        jobs = [
+            (mode, path, user_ids[index : index + threads], image_ids, start, deadline)
+            for index in range(0, len(user_ids), threads)
+        ]
+        context = multiprocessing.get_context("fork")
+        with context.Pool(options["processes"]) as pool:
+            results = pool.starmap(work, jobs)
+        return sum(results, Counter())
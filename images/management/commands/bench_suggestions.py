@@ -0,0 +1,73 @@
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from images import graph
+from images.suggestions import chunks
+
+
+class Command(BaseCommand):
+    help = "Measure follow suggestions on a synthetic power-law follow graph"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100000)
+        parser.add_argument("--edges", type=int, default=1000000)
+        parser.add_argument("--sample", type=int, default=20000)
+        parser.add_argument("--workers", type=int, default=os.cpu_count())
+        parser.add_argument("--max-degree", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        users = options["users"]
+        mean_degree = options["edges"] / users
+
+        def edges():
+            # Out-degrees are power-law distributed, popular accounts have low ids
+            for source in range(users):
+                degree = min(users - 1, int(rng.paretovariate(2) * mean_degree / 2))
+                followed = {int(users * rng.random() ** 3) for _ in range(degree)}
+                followed.discard(source)
+                for target in sorted(followed):
+                    yield source, target
+
+        started = time.perf_counter()
+        offsets, targets = graph.build(edges(), users)
+        self.stdout.write(
+            "Built graph of %d users and %d edges (%.1f MB) in %.2fs"
+            % (
+                users,
+                len(targets),
+                (offsets.itemsize * len(offsets) + targets.itemsize * len(targets))
+                / 2 ** 20,
+                time.perf_counter() - started,
+            )
+        )
+
+        sample = rng.sample(range(users), min(options["sample"], users))
+        graph.init_worker(offsets, targets)
+        started = time.perf_counter()
+        graph.suggest_many(sample[:1000], 20, options["max_degree"])
+        single = 1000 / (time.perf_counter() - started)
+        self.stdout.write("1 process: %.0f users/s" % single)
+
+        started = time.perf_counter()
+        with ProcessPoolExecutor(
+            options["workers"],
+            initializer=graph.init_worker,
+            initargs=(offsets, targets),
+        ) as pool:
+            jobs = [
+                pool.submit(graph.suggest_many, chunk, 20, options["max_degree"])
+                for chunk in chunks(sample, 500)
+            ]
+            for job in jobs:
+                job.result()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            "%d processes: %d users in %.2fs, %.0f users/s"
+            % (options["workers"], len(sample), elapsed, len(sample) / elapsed)
+        )
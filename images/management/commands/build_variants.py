@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from images import derivatives
+from images.models import Creator, Image
+
+PICTURES = (
+    (Image, "file", "variants"),
+    (Creator, "profile_image", "profile_image_variants"),
+)
+
+
+def process(model, pk, field_name, variants_field, force):
+    try:
+        derivatives.process(model, pk, field_name, variants_field, force)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Generate the resized variants of existing images and profile pictures"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Regenerate variants that are already up to date",
+        )
+
+    def handle(self, *args, **options):
+        force = options["force"]
+        # Each thread feeds one worker of the process pool
+        with ThreadPoolExecutor(settings.IMAGE_VARIANT_WORKERS) as threads:
+            for model, field_name, variants_field in PICTURES:
+                pictures = model.objects.exclude(**{field_name: ""}).values_list(
+                    "pk", field_name, variants_field
+                )
+                futures = [
+                    threads.submit(
+                        process, model, pk, field_name, variants_field, force
+                    )
+                    for pk, source, variants in pictures.iterator()
+                    if force or not derivatives.load(source, variants)
+                ]
+                for future in futures:
+                    future.result()
+                self.stdout.write(
+                    "Processed %d %s pictures"
+                    % (len(futures), model._meta.verbose_name)
+                )
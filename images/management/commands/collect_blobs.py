@@ -0,0 +1,61 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import F
+from django.utils import timezone
+
+from images.models import Blob, Image
+from images.storage import content_storage
+
+
+def count_references():
+    references = Counter()
+    for image in Image.objects.only("file", "variants").iterator():
+        references.update(image.get_file_names())
+    return references
+
+
+class Command(BaseCommand):
+    help = "Delete stored blobs that no image references anymore"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--grace",
+            type=int,
+            default=60,
+            help="Keep blobs created less than this many minutes ago",
+        )
+        parser.add_argument(
+            "--recount",
+            action="store_true",
+            help="Reset reference counts from the images table first; "
+            "only safe while no uploads are running",
+        )
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        references = count_references()
+
+        if options["recount"]:
+            for name, refcount in Blob.objects.values_list("name", "refcount"):
+                if references[name] != refcount:
+                    Blob.objects.filter(name=name).update(
+                        refcount=F("refcount") - refcount + references[name]
+                    )
+
+        cutoff = timezone.now() - timedelta(minutes=options["grace"])
+        garbage = Blob.objects.filter(refcount__lte=0, created__lt=cutoff)
+        removed = freed = 0
+        for blob in garbage.iterator():
+            if references[blob.name]:
+                continue
+            if not options["dry_run"]:
+                # Skip blobs that were referenced again since the scan
+                if not Blob.objects.filter(pk=blob.pk, refcount__lte=0).delete()[0]:
+                    continue
+                content_storage.delete(blob.name)
+            removed += 1
+            freed += blob.size
+
+        self.stdout.write("Removed %d blobs, %d bytes" % (removed, freed))
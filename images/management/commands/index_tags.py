@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+
+from images.counters import count_of
+from images.models import Image, ImageTag, Tag, parse_tags
+from images.transactions import write_atomic
+
+
+class Command(BaseCommand):
+    help = "Parse the tags text of existing images into the tag index"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        last_id = 0
+        indexed = 0
+        while True:
+            batch = list(
+                Image.objects.filter(pk__gt=last_id)
+                .order_by("pk")
+                .values_list("pk", "tags", "created")[: options["batch_size"]]
+            )
+            if not batch:
+                break
+            last_id = batch[-1][0]
+
+            with write_atomic():
+                wanted = {pk: set(parse_tags(tags)) for pk, tags, _created in batch}
+                tag_ids = Tag.get_ids(set().union(*wanted.values()))
+                current = set(
+                    ImageTag.objects.filter(image_id__in=wanted).values_list(
+                        "image_id", "tag_id"
+                    )
+                )
+                links = {
+                    (pk, tag_ids[name]): created
+                    for pk, _tags, created in batch
+                    for name in wanted[pk]
+                }
+
+                ImageTag.objects.bulk_create(
+                    [
+                        ImageTag(image_id=pk, tag_id=tag_id, created=created)
+                        for (pk, tag_id), created in links.items()
+                        if (pk, tag_id) not in current
+                    ],
+                    ignore_conflicts=True,
+                )
+                for pk, tag_id in current - set(links):
+                    ImageTag.objects.filter(image_id=pk, tag_id=tag_id).delete()
+            indexed += len(batch)
+
+        Tag.objects.update(image_count=count_of(ImageTag.objects.all(), "tag"))
+        self.stdout.write("Indexed tags of %d images" % indexed)
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from images import search
+from images.transactions import write_atomic
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index from scratch"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        backend = search.get_backend()
+        backend.install()
+        for kind, (model, fields) in search.DOCUMENTS.items():
+            indexed = last_id = 0
+            # One transaction per batch of pks, so the write lock is released
+            # between batches and searches keep finding the rest of the index
+            while True:
+                with write_atomic():
+                    batch = list(
+                        model.objects.filter(pk__gt=last_id)
+                        .order_by("pk")
+                        .only("pk", *fields)[: options["batch_size"]]
+                    )
+                    if not batch:
+                        backend.clear(kind, after=last_id)
+                        break
+                    backend.clear(kind, after=last_id, upto=batch[-1].pk)
+                    backend.index(kind, batch)
+                last_id = batch[-1].pk
+                indexed += len(batch)
+            self.stdout.write("Indexed %d %s" % (indexed, kind))
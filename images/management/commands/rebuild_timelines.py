@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from images.feed import rebuild_timelines
+from images.models import Creator, TimelineEntry
+
+
+class Command(BaseCommand):
+    help = "Rebuild or backfill home feed inboxes from the follow graph"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "usernames", nargs="*", help="Only rebuild the inboxes of these users"
+        )
+        parser.add_argument(
+            "--clear",
+            action="store_true",
+            help="Delete existing inbox entries before backfilling",
+        )
+
+    def handle(self, *args, **options):
+        owner_ids = None
+        if options["usernames"]:
+            owner_ids = list(
+                Creator.objects.filter(username__in=options["usernames"]).values_list(
+                    "pk", flat=True
+                )
+            )
+
+        if options["clear"]:
+            entries = TimelineEntry.objects.all()
+            if owner_ids is not None:
+                entries = entries.filter(owner__in=owner_ids)
+            entries.delete()
+
+        creators = rebuild_timelines(owner_ids)
+        self.stdout.write("Backfilled images of %d creators" % creators)
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+
+from images.cache import kind_of, object_cache
+from images.counters import count_of, versioned
+from images.models import (
+    Comment,
+    CounterShard,
+    Creator,
+    CreatorFollower,
+    Image,
+    ImageTag,
+    Like,
+    Tag,
+)
+from images.transactions import write_atomic
+
+# Cache versions bumped per call, keeping the pks of a batch in memory
+BATCH_SIZE = 1000
+
+
+def invalidate_all(model):
+    pks = []
+    for pk in model.objects.values_list("pk", flat=True).iterator():
+        pks.append(pk)
+        if len(pks) == BATCH_SIZE:
+            object_cache.invalidate(kind_of(model), *pks)
+            pks = []
+    if pks:
+        object_cache.invalidate(kind_of(model), *pks)
+
+
+class Command(BaseCommand):
+    help = "Recompute every denormalized counter from the source tables"
+
+    def handle(self, *args, **options):
+        with write_atomic():
+            images = Image.objects.update(
+                like_count=count_of(Like.objects.all(), "image"),
+                comment_count=count_of(Comment.objects.all(), "image_id"),
+                **versioned(Image)
+            )
+            creators = Creator.objects.update(
+                post_count=count_of(Image.objects.all(), "creator_id"),
+                followers_count=count_of(CreatorFollower.objects.all(), "creator"),
+                following_count=count_of(CreatorFollower.objects.all(), "follower"),
+                **versioned(Creator)
+            )
+            Tag.objects.update(image_count=count_of(ImageTag.objects.all(), "tag"))
+            CounterShard.objects.all().delete()
+            # Cached representations carry the counts
+            invalidate_all(Image)
+            invalidate_all(Creator)
+
+        self.stdout.write(
+            "Reconciled counters of %d images and %d creators" % (images, creators)
+        )
@@ -0,0 +1,202 @@
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from images.models import Comment, Creator, CreatorFollower, Image, Like
+from images.transactions import write_atomic
+
+WORDS = (
+    "sunset", "beach", "city", "food", "coffee", "travel", "mountains", "dog",
+    "cat", "friends", "art", "music", "night", "summer", "winter", "street",
+    "flowers", "books", "sea", "family",
+)
+PASSWORD = "seed-password"
+
+
+def draw(rng, mean):
+    """
+    A random count with the given mean, most often below it.
+    """
+    return int(rng.expovariate(1 / mean)) if mean > 0 else 0
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the database with synthetic creators, follows, images, likes and "
+        "comments, then rebuild the derived tables"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--creators", type=int, default=1000)
+        parser.add_argument("--mean-followers", type=float, default=50)
+        # Pareto shape of follower counts, the lower the more skewed
+        parser.add_argument("--followers-alpha", type=float, default=1.5)
+        parser.add_argument(
+            "--images", type=float, default=5, help="Mean images per creator"
+        )
+        parser.add_argument(
+            "--likes", type=float, default=10, help="Mean likes per image"
+        )
+        parser.add_argument(
+            "--comments", type=float, default=2, help="Mean comments per image"
+        )
+        parser.add_argument("--prefix", default="seed")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--no-derived",
+            action="store_true",
+            help="Leave counters, timelines and indexes to be rebuilt later",
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        started = time.perf_counter()
+
+        with write_atomic():
+            creator_ids = self.create_creators(options)
+            followers = self.create_follows(rng, creator_ids, options)
+            images = self.create_images(rng, creator_ids, options)
+            self.create_reactions(rng, creator_ids, followers, images, options)
+
+        self.stdout.write(
+            "Seeded %d creators and %d images in %.1fs"
+            % (len(creator_ids), len(images), time.perf_counter() - started)
+        )
+        if not options["no_derived"]:
+            for command, args in (
+                ("reconcile_counters", ()),
+                ("index_tags", ()),
+                ("rebuild_search_index", ()),
+                ("rebuild_timelines", ()),
+                ("update_explore", ("--rebuild",)),
+                ("update_suggestions", ("--all",)),
+            ):
+                call_command(command, *args, stdout=self.stdout)
+
+    def bulk_create(self, model, objects):
+        """
+        Insert an iterable of unsaved objects in batches, returning their number.
+        """
+        batch, count = [], 0
+        for obj in objects:
+            batch.append(obj)
+            if len(batch) >= self.batch_size:
+                model.objects.bulk_create(batch, ignore_conflicts=True)
+                count += len(batch)
+                batch = []
+        model.objects.bulk_create(batch, ignore_conflicts=True)
+        return count + len(batch)
+
+    def create_creators(self, options):
+        # Hashing is slow on purpose, every seeded creator shares one hash
+        password = make_password(PASSWORD)
+        usernames = [
+            "%s_%d" % (options["prefix"], index) for index in range(options["creators"])
+        ]
+        self.bulk_create(
+            Creator,
+            (
+                Creator(
+                    username=username,
+                    password=password,
+                    name=username.replace("_", " ").title(),
+                    bio="",
+                    website="",
+                )
+                for username in usernames
+            ),
+        )
+        pks = dict(
+            Creator.objects.filter(username__in=usernames).values_list("username", "pk")
+        )
+        return [pks[username] for username in usernames]
+
+    def create_follows(self, rng, creator_ids, options):
+        """
+        Give every creator a power-law number of random followers.
+
+        Returns the follower ids of every creator.
+        """
+        alpha = options["followers_alpha"]
+        # Pareto draws average alpha / (alpha - 1)
+        scale = options["mean_followers"] * max(alpha - 1, 0.01) / alpha
+        followers = {}
+        for creator_id in creator_ids:
+            count = min(
+                len(creator_ids) - 1, int(rng.paretovariate(alpha) * scale)
+            )
+            sample = rng.sample(creator_ids, count + 1)
+            followers[creator_id] = [pk for pk in sample if pk != creator_id][:count]
+
+        count = self.bulk_create(
+            CreatorFollower,
+            (
+                CreatorFollower(creator_id=creator_id, follower_id=follower_id)
+                for creator_id, follower_ids in followers.items()
+                for follower_id in follower_ids
+            ),
+        )
+        self.stdout.write("Created %d follows" % count)
+        return followers
+
+    def create_images(self, rng, creator_ids, options):
+        """
+        Returns ``(image id, creator id)`` of the created images.
+        """
+        last_id = Image.objects.aggregate(Max("pk"))["pk__max"] or 0
+
+        def images():
+            for creator_id in creator_ids:
+                for _ in range(draw(rng, options["images"])):
+                    yield Image(
+                        file="user_images/%s.jpg" % options["prefix"],
+                        caption=" ".join(rng.sample(WORDS, 3)),
+                        tags=" ".join(rng.sample(WORDS, 2)),
+                        creator_id_id=creator_id,
+                    )
+
+        self.bulk_create(Image, images())
+        return list(
+            Image.objects.filter(pk__gt=last_id)
+            .order_by("pk")
+            .values_list("pk", "creator_id")
+        )
+
+    def create_reactions(self, rng, creator_ids, followers, images, options):
+        """
+        Like and comment images, mostly by followers of their creators.
+        """
+
+        def pick(creator_id, count):
+            audience = followers[creator_id]
+            if len(audience) < count:
+                audience = creator_ids
+            return rng.sample(audience, min(count, len(audience)))
+
+        likes = self.bulk_create(
+            Like,
+            (
+                Like(image_id=image_id, person_id=person_id)
+                for image_id, creator_id in images
+                for person_id in pick(creator_id, draw(rng, options["likes"]))
+            ),
+        )
+        comments = self.bulk_create(
+            Comment,
+            (
+                Comment(
+                    image_id_id=image_id,
+                    creator_id=person_id,
+                    message=" ".join(rng.sample(WORDS, 4)),
+                )
+                for image_id, creator_id in images
+                for person_id in pick(creator_id, draw(rng, options["comments"]))
+            ),
+        )
+        self.stdout.write("Created %d likes and %d comments" % (likes, comments))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from images import explore
+
+
+class Command(BaseCommand):
+    help = "Add the likes, follows and posts made since the last run to Explore"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Recompute every score, e.g. after changing EXPLORE_HALF_LIFE",
+        )
+
+    def handle(self, *args, **options):
+        if options["rebuild"]:
+            counts = explore.rebuild(options["batch_size"])
+        else:
+            counts = explore.update(options["batch_size"])
+        self.stdout.write(
+            "Scored %s"
+            % ", ".join("%d %s" % (count, source) for source, count in counts.items())
+        )
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from images import suggestions
+
+
+class Command(BaseCommand):
+    help = "Recompute follow suggestions of users whose neighborhood changed"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all", action="store_true", help="Recompute the suggestions of every user"
+        )
+        parser.add_argument("--workers", type=int, default=None)
+
+    def handle(self, *args, **options):
+        refreshed = suggestions.refresh(full=options["all"], workers=options["workers"])
+        self.stdout.write("Refreshed suggestions of %d users" % refreshed)
@@ -0,0 +1,394 @@
+"""
+Per-route request metrics in the Prometheus text format.
+
+``MetricsMiddleware`` times every request and counts its SQL queries with a
+database execution wrapper, then adds them to the process ``registry`` under
+the URL pattern that matched. Building the response data in serializers, see
+``timed``, and rendering the response body, where DRF encodes it to JSON, are
+timed on their own.
+
+A sample of ``METRICS_SLOW_SAMPLE_RATE`` of the requests also records each
+SQL statement; those slower than ``METRICS_SLOW_REQUEST`` seconds are logged
+with their most repeated statements, which is how N+1 queries show up.
+
+With ``METRICS_DIR`` set, every process writes its totals to a file there at
+most every ``METRICS_FLUSH_INTERVAL`` seconds and ``/metrics`` adds up the
+files of all processes. Files of exited processes are kept so the counters
+never go down.
+
+``/metrics`` is served to staff sessions and to scrapers sending
+``Authorization: Bearer <METRICS_TOKEN>``; behind a proxy every request
+comes from a local address, so the client address proves nothing.
+"""
+import atexit
+import hmac
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class QueryCollector:
+    """
+    Database execution wrapper counting the queries of one request.
+    """
+
+    __slots__ = (
+        "count",
+        "seconds",
+        "statements",
+        "serialize_seconds",
+        "serializing",
+        "render_seconds",
+    )
+
+    def __init__(self, sampled=False):
+        self.count = 0
+        self.seconds = 0.0
+        # SQL -> executions, only for sampled requests
+        self.statements = Counter() if sampled else None
+        self.serialize_seconds = 0.0
+        self.serializing = False
+        self.render_seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+            if self.statements is not None:
+                self.statements[sql] += 1
+
+
+@contextmanager
+def timed(request):
+    """
+    Add the time spent in the block to the serialization time of ``request``.
+
+    Nested blocks, like the serializers of related objects, are counted once.
+    """
+    collector = getattr(request, "metrics_collector", None)
+    if collector is None or collector.serializing:
+        yield
+        return
+    collector.serializing = True
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        collector.serialize_seconds += time.perf_counter() - started
+        collector.serializing = False
+
+
+def new_entry():
+    return {
+        "requests": 0,
+        "statuses": {},
+        "duration": [0] * (len(DURATION_BUCKETS) + 1),
+        "duration_sum": 0.0,
+        "queries": [0] * (len(QUERY_BUCKETS) + 1),
+        "queries_sum": 0,
+        "db_seconds": 0.0,
+        "serialize_seconds": 0.0,
+        "render_seconds": 0.0,
+        "response_bytes": 0,
+    }
+
+
+def bucket(buckets, value):
+    for index, bound in enumerate(buckets):
+        if value <= bound:
+            return index
+    return len(buckets)
+
+
+def merge(snapshots):
+    """
+    Add up ``{route: {method: entry}}`` snapshots of several processes.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for route, methods in snapshot.items():
+            for method, entry in methods.items():
+                total = merged.setdefault(route, {}).setdefault(method, new_entry())
+                for name, value in entry.items():
+                    if name == "statuses":
+                        for status, count in value.items():
+                            total[name][status] = total[name].get(status, 0) + count
+                    elif isinstance(value, list):
+                        total[name] = [a + b for a, b in zip(total[name], value)]
+                    else:
+                        total[name] += value
+    return merged
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        # route -> method -> entry
+        self.entries = {}
+        self.flushed = time.monotonic()
+
+    def observe(self, route, method, status, duration, collector, size):
+        with self.lock:
+            entry = self.entries.setdefault(route, {}).get(method)
+            if entry is None:
+                entry = self.entries[route][method] = new_entry()
+            entry["requests"] += 1
+            status = str(status)
+            entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+            entry["duration"][bucket(DURATION_BUCKETS, duration)] += 1
+            entry["duration_sum"] += duration
+            entry["queries"][bucket(QUERY_BUCKETS, collector.count)] += 1
+            entry["queries_sum"] += collector.count
+            entry["db_seconds"] += collector.seconds
+            entry["serialize_seconds"] += collector.serialize_seconds
+            entry["render_seconds"] += collector.render_seconds
+            entry["response_bytes"] += size
+
+    def snapshot(self):
+        with self.lock:
+            return merge([self.entries])
+
+    def get_path(self):
+        return os.path.join(settings.METRICS_DIR, "metrics-%d.json" % os.getpid())
+
+    def flush(self):
+        if not settings.METRICS_DIR:
+            return
+        with self.flush_lock:
+            self.flushed = time.monotonic()
+            path = self.get_path()
+            # Readers never see a partly written file
+            fd, tmp_path = tempfile.mkstemp(
+                suffix=".tmp", prefix=os.path.basename(path), dir=settings.METRICS_DIR
+            )
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(self.snapshot(), f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+    def maybe_flush(self):
+        if (
+            settings.METRICS_DIR
+            and time.monotonic() - self.flushed > settings.METRICS_FLUSH_INTERVAL
+            and not self.flush_lock.locked()
+        ):
+            self.flush()
+
+    def collect(self):
+        """
+        Totals of every process sharing ``METRICS_DIR``, or of this one.
+        """
+        snapshots = [self.snapshot()]
+        if settings.METRICS_DIR:
+            own = os.path.basename(self.get_path())
+            for name in os.listdir(settings.METRICS_DIR):
+                if name == own or not name.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(settings.METRICS_DIR, name)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return merge(snapshots)
+
+
+registry = Registry()
+atexit.register(registry.flush)
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labels(**values):
+    return ",".join(
+        '%s="%s"' % (name, escape(str(value))) for name, value in values.items()
+    )
+
+
+def histogram(lines, name, buckets, counts, total, **label_values):
+    base = labels(**label_values)
+    cumulative = 0
+    for bound, count in zip(buckets + ("+Inf",), counts):
+        cumulative += count
+        lines.append('%s_bucket{%s,le="%s"} %d' % (name, base, bound, cumulative))
+    lines.append("%s_sum{%s} %s" % (name, base, total))
+    lines.append("%s_count{%s} %d" % (name, base, cumulative))
+
+
+def export(entries):
+    """
+    Render merged entries in the Prometheus text exposition format.
+    """
+    help_lines = (
+        ("http_requests_total", "counter", "Requests by route, method and status"),
+        (
+            "http_request_duration_seconds",
+            "histogram",
+            "Time spent in the middleware chain and view",
+        ),
+        ("http_request_db_queries", "histogram", "SQL queries per request"),
+        ("http_request_db_seconds_total", "counter", "Time spent running SQL"),
+        (
+            "http_request_serialize_seconds_total",
+            "counter",
+            "Time spent building response data",
+        ),
+        (
+            "http_request_render_seconds_total",
+            "counter",
+            "Time spent rendering response bodies",
+        ),
+        ("http_response_bytes_total", "counter", "Size of response bodies"),
+    )
+    sections = {name: [] for name, _type, _help in help_lines}
+    for route in sorted(entries):
+        for method, entry in sorted(entries[route].items()):
+            base = dict(route=route, method=method)
+            for status, count in sorted(entry["statuses"].items()):
+                line = "http_requests_total{%s} %d" % (
+                    labels(**base, status=status),
+                    count,
+                )
+                sections["http_requests_total"].append(line)
+            histogram(
+                sections["http_request_duration_seconds"],
+                "http_request_duration_seconds",
+                DURATION_BUCKETS,
+                entry["duration"],
+                entry["duration_sum"],
+                **base
+            )
+            histogram(
+                sections["http_request_db_queries"],
+                "http_request_db_queries",
+                QUERY_BUCKETS,
+                entry["queries"],
+                entry["queries_sum"],
+                **base
+            )
+            for name, field in (
+                ("http_request_db_seconds_total", "db_seconds"),
+                ("http_request_serialize_seconds_total", "serialize_seconds"),
+                ("http_request_render_seconds_total", "render_seconds"),
+                ("http_response_bytes_total", "response_bytes"),
+            ):
+                line = "%s{%s} %s" % (name, labels(**base), entry[field])
+                sections[name].append(line)
+
+    lines = []
+    for name, kind, description in help_lines:
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        lines.extend(sections[name])
+    return "\n".join(lines) + "\n"
+
+
+def get_route(request):
+    match = getattr(request, "resolver_match", None)
+    return match.route if match is not None else "<unmatched>"
+
+
+def get_size(response):
+    if response.streaming:
+        return int(response.get("Content-Length", 0))
+    return len(response.content)
+
+
+def log_slow(request, duration, collector):
+    repeated = [
+        "%dx %s" % (count, sql[:200])
+        for sql, count in collector.statements.most_common(
+            settings.METRICS_SLOW_TOP_QUERIES
+        )
+        if count > 1
+    ]
+    logger.warning(
+        "Slow request %s %s (%s): %.0f ms, %d queries in %.0f ms%s",
+        request.method,
+        request.path,
+        get_route(request),
+        duration * 1000,
+        collector.count,
+        collector.seconds * 1000,
+        "".join("\n  " + line for line in repeated),
+    )
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sampled = random.random() < settings.METRICS_SLOW_SAMPLE_RATE
+        collector = request.metrics_collector = QueryCollector(sampled)
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(collector))
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        registry.observe(
+            get_route(request),
+            request.method,
+            response.status_code,
+            duration,
+            collector,
+            get_size(response),
+        )
+        if sampled and duration >= settings.METRICS_SLOW_REQUEST:
+            log_slow(request, duration, collector)
+        registry.maybe_flush()
+        return response
+
+    def process_template_response(self, request, response):
+        collector = request.metrics_collector
+        started = time.perf_counter()
+
+        def rendered(response):
+            collector.render_seconds += time.perf_counter() - started
+
+        response.add_post_render_callback(rendered)
+        return response
+
+
+def is_allowed(request):
+    token = settings.METRICS_TOKEN
+    if token:
+        expected = ("Bearer " + token).encode()
+        given = request.META.get("HTTP_AUTHORIZATION", "").encode()
+        if hmac.compare_digest(given, expected):
+            return True
+    user = getattr(request, "user", None)
+    return user is not None and user.is_staff
+
+
+def metrics_view(request):
+    if not is_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(export(registry.collect()), content_type=CONTENT_TYPE)
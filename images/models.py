@@ -1,20 +1,43 @@
+import re
+
 from django.contrib.auth import models as user_models
 from django.contrib.auth.models import PermissionsMixin
-from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
+from django.db import models, transaction
 
+from . import activity, counters, derivatives, events, storage, tasks
 from .managers import UserManager
+from .transactions import write_atomic
+from .writequeue import queued
+
+TAG_PATTERN = re.compile(r"\w+")
+
+
+def parse_tags(text):
+    """
+    Split free-form tags text into unique, lower-case tag names.
+    """
+    names = []
+    for name in TAG_PATTERN.findall(text.lower()):
+        name = name[: Tag._meta.get_field("name").max_length]
+        if name not in names:
+            names.append(name)
+    return names
 
 
 class Creator(user_models.AbstractBaseUser, PermissionsMixin):
     username = models.CharField(max_length=150, unique=True)
     profile_image = models.ImageField(upload_to="profiles_images")
+    profile_image_variants = models.TextField(blank=True, editable=False)
     name = models.CharField(max_length=255)
     bio = models.TextField()
     website = models.TextField()
     post_count = models.IntegerField(default=0)
     followers_count = models.IntegerField(default=0)
     following_count = models.IntegerField(default=0)
+    unread_activity_count = models.IntegerField(default=0)
+    activity_read_at = models.DateTimeField(null=True, blank=True)
+    # Changed with every write of the public profile, see images.conditional
+    version = models.IntegerField(default=0, editable=False)
 
     USERNAME_FIELD = "username"
 
@@ -24,56 +47,148 @@ class Creator(user_models.AbstractBaseUser, PermissionsMixin):
     def is_staff(self):
         return self.is_superuser
 
+    def save(self, *args, **kwargs):
+        derivatives.strip_exif(self.profile_image)
+        super(Creator, self).save(*args, **kwargs)
+        derivatives.schedule(self, "profile_image", "profile_image_variants")
+
+    @queued
     def follow(self, follower):
-        follow = CreatorFollower.objects.get_or_create(creator=self, follower=follower)
-        if follow[1]:
-            follower.following_count += 1
-            follower.save()
+        with write_atomic():
+            follow = CreatorFollower.objects.get_or_create(
+                creator=self, follower=follower
+            )
+            if follow[1]:
+                counters.increment(Creator, follower.pk, "following_count", 1)
+                counters.increment(Creator, self.pk, "followers_count", 1)
+                SuggestionPivot.objects.create(creator=follower)
+                events.publish(("user:%d" % follower.pk, "follow", {"user": self.pk}))
+                activity.record((self.pk, "follow", follower.pk, None))
 
-            self.followers_count += 1
-            self.save()
+                from .autocomplete import creator_index
 
-    def unfollow(self, ex_follower):
-        try:
-            follow = CreatorFollower.objects.get(creator=self, follower=ex_follower)
-        except ObjectDoesNotExist:
-            return False
+                creator_index.count_followers({self.pk: 1})
 
-        ex_follower.following_count -= 1
-        ex_follower.save()
+        if follow[1]:
+            from .feed import backfill_timeline
 
-        self.followers_count -= 1
-        self.save()
+            tasks.defer(backfill_timeline, follower.pk, self.pk)
 
-        follow.delete()
+    @queued
+    def unfollow(self, ex_follower):
+        with write_atomic():
+            deleted, _ = CreatorFollower.objects.filter(
+                creator=self, follower=ex_follower
+            ).delete()
+            if not deleted:
+                return False
+            counters.increment(Creator, ex_follower.pk, "following_count", -1)
+            counters.increment(Creator, self.pk, "followers_count", -1)
+            SuggestionPivot.objects.create(creator=ex_follower)
+            events.publish(("user:%d" % ex_follower.pk, "unfollow", {"user": self.pk}))
+
+            from .autocomplete import creator_index
+            from .feed import backfill_followers, dropped_to_threshold
+
+            creator_index.count_followers({self.pk: -1})
+
+            for pk in dropped_to_threshold([self.pk]):
+                tasks.defer(backfill_followers, pk)
+
+        TimelineEntry.objects.filter(owner=ex_follower, creator=self).delete()
         return True
 
-    def get_followers(self):
-        followers_ids = CreatorFollower.objects.filter(creator=self).values_list(
-            "follower", flat=True
-        )
-        followers = []
-        for follower_id in followers_ids:
-            followers.append(Creator.objects.get(pk=follower_id))
+    @queued
+    def follow_many(self, creator_ids):
+        """
+        Make this user follow ``creator_ids`` with bulk queries.
+
+        Returns ``{creator_id: changed}``, leaving out unknown creators.
+        """
+        with write_atomic():
+            found = set(
+                Creator.objects.filter(pk__in=creator_ids).values_list("pk", flat=True)
+            )
+            followed = self.get_following_ids(found)
+            new = [pk for pk in found if pk not in followed]
+            CreatorFollower.objects.bulk_create(
+                [CreatorFollower(creator_id=pk, follower=self) for pk in new],
+                ignore_conflicts=True,
+            )
+            counters.increment(Creator, self.pk, "following_count", len(new))
+            counters.increment_many(Creator, "followers_count", {pk: 1 for pk in new})
+            if new:
+                SuggestionPivot.objects.create(creator=self)
+            events.publish(
+                *[("user:%d" % self.pk, "follow", {"user": pk}) for pk in new]
+            )
+            activity.record(*[(pk, "follow", self.pk, None) for pk in new])
+
+            from .autocomplete import creator_index
+
+            creator_index.count_followers({pk: 1 for pk in new})
+
+        from .feed import backfill_timeline
+
+        for pk in new:
+            tasks.defer(backfill_timeline, self.pk, pk)
+        return {pk: pk not in followed for pk in found}
+
+    @queued
+    def unfollow_many(self, creator_ids):
+        """
+        Make this user stop following ``creator_ids`` with bulk queries.
+
+        Returns ``{creator_id: changed}``, leaving out unknown creators.
+        """
+        with write_atomic():
+            found = set(
+                Creator.objects.filter(pk__in=creator_ids).values_list("pk", flat=True)
+            )
+            followed = self.get_following_ids(found)
+            CreatorFollower.objects.filter(
+                follower=self, creator_id__in=followed
+            ).delete()
+            counters.increment(Creator, self.pk, "following_count", -len(followed))
+            counters.increment_many(
+                Creator, "followers_count", {pk: -1 for pk in followed}
+            )
+            if followed:
+                SuggestionPivot.objects.create(creator=self)
+            events.publish(
+                *[("user:%d" % self.pk, "unfollow", {"user": pk}) for pk in followed]
+            )
+
+            from .autocomplete import creator_index
+            from .feed import backfill_followers, dropped_to_threshold
+
+            creator_index.count_followers({pk: -1 for pk in followed})
+
+            for pk in dropped_to_threshold(followed):
+                tasks.defer(backfill_followers, pk)
+
+        TimelineEntry.objects.filter(owner=self, creator_id__in=followed).delete()
+        return {pk: pk in followed for pk in found}
 
-        return followers
+    def get_followers(self):
+        return Creator.objects.filter(follower__creator=self)
 
     def get_following(self):
-        creators_ids = CreatorFollower.objects.filter(follower=self).values_list(
-            "creator", flat=True
+        return Creator.objects.filter(creator__follower=self)
+
+    def get_following_ids(self, creator_ids):
+        """
+        Return which of ``creator_ids`` this user follows, in one query.
+        """
+        return set(
+            CreatorFollower.objects.filter(
+                follower=self, creator_id__in=creator_ids
+            ).values_list("creator_id", flat=True)
         )
-        creators = []
-        for creator_id in creators_ids:
-            creators.append(Creator.objects.get(pk=creator_id))
-
-        return creators
 
     def get_following_images(self):
-        all_following = self.get_following()
-        all_images = []
-        for following in all_following:
-            all_images.extend(Image.objects.filter(creator_id=following))
-        return all_images
+        following_ids = CreatorFollower.objects.filter(follower=self).values("creator")
+        return Image.objects.filter(creator_id__in=following_ids)
 
     def __str__(self):
         return self.username
@@ -86,55 +201,376 @@ class CreatorFollower(models.Model):
     follower = models.ForeignKey(
         Creator, on_delete=models.CASCADE, related_name="follower"
     )
+    created = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return str(self.follower) + " -> " + str(self.creator)
 
+    class Meta:
+        unique_together = ("creator", "follower")
+        indexes = [models.Index(fields=["follower", "creator"])]
+
 
 class Image(models.Model):
-    file = models.ImageField(upload_to="user_images")
+    file = models.ImageField(upload_to="user_images", storage=storage.content_storage)
+    variants = models.TextField(blank=True, editable=False)
     caption = models.TextField(blank=True)
     like_count = models.IntegerField(default=0)
+    comment_count = models.IntegerField(default=0)
     creator_id = models.ForeignKey(Creator, on_delete=models.CASCADE)
     tags = models.TextField(blank=True)
+    hashtags = models.ManyToManyField(
+        "Tag", through="ImageTag", related_name="images", blank=True
+    )
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Changed with every write of the representation, see images.conditional
+    version = models.IntegerField(default=0, editable=False)
 
     def save(self, *args, **kwargs):
-        if not self.pk:
-            self.creator_id.post_count += 1
-            self.creator_id.save()
-        return super(Image, self).save(*args, **kwargs)
+        created = not self.pk
+        derivatives.strip_exif(self.file)
+        # Storing an upload takes a reference, see images.storage
+        uploaded = not self.file._committed
+        previous = None
+        update_fields = kwargs.get("update_fields")
+        if not created and (update_fields is None or "file" in update_fields):
+            previous = (
+                Image.objects.filter(pk=self.pk).values_list("file", flat=True).first()
+            )
+        with write_atomic():
+            super(Image, self).save(*args, **kwargs)
+            if previous and (uploaded or previous != self.file.name):
+                transaction.on_commit(lambda: storage.release([previous]))
+            if created:
+                counters.increment(Creator, self.creator_id_id, "post_count", 1)
+                events.publish(
+                    (
+                        "creator:%d" % self.creator_id_id,
+                        "image",
+                        {"image": self.pk, "creator": self.creator_id_id},
+                    )
+                )
+            self.sync_tags(created)
+        derivatives.schedule(self, "file", "variants")
+        if created:
+            from .feed import fan_out
+
+            tasks.defer(fan_out, self.pk)
 
     def delete(self, *args, **kwargs):
-        if not self.pk:
-            self.creator_id.post_count -= 1
-            self.creator_id.save()
-        return super(Image, self).delete(*args, **kwargs)
+        with write_atomic():
+            if self.pk:
+                counters.increment(Creator, self.creator_id_id, "post_count", -1)
+                storage.release(self.get_file_names())
+                tag_ids = ImageTag.objects.filter(image=self).values_list(
+                    "tag_id", flat=True
+                )
+                counters.increment_many(Tag, "image_count", {t: -1 for t in tag_ids})
+            return super(Image, self).delete(*args, **kwargs)
+
+    def sync_tags(self, created=False):
+        """
+        Link the image to the normalized tags parsed from its tags text.
+        """
+        wanted = set(parse_tags(self.tags))
+        current = {}
+        if not created:
+            current = dict(
+                ImageTag.objects.filter(image=self).values_list("tag__name", "tag_id")
+            )
+
+        added = Tag.get_ids(wanted - set(current))
+        if added:
+            ImageTag.objects.bulk_create(
+                [
+                    ImageTag(tag_id=tag_id, image=self, created=self.created)
+                    for tag_id in added.values()
+                ],
+                ignore_conflicts=True,
+            )
+            counters.increment_many(Tag, "image_count", {t: 1 for t in added.values()})
+
+        removed = [tag_id for name, tag_id in current.items() if name not in wanted]
+        if removed:
+            ImageTag.objects.filter(image=self, tag_id__in=removed).delete()
+            counters.increment_many(Tag, "image_count", {t: -1 for t in removed})
+
+    def get_file_names(self):
+        """
+        Names of the stored original and its variants.
+        """
+        return [self.file.name] + derivatives.stored_names(self.variants)
 
     def __str__(self):
         return self.creator_id.username
 
+    class Meta:
+        indexes = [models.Index(fields=["creator_id", "created", "id"])]
+
+
+class Tag(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    image_count = models.IntegerField(default=0)
+
+    @classmethod
+    def get_ids(cls, names):
+        """
+        Return ``{name: id}``, creating the missing tags in bulk.
+        """
+        if not names:
+            return {}
+        cls.objects.bulk_create(
+            [cls(name=name) for name in names], ignore_conflicts=True
+        )
+        return dict(cls.objects.filter(name__in=names).values_list("name", "pk"))
+
+    def __str__(self):
+        return self.name
+
+
+class ImageTag(models.Model):
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
+    image = models.ForeignKey(Image, on_delete=models.CASCADE)
+    # Copied from the image so a tag page is one range scan of this table
+    created = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("tag", "image")
+        indexes = [models.Index(fields=["tag", "created", "image"])]
+
+
+class TimelineEntry(models.Model):
+    """
+    An image pushed into a follower's home feed at write time.
+    """
+
+    owner = models.ForeignKey(
+        Creator, on_delete=models.CASCADE, related_name="timeline"
+    )
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name="+")
+    creator = models.ForeignKey(Creator, on_delete=models.CASCADE, related_name="+")
+    created = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("owner", "image")
+        indexes = [
+            models.Index(fields=["owner", "created", "image"]),
+            models.Index(fields=["owner", "creator"]),
+        ]
+
 
 class Comment(models.Model):
     message = models.TextField()
     creator = models.ForeignKey(Creator, on_delete=models.CASCADE)
     image_id = models.ForeignKey(Image, on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+
+    @queued
+    def save(self, *args, **kwargs):
+        if self.pk:
+            return super(Comment, self).save(*args, **kwargs)
+        with write_atomic():
+            super(Comment, self).save(*args, **kwargs)
+            counters.increment(Image, self.image_id_id, "comment_count", 1)
+            owner_id = self.image_id.creator_id_id
+            activity.record((owner_id, "comment", self.creator_id, self.image_id_id))
+            if owner_id != self.creator_id:
+                events.publish(
+                    (
+                        "user:%d" % owner_id,
+                        "comment",
+                        {
+                            "image": self.image_id_id,
+                            "comment": self.pk,
+                            "creator": self.creator_id,
+                        },
+                    )
+                )
+
+    @queued
+    def delete(self, *args, **kwargs):
+        with write_atomic():
+            deleted = super(Comment, self).delete(*args, **kwargs)
+            # A concurrent delete of the same row already decremented it
+            if deleted[1].get(self._meta.label):
+                counters.increment(Image, self.image_id_id, "comment_count", -1)
+            return deleted
+
+    class Meta:
+        indexes = [models.Index(fields=["image_id", "created", "id"])]
+
+
+def like_event(owner_id, like):
+    return (
+        "user:%d" % owner_id,
+        "like",
+        {"image": like.image_id, "person": like.person_id},
+    )
 
 
 class Like(models.Model):
     image = models.ForeignKey(Image, on_delete=models.CASCADE)
     person = models.ForeignKey(Creator, on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
 
+    @queued
     def save(self, *args, **kwargs):
-        if not self.pk:
-            self.image.like_count += 1
-            self.image.save()
-        return super(Like, self).save(*args, **kwargs)
-
+        if self.pk:
+            return super(Like, self).save(*args, **kwargs)
+        with write_atomic():
+            super(Like, self).save(*args, **kwargs)
+            counters.increment(Image, self.image_id, "like_count", 1)
+            owner_id = self.image.creator_id_id
+            activity.record((owner_id, "like", self.person_id, self.image_id))
+            if owner_id != self.person_id:
+                events.publish(like_event(owner_id, self))
+
+    @queued
     def delete(self, *args, **kwargs):
-        if not self.pk:
-            self.image.like_count -= 1
-            self.image.save()
-        return super(Like, self).delete(*args, **kwargs)
+        with write_atomic():
+            deleted = super(Like, self).delete(*args, **kwargs)
+            # A concurrent delete of the same row already decremented it
+            if deleted[1].get(self._meta.label):
+                counters.increment(Image, self.image_id, "like_count", -1)
+            return deleted
 
     class Meta:
         unique_together = ('image', 'person',)
+        indexes = [models.Index(fields=["image", "created", "id"])]
+
+
+class CounterShard(models.Model):
+    """
+    One slice of a hot counter, see ``images.counters``.
+    """
+
+    counter = models.CharField(max_length=64)
+    object_id = models.IntegerField()
+    shard = models.SmallIntegerField()
+    value = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("counter", "object_id", "shard")
+
+
+class Blob(models.Model):
+    """
+    A stored file of ``ContentAddressedStorage`` and its reference count.
+    """
+
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    refcount = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+
+class RevokedToken(models.Model):
+    """
+    A signed token refused before it expires, see ``images.authentication``.
+    """
+
+    signature = models.CharField(max_length=64, unique=True)
+    expires = models.DateTimeField(db_index=True)
+
+
+class ExploreScore(models.Model):
+    """
+    Time-decayed popularity of a creator or an image, see ``images.explore``.
+    """
+
+    KINDS = (("creator", "creator"), ("image", "image"))
+
+    kind = models.CharField(max_length=8, choices=KINDS)
+    object_id = models.IntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = ("kind", "object_id")
+        indexes = [models.Index(fields=["kind", "score", "object_id"])]
+
+
+class ExploreCheckpoint(models.Model):
+    """
+    The last row of a source table already added to the explore scores.
+    """
+
+    source = models.CharField(max_length=16, unique=True)
+    last_id = models.IntegerField(default=0)
+
+
+class Suggestion(models.Model):
+    """
+    An account recommended to follow, see ``images.suggestions``.
+    """
+
+    owner = models.ForeignKey(
+        Creator, on_delete=models.CASCADE, related_name="suggestions"
+    )
+    suggested = models.ForeignKey(Creator, on_delete=models.CASCADE, related_name="+")
+    # Number of followed accounts that follow the suggested one
+    score = models.IntegerField()
+
+    class Meta:
+        unique_together = ("owner", "suggested")
+
+
+class SuggestionPivot(models.Model):
+    """
+    A user whose follows changed since suggestions were last refreshed.
+    """
+
+    creator = models.ForeignKey(Creator, on_delete=models.CASCADE, related_name="+")
+
+
+class StreamEvent(models.Model):
+    """
+    A live event shared between the processes serving streams, see
+    ``images.events.DatabaseBroker``.
+    """
+
+    topic = models.CharField(max_length=64)
+    kind = models.CharField(max_length=16)
+    data = models.TextField()
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class Activity(models.Model):
+    """
+    Likes, comments or follows received by a user, see ``images.activity``.
+    """
+
+    KINDS = (("like", "like"), ("comment", "comment"), ("follow", "follow"))
+
+    recipient = models.ForeignKey(
+        Creator, on_delete=models.CASCADE, related_name="activity"
+    )
+    kind = models.CharField(max_length=8, choices=KINDS)
+    # The image liked or commented on, none for follows
+    image = models.ForeignKey(
+        Image, on_delete=models.CASCADE, null=True, related_name="+"
+    )
+    # Latest of the actor_count users aggregated into the row
+    actor = models.ForeignKey(Creator, on_delete=models.CASCADE, related_name="+")
+    actor_count = models.IntegerField(default=1)
+    created = models.DateTimeField()
+    updated = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["recipient", "updated", "id"]),
+            models.Index(fields=["recipient", "kind", "image", "updated"]),
+        ]
+
+
+class ActivityActor(models.Model):
+    """
+    One of the distinct users aggregated into an ``Activity`` row.
+    """
+
+    activity = models.ForeignKey(
+        Activity, on_delete=models.CASCADE, related_name="actors"
+    )
+    actor = models.ForeignKey(Creator, on_delete=models.CASCADE, related_name="+")
+
+    class Meta:
+        unique_together = ("activity", "actor")
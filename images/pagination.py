@@ -0,0 +1,243 @@
+import base64
+import binascii
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db.models import FloatField, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def keyset_filter(ordering, position, reverse=False):
+    """
+    Build the condition selecting rows strictly after ``position``.
+
+    ``ordering`` is an ``order_by`` style tuple; ``reverse`` walks it backwards.
+    """
+    condition = Q()
+    for index, field in enumerate(ordering):
+        descending = field.startswith("-") != reverse
+        lookup = "%s__%s" % (field.lstrip("-"), "lt" if descending else "gt")
+        clause = Q(**{lookup: position[index]})
+        for previous, value in zip(ordering[:index], position):
+            clause &= Q(**{previous.lstrip("-"): value})
+        condition |= clause
+    return condition
+
+
+def reverse_ordering(ordering):
+    return tuple(
+        field[1:] if field.startswith("-") else "-" + field for field in ordering
+    )
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a unique composite ordering.
+
+    The cursor keeps the ordering values of the boundary row, so every page is
+    one index range scan no matter how deep the client has scrolled.
+    """
+
+    ordering = ("-created", "-id")
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    page_size_setting = "KEYSET_PAGE_SIZE"
+    invalid_cursor_message = "Invalid cursor"
+    # Fields converting cursor values of orderings that are not model fields
+    cursor_fields = {}
+
+    def get_page_size(self, request):
+        page_size = getattr(settings, self.page_size_setting)
+        try:
+            requested = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return page_size
+        if requested > 0:
+            return min(requested, settings.KEYSET_MAX_PAGE_SIZE)
+        return page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.position, self.reverse = self.decode_cursor(request)
+        position = self.parse_position(self.position, queryset.model)
+
+        rows = self.fetch(queryset, position, self.reverse, self.page_size + 1)
+        has_more = len(rows) > self.page_size
+        rows = rows[: self.page_size]
+        if self.reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+
+        self.page = rows
+        return rows
+
+    def fetch(self, source, position, reverse, limit):
+        """
+        Return up to ``limit`` rows past ``position`` in page order.
+
+        Sources that are not querysets (merged timelines, search results)
+        provide their own ``page(position, reverse, limit)``.
+        """
+        if hasattr(source, "page"):
+            return list(source.page(position, reverse, limit))
+        if position is not None:
+            source = source.filter(self.keyset_filter(position, reverse))
+        return list(source.order_by(*self.get_ordering(reverse))[:limit])
+
+    def get_ordering(self, reverse=False):
+        return reverse_ordering(self.ordering) if reverse else self.ordering
+
+    def keyset_filter(self, position, reverse=False):
+        return keyset_filter(self.ordering, position, reverse)
+
+    def get_position(self, row):
+        position = []
+        for field in self.ordering:
+            name = field.lstrip("-")
+            value = row[name] if isinstance(row, dict) else getattr(row, name)
+            position.append(str(value))
+        return position
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode("ascii")))
+            position, reverse = cursor["p"], bool(cursor["r"])
+        except (binascii.Error, UnicodeError, ValueError, KeyError, TypeError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def parse_position(self, position, model):
+        """
+        Convert the values of a decoded cursor with the ordering fields.
+        """
+        if position is None:
+            return None
+        values = []
+        for field_name, value in zip(self.ordering, position):
+            name = field_name.lstrip("-")
+            field = self.cursor_fields.get(name) or model._meta.get_field(name)
+            try:
+                value = field.to_python(value)
+            except (ValidationError, TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+            if value is None:
+                raise NotFound(self.invalid_cursor_message)
+            values.append(value)
+        return values
+
+    def encode_cursor(self, position, reverse):
+        cursor = json.dumps({"p": position, "r": int(reverse)})
+        encoded = base64.urlsafe_b64encode(cursor.encode("ascii")).decode("ascii")
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            return self.encode_cursor(self.position, reverse=False)
+        return self.encode_cursor(self.get_position(self.page[-1]), reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.get_position(self.page[0]), reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data),
+                ]
+            )
+        )
+
+
+class FeedPagination(KeysetPagination):
+    page_size_setting = "FEED_PAGE_SIZE"
+
+
+class FollowPagination(KeysetPagination):
+    """
+    Followers and followed creators, most recently followed first.
+    """
+
+
+class CommentPagination(KeysetPagination):
+    """
+    Newest-first comment pages in both directions.
+
+    ``?after=<comment id>`` switches to polling: the comments written after
+    that one, oldest first, with a next link to poll again from the last.
+    """
+
+    after_query_param = "after"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.after = request.query_params.get(self.after_query_param)
+        if self.after is None:
+            return super(CommentPagination, self).paginate_queryset(
+                queryset, request, view
+            )
+
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        fields = [field.lstrip("-") for field in self.ordering]
+        try:
+            anchor = queryset.filter(pk=int(self.after)).values_list(*fields).get()
+        except (ValueError, ObjectDoesNotExist):
+            raise NotFound("Invalid comment id")
+
+        position = [str(value) for value in anchor]
+        self.page = self.fetch(queryset, position, True, self.page_size)
+        return self.page
+
+    def get_next_link(self):
+        if self.after is None:
+            return super(CommentPagination, self).get_next_link()
+        last = self.page[-1].pk if self.page else self.after
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.after_query_param, last)
+
+    def get_previous_link(self):
+        if self.after is None:
+            return super(CommentPagination, self).get_previous_link()
+        return None
+
+
+class TagPagination(KeysetPagination):
+    ordering = ("-created", "-image_id")
+
+
+class SearchPagination(KeysetPagination):
+    ordering = ("rank", "id")
+    cursor_fields = {"rank": FloatField()}
+
+
+class ExplorePagination(KeysetPagination):
+    ordering = ("-score", "-object_id")
+
+
+class LikePagination(KeysetPagination):
+    """
+    Who liked an image, newest first.
+    """
+
+
+class ActivityPagination(KeysetPagination):
+    ordering = ("-updated", "-id")
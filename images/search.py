@@ -0,0 +1,154 @@
+"""
+Ranked full-text search over image captions and creator profiles.
+
+The engine is chosen with the ``SEARCH_BACKEND`` setting. The SQLite backend
+keeps one FTS5 table per searchable model whose rowid is the object's primary
+key; it is updated on every save and delete and ranked with bm25.
+"""
+import abc
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from .models import Creator, Image
+
+QUERY_TERM = re.compile(r"\w+")
+
+# kind -> (model, indexed fields)
+DOCUMENTS = {
+    "images": (Image, ("caption",)),
+    "users": (Creator, ("username", "name", "bio")),
+}
+
+
+class SearchBackend(abc.ABC):
+    """
+    Interface of full-text search engines.
+
+    ``search`` returns ``(pk, rank)`` pairs, best first, after the
+    ``(rank, pk)`` position; ``reverse`` walks towards better matches.
+    """
+
+    def install(self):
+        pass
+
+    @abc.abstractmethod
+    def index(self, kind, objects):
+        """
+        Add or replace the documents of ``objects``.
+        """
+
+    @abc.abstractmethod
+    def remove(self, kind, pks):
+        """
+        Drop the documents of ``pks``.
+        """
+
+    @abc.abstractmethod
+    def clear(self, kind, after=None, upto=None):
+        """
+        Drop the documents of ``kind`` whose pk is past ``after`` and up to
+        ``upto``, every document by default.
+        """
+
+    @abc.abstractmethod
+    def search(self, kind, query, position, reverse, limit):
+        """
+        Return up to ``limit`` ``(pk, rank)`` pairs matching ``query``.
+        """
+
+
+class SQLiteFTS5Backend(SearchBackend):
+    def table(self, kind):
+        return "%s_fts" % DOCUMENTS[kind][0]._meta.db_table
+
+    def install(self):
+        with connection.cursor() as cursor:
+            for kind, (_model, fields) in DOCUMENTS.items():
+                cursor.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, "
+                    "tokenize='unicode61 remove_diacritics 2')"
+                    % (self.table(kind), ", ".join(fields))
+                )
+
+    def index(self, kind, objects):
+        fields = DOCUMENTS[kind][1]
+        placeholders = ", ".join(["%s"] * (len(fields) + 1))
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO %s (rowid, %s) VALUES (%s)"
+                % (self.table(kind), ", ".join(fields), placeholders),
+                [
+                    [obj.pk] + [getattr(obj, field) for field in fields]
+                    for obj in objects
+                ],
+            )
+
+    def remove(self, kind, pks):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "DELETE FROM %s WHERE rowid = %%s" % self.table(kind),
+                [[pk] for pk in pks],
+            )
+
+    def clear(self, kind, after=None, upto=None):
+        sql, params = "DELETE FROM %s WHERE 1" % self.table(kind), []
+        if after is not None:
+            sql += " AND rowid > %s"
+            params.append(after)
+        if upto is not None:
+            sql += " AND rowid <= %s"
+            params.append(upto)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def search(self, kind, query, position, reverse, limit):
+        terms = QUERY_TERM.findall(query)
+        if not terms:
+            return []
+        # Every word must match, the last one as a prefix of a longer word
+        match = " ".join('"%s"' % term for term in terms) + "*"
+
+        table = self.table(kind)
+        after, direction = ("<", "DESC") if reverse else (">", "ASC")
+        sql = "SELECT rowid, rank FROM {table} WHERE {table} MATCH %s"
+        params = [match]
+        if position is not None:
+            rank, pk = float(position[0]), int(position[1])
+            sql += " AND (rank {after} %s OR (rank = %s AND rowid {after} %s))"
+            params += [rank, rank, pk]
+        sql += " ORDER BY rank {direction}, rowid {direction} LIMIT %s"
+        sql = sql.format(table=table, after=after, direction=direction)
+        params.append(limit)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+
+def get_backend():
+    return import_string(settings.SEARCH_BACKEND)()
+
+
+class SearchResults:
+    """
+    Keyset-paginated search results, see ``KeysetPagination.fetch``.
+    """
+
+    def __init__(self, kind, query, backend=None):
+        self.kind = kind
+        self.query = query
+        self.model = DOCUMENTS[kind][0]
+        self.backend = backend or get_backend()
+
+    def page(self, position, reverse, limit):
+        ranked = self.backend.search(self.kind, self.query, position, reverse, limit)
+        objects = self.model.objects.only("pk").in_bulk([pk for pk, _rank in ranked])
+        results = []
+        for pk, rank in ranked:
+            if pk in objects:
+                objects[pk].rank = rank
+                results.append(objects[pk])
+        return results
@@ -1,11 +1,40 @@
+import abc
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
 from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.db.models import Manager
 from rest_framework import serializers
 
-from .models import Comment, Creator, Image, Like
+from . import counters, derivatives, likefilter, metrics
+from .cache import kind_of, object_cache
+from .likebuffer import like_buffer
+from .models import Activity, Comment, Creator, CreatorFollower, Image, Like
+
+COMMENTS_PREVIEW_BATCH_SIZE = 200
+
 
+class TimedMixin:
+    """
+    Count building representations as serialization time of the request.
+    """
 
-class CreatorSerializer(serializers.ModelSerializer):
+    def to_representation(self, instance):
+        with metrics.timed(self.context.get("request")):
+            return super(TimedMixin, self).to_representation(instance)
+
+
+class CreatorSerializer(TimedMixin, serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, required=True, )
+    profile_image_variants = serializers.SerializerMethodField()
+
+    def get_profile_image_variants(self, creator):
+        return derivatives.represent(
+            creator.profile_image,
+            creator.profile_image_variants,
+            self.context.get("request"),
+        )
 
     def create(self, validated_data):
         validated_data["password"] = make_password(validated_data.get("password"))
@@ -18,10 +47,16 @@ class CreatorSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Creator
-        fields = "__all__"
+        # The public profile, activity state is private to the user
+        fields = (
+            "id", "username", "password", "profile_image", "profile_image_variants",
+            "name", "bio", "website", "post_count", "followers_count",
+            "following_count",
+        )
+        read_only_fields = ("post_count", "followers_count", "following_count")
 
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(TimedMixin, serializers.ModelSerializer):
     creator = serializers.PrimaryKeyRelatedField(
         queryset=Creator.objects.all(), default=serializers.CurrentUserDefault()
     )
@@ -31,22 +66,132 @@ class CommentSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
-class ImageSerializer(serializers.ModelSerializer):
+def comment_previews(image_ids):
+    """
+    The newest comments of every image in ``image_ids``, as one query.
+
+    Each image gets its own ``LIMIT`` subquery, a short range scan of the
+    comment index, so images with many comments cost no more than others.
+    """
+    image_ids = list(image_ids)
+    if not image_ids:
+        return []
+    quote = connection.ops.quote_name
+    newest = (
+        "SELECT * FROM (SELECT * FROM {table} WHERE {image} = %s "
+        "ORDER BY {created} DESC, {id} DESC LIMIT {size}) AS {alias}"
+    )
+    names = {
+        "table": quote(Comment._meta.db_table),
+        "image": quote(Comment._meta.get_field("image_id").column),
+        "created": quote("created"),
+        "id": quote("id"),
+        "size": settings.COMMENTS_PREVIEW_SIZE,
+    }
+    ordering = " ORDER BY %s DESC, %s DESC" % (quote("created"), quote("id"))
+    comments = []
+    # SQLite caps the number of terms of a compound select
+    for start in range(0, len(image_ids), COMMENTS_PREVIEW_BATCH_SIZE):
+        batch = image_ids[start : start + COMMENTS_PREVIEW_BATCH_SIZE]
+        # Every derived table needs its own alias outside of SQLite
+        query = " UNION ALL ".join(
+            newest.format(alias=quote("newest%d" % index), **names)
+            for index in range(len(batch))
+        )
+        comments.extend(Comment.objects.raw(query + ordering, batch))
+    return comments
+
+
+def load_comment_previews(image_ids):
+    previews = defaultdict(list)
+    for comment in comment_previews(image_ids):
+        previews[comment.image_id_id].append(comment)
+    return previews
+
+
+def get_like_deltas(image_ids):
+    """
+    Likes of ``image_ids`` not added to their ``like_count`` column yet.
+    """
+    like_deltas = counters.get_shard_totals(Image, "like_count", image_ids)
+    for image_id, delta in like_buffer.get_like_deltas(image_ids).items():
+        like_deltas[image_id] = like_deltas.get(image_id, 0) + delta
+    return like_deltas
+
+
+class ImageListSerializer(TimedMixin, serializers.ListSerializer):
+    def to_representation(self, data):
+        images = list(data.all() if isinstance(data, Manager) else data)
+        self.child.prepare(images)
+        return [self.child.to_representation(image) for image in images]
+
+
+class ImageSerializer(TimedMixin, serializers.ModelSerializer):
     creator_id = serializers.PrimaryKeyRelatedField(
         queryset=Creator.objects.all(), default=serializers.CurrentUserDefault()
     )
 
     comments = serializers.SerializerMethodField('get_all_related_comments', read_only=True)
+    like_count = serializers.SerializerMethodField()
+    variants = serializers.SerializerMethodField()
+    liked_by_me = serializers.SerializerMethodField()
+
+    prepared = None
+
+    def get_fields(self):
+        fields = super(ImageSerializer, self).get_fields()
+        if self.context.get("shared"):
+            # Cached for every viewer, see add_liked_by_me
+            del fields["liked_by_me"]
+        return fields
+
+    def prepare(self, images):
+        """
+        Load the related data of a page of images with one query per kind.
+        """
+        image_ids = [image.pk for image in images]
+        request = self.context.get("request")
+        self.prepared = {
+            "comments": load_comment_previews(image_ids),
+            "like_deltas": get_like_deltas(image_ids),
+            "liked": set(),
+        }
+        if request is not None and not self.context.get("shared"):
+            self.prepared["liked"] = likefilter.liked_image_ids(
+                request.user, image_ids
+            )
+
+    def to_representation(self, instance):
+        if self.prepared is None:
+            self.prepare([instance])
+        return super(ImageSerializer, self).to_representation(instance)
 
     def get_all_related_comments(self, foo):
-        return CommentSerializer(Comment.objects.filter(image_id=foo), many=True).data
+        previews = self.prepared["comments"].get(foo.pk, [])
+        return CommentSerializer(previews, many=True).data
+
+    def get_variants(self, image):
+        return derivatives.represent(
+            image.file, image.variants, self.context.get("request")
+        )
+
+    def get_like_count(self, image):
+        return image.like_count + self.prepared["like_deltas"].get(image.pk, 0)
+
+    def get_liked_by_me(self, image):
+        return image.pk in self.prepared["liked"]
 
     class Meta:
         model = Image
-        fields = ('id', 'file', 'caption', 'like_count', 'creator_id', 'tags', 'comments')
+        fields = (
+            'id', 'file', 'variants', 'caption', 'like_count', 'comment_count',
+            'creator_id', 'tags', 'comments', 'liked_by_me',
+        )
+        read_only_fields = ('comment_count',)
+        list_serializer_class = ImageListSerializer
 
 
-class LikeSerializer(serializers.ModelSerializer):
+class LikeSerializer(TimedMixin, serializers.ModelSerializer):
     person = serializers.PrimaryKeyRelatedField(
         queryset=Creator.objects.all(), default=serializers.CurrentUserDefault()
     )
@@ -57,3 +202,275 @@ class LikeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Like
         fields = "__all__"
+
+
+class ActivitySerializer(TimedMixin, serializers.ModelSerializer):
+    """
+    Activity rows of one user. The context holds the ``actors``
+    representations by id and the user's ``read_at``.
+    """
+
+    actor = serializers.SerializerMethodField()
+    unread = serializers.SerializerMethodField()
+
+    def get_actor(self, row):
+        return self.context["actors"].get(row.actor_id)
+
+    def get_unread(self, row):
+        read_at = self.context["read_at"]
+        return read_at is None or row.updated > read_at
+
+    class Meta:
+        model = Activity
+        fields = (
+            "id", "kind", "image", "actor", "actor_count", "created", "updated",
+            "unread",
+        )
+
+
+class RowSerializer(abc.ABC):
+    """
+    Read-only representations built from ``.values()`` rows.
+
+    The fast path of list endpoints: no model instances and no field objects
+    per row, and ``prepare`` loads the related data of a page at once.
+    Subclasses name the ``fields`` to read and implement ``represent``.
+    """
+
+    fields = ()
+
+    class Meta:
+        model = None
+
+    def __init__(self, request=None):
+        self.request = request
+
+    def serialize(self, queryset):
+        return self.serialize_rows(list(queryset.values(*self.fields)))
+
+    def serialize_rows(self, rows):
+        with metrics.timed(self.request):
+            self.prepare(rows)
+            return [self.represent(row) for row in rows]
+
+    def load(self, pks):
+        """
+        Return ``{pk: representation}`` of the existing objects among ``pks``.
+        """
+        queryset = self.Meta.model.objects.filter(pk__in=pks)
+        return {data["id"]: data for data in self.serialize(queryset)}
+
+    def prepare(self, rows):
+        pass
+
+    @abc.abstractmethod
+    def represent(self, row):
+        """
+        Return the representation of one row of ``fields``.
+        """
+
+    def file_url(self, storage, name):
+        # As FileField renders it
+        if not name:
+            return None
+        url = storage.url(name)
+        return self.request.build_absolute_uri(url) if self.request else url
+
+
+class CreatorRowSerializer(RowSerializer):
+    """
+    The public profile fields of creators.
+    """
+
+    fields = (
+        "id", "username", "profile_image", "profile_image_variants", "name",
+        "bio", "website", "post_count", "followers_count", "following_count",
+    )
+    storage = Creator._meta.get_field("profile_image").storage
+
+    class Meta:
+        model = Creator
+
+    def represent(self, row):
+        data = OrderedDict((name, row[name]) for name in self.fields)
+        data["profile_image"] = self.file_url(self.storage, row["profile_image"])
+        data["profile_image_variants"] = derivatives.represent_name(
+            self.storage,
+            row["profile_image"],
+            row["profile_image_variants"],
+            self.request,
+        )
+        return data
+
+
+class ImageRowSerializer(RowSerializer):
+    """
+    Images as ``ImageSerializer`` renders them.
+    """
+
+    fields = (
+        "id", "file", "variants", "caption", "like_count", "comment_count",
+        "creator_id", "tags",
+    )
+    storage = Image._meta.get_field("file").storage
+
+    class Meta:
+        model = Image
+
+    def prepare(self, rows):
+        image_ids = [row["id"] for row in rows]
+        self.like_deltas = get_like_deltas(image_ids)
+        self.comments = {
+            image_id: CommentSerializer(previews, many=True).data
+            for image_id, previews in load_comment_previews(image_ids).items()
+        }
+
+    def represent(self, row):
+        data = OrderedDict((name, row[name]) for name in self.fields)
+        data["file"] = self.file_url(self.storage, row["file"])
+        data["variants"] = derivatives.represent_name(
+            self.storage, row["file"], row["variants"], self.request
+        )
+        data["like_count"] += self.like_deltas.get(row["id"], 0)
+        data["comments"] = self.comments.get(row["id"], [])
+        return data
+
+
+class LikerRowSerializer(RowSerializer):
+    """
+    The likes of an image with the profiles of who liked it, read with one join.
+    """
+
+    fields = ("id", "created") + tuple(
+        "person__" + name for name in CreatorRowSerializer.fields
+    )
+    created_field = serializers.DateTimeField()
+
+    class Meta:
+        model = Like
+
+    def __init__(self, request=None):
+        super(LikerRowSerializer, self).__init__(request)
+        self.person = CreatorRowSerializer(request)
+
+    def represent(self, row):
+        person = {name: row["person__" + name] for name in CreatorRowSerializer.fields}
+        return OrderedDict(
+            [
+                ("id", row["id"]),
+                ("person", self.person.represent(person)),
+                ("created", self.created_field.to_representation(row["created"])),
+            ]
+        )
+
+
+class FollowRowSerializer(RowSerializer):
+    """
+    The profiles on one side of follows, read with one join.
+
+    ``relation`` is ``"follower"`` to list the followers of a creator and
+    ``"creator"`` to list the creators someone follows. The follow's
+    ``id`` and ``created`` are read for pagination.
+    """
+
+    class Meta:
+        model = CreatorFollower
+
+    def __init__(self, relation, request=None):
+        super(FollowRowSerializer, self).__init__(request)
+        self.prefix = relation + "__"
+        self.fields = ("id", "created") + tuple(
+            self.prefix + name for name in CreatorRowSerializer.fields
+        )
+        self.creator = CreatorRowSerializer(request)
+
+    def represent(self, row):
+        creator = {
+            name: row[self.prefix + name] for name in CreatorRowSerializer.fields
+        }
+        return self.creator.represent(creator)
+
+
+def add_liked_by_me(images, user):
+    """
+    Copy image representations adding whether ``user`` likes each of them.
+
+    The flag depends on the viewer, so it is added to the shared cached data
+    with at most one query for the whole page, see ``images.likefilter``.
+    """
+    liked = likefilter.liked_image_ids(user, [image["id"] for image in images])
+    return [
+        OrderedDict(image, liked_by_me=image["id"] in liked) for image in images
+    ]
+
+
+def cache_namespace(serializer_class, request):
+    # Representations hold absolute URLs when serialized for a request
+    host = request.build_absolute_uri("/") if request is not None else ""
+    return "%s:%s" % (serializer_class.__name__, host)
+
+
+def serialize_cached(serializer_class, objects, request=None):
+    """
+    Serialize a page of objects, rendering only those missing from the cache.
+
+    The returned representations are shared with the cache and must not be
+    modified; copy them to add viewer-specific fields.
+    """
+    objects = list(objects)
+    by_pk = {obj.pk: obj for obj in objects}
+
+    def render(pks):
+        if issubclass(serializer_class, RowSerializer):
+            return serializer_class(request).load(pks)
+        serializer = serializer_class(
+            [by_pk[pk] for pk in pks],
+            many=True,
+            context={"request": request, "shared": True},
+        )
+        return {pk: OrderedDict(data) for pk, data in zip(pks, serializer.data)}
+
+    model = serializer_class.Meta.model
+    with metrics.timed(request):
+        cached = object_cache.get_many(
+            kind_of(model),
+            list(by_pk),
+            render,
+            cache_namespace(serializer_class, request),
+        )
+    # Row serializers skip objects deleted since they were paginated
+    return [cached[obj.pk] for obj in objects if obj.pk in cached]
+
+
+def get_cached_many(serializer_class, pks, request=None):
+    """
+    Return ``{pk: representation}`` of the existing objects among ``pks``,
+    loading only those missing from the cache.
+    """
+    model = serializer_class.Meta.model
+
+    def render(missing):
+        if issubclass(serializer_class, RowSerializer):
+            return serializer_class(request).load(missing)
+        objects = list(model.objects.filter(pk__in=missing))
+        serializer = serializer_class(
+            objects, many=True, context={"request": request, "shared": True}
+        )
+        return {
+            obj.pk: OrderedDict(data) for obj, data in zip(objects, serializer.data)
+        }
+
+    with metrics.timed(request):
+        return object_cache.get_many(
+            kind_of(model),
+            list(pks),
+            render,
+            cache_namespace(serializer_class, request),
+        )
+
+
+def get_cached(serializer_class, pk, request=None):
+    """
+    Return the cached representation of one object, None if it does not exist.
+    """
+    return get_cached_many(serializer_class, [pk], request).get(pk)
@@ -0,0 +1,82 @@
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from . import counters, likefilter, search
+from .authentication import forget_user
+from .autocomplete import creator_index
+from .cache import kind_of, object_cache
+from .models import Comment, Creator, ExploreScore, Image, Like
+
+SEARCH_KINDS = {Image: "images", Creator: "users"}
+
+
+@receiver(post_migrate)
+def install_search(sender, **kwargs):
+    if sender.name == "images":
+        search.get_backend().install()
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_save, sender=Creator)
+def index_document(sender, instance, update_fields=None, **kwargs):
+    fields = search.DOCUMENTS[SEARCH_KINDS[sender]][1]
+    if update_fields is not None and not set(fields) & set(update_fields):
+        return
+    search.get_backend().index(SEARCH_KINDS[sender], [instance])
+
+
+@receiver(post_delete, sender=Image)
+@receiver(post_delete, sender=Creator)
+def remove_document(sender, instance, **kwargs):
+    search.get_backend().remove(SEARCH_KINDS[sender], [instance.pk])
+
+
+@receiver(post_save, sender=Creator)
+def update_autocomplete(sender, instance, **kwargs):
+    creator_index.update(instance)
+
+
+@receiver(post_delete, sender=Creator)
+def remove_from_autocomplete(sender, instance, **kwargs):
+    creator_index.remove(instance.pk)
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_save, sender=Creator)
+@receiver(post_delete, sender=Image)
+@receiver(post_delete, sender=Creator)
+def invalidate_cached(sender, instance, **kwargs):
+    if kwargs["signal"] is post_save and not kwargs["created"]:
+        counters.touch(sender, instance.pk)
+    object_cache.invalidate(kind_of(sender), instance.pk)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_comment_preview(sender, instance, **kwargs):
+    counters.touch(Image, instance.image_id_id)
+    object_cache.invalidate(kind_of(Image), instance.image_id_id)
+
+
+@receiver(post_save, sender=Like)
+def add_to_like_filter(sender, instance, created, **kwargs):
+    if created:
+        likefilter.add(instance.person_id, instance.image_id)
+
+
+@receiver(post_delete, sender=Like)
+def invalidate_like_filter(sender, instance, **kwargs):
+    likefilter.invalidate(instance.person_id)
+
+
+@receiver(post_save, sender=Creator)
+@receiver(post_delete, sender=Creator)
+def forget_token_user(sender, instance, **kwargs):
+    forget_user(instance.pk)
+
+
+@receiver(post_delete, sender=Image)
+@receiver(post_delete, sender=Creator)
+def remove_explore_score(sender, instance, **kwargs):
+    kind = "image" if sender is Image else "creator"
+    ExploreScore.objects.filter(kind=kind, object_id=instance.pk).delete()
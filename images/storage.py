@@ -0,0 +1,99 @@
+"""
+Content-addressed media storage.
+
+Uploads are hashed while they are streamed to disk and stored once under
+``<upload_to>/<h[:2]>/<h[2:4]>/<sha256><ext>``, so reposting the same picture
+costs no extra disk space. Every save of a blob takes a reference in the
+``Blob`` table, and deleting an ``Image`` or replacing its file releases its
+references; blobs are only removed from disk by the ``collect_blobs`` command.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError
+from django.db.models import F
+
+from . import models
+from .transactions import write_atomic
+
+CHUNK_SIZE = 64 * 1024
+
+
+def retain(name, size):
+    if models.Blob.objects.filter(name=name).update(refcount=F("refcount") + 1):
+        return
+    try:
+        with write_atomic():
+            models.Blob.objects.create(name=name, size=size, refcount=1)
+    except IntegrityError:
+        # Stored concurrently by another upload
+        models.Blob.objects.filter(name=name).update(refcount=F("refcount") + 1)
+
+
+def release(names):
+    models.Blob.objects.filter(name__in=names).update(refcount=F("refcount") - 1)
+
+
+def discard(file_storage, names):
+    """
+    Drop files no longer referenced: blobs are released for ``collect_blobs``,
+    files of other storages are deleted right away.
+    """
+    if isinstance(file_storage, ContentAddressedStorage):
+        release(names)
+        return
+    for name in names:
+        file_storage.delete(name)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def get_available_name(self, name, max_length=None):
+        # Names are derived from the content in _save, collisions are duplicates
+        return name
+
+    def _save(self, name, content):
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+
+        digest = hashlib.sha256()
+        size = 0
+        if hasattr(content, "temporary_file_path"):
+            # Large uploads are already on disk, hash them in place
+            temporary = content.temporary_file_path()
+            with open(temporary, "rb") as source:
+                for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    size += len(chunk)
+        else:
+            os.makedirs(self.location, exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(
+                prefix=".upload-", dir=self.location
+            )
+            with os.fdopen(descriptor, "wb") as target:
+                for chunk in content.chunks(CHUNK_SIZE):
+                    digest.update(chunk)
+                    target.write(chunk)
+                    size += len(chunk)
+
+        hexdigest = digest.hexdigest()
+        name = os.path.join(
+            directory, hexdigest[:2], hexdigest[2:4], hexdigest + extension
+        )
+        path = self.path(name)
+        if os.path.exists(path):
+            if not hasattr(content, "temporary_file_path"):
+                os.remove(temporary)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file_move_safe(temporary, path, allow_overwrite=True)
+            if self.file_permissions_mode is not None:
+                os.chmod(path, self.file_permissions_mode)
+
+        retain(name, size)
+        return name.replace("\\", "/")
+
+
+content_storage = ContentAddressedStorage()
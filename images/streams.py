@@ -0,0 +1,148 @@
+"""
+ASGI application streaming live events as Server-Sent Events.
+
+``GET /events/?token=<signed token>`` (or with an ``Authorization: Bearer``
+header) subscribes to the events of the user and of the creators it follows,
+see ``images.events``. A comment line is sent every ``EVENTS_KEEPALIVE``
+seconds so proxies keep idle streams open.
+"""
+import asyncio
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.exceptions import AuthenticationFailed
+
+from . import events
+from .authentication import SignedTokenAuthentication, parse_token
+from .models import CreatorFollower
+
+PATH = "/events/"
+
+broker_task = None
+
+
+def get_token(scope):
+    for name, value in scope.get("headers", ()):
+        if name == b"authorization" and value[:7].lower() == b"bearer ":
+            return value[7:].decode("latin-1")
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    return query.get("token", [None])[0]
+
+
+def authenticate(token):
+    """
+    Return the id of the user of a signed token and the creators it follows.
+    """
+    close_old_connections()
+    try:
+        parsed = parse_token(token) if token else None
+        if parsed is None:
+            return None
+        user, _token = SignedTokenAuthentication().authenticate_credentials(
+            token, *parsed
+        )
+        following = list(
+            CreatorFollower.objects.filter(follower=user).values_list(
+                "creator_id", flat=True
+            )
+        )
+        return user.pk, following
+    except AuthenticationFailed:
+        return None
+    finally:
+        close_old_connections()
+
+
+def start_broker():
+    global broker_task
+    if broker_task is None:
+        broker_task = asyncio.ensure_future(events.broker.run(events.hub))
+
+
+async def respond(send, status, body=b""):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/plain; charset=utf-8")],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_body(send, body):
+    await send({"type": "http.response.body", "body": body, "more_body": True})
+
+
+async def stream(scope, receive, send):
+    loop = asyncio.get_event_loop()
+    found = await loop.run_in_executor(None, authenticate, get_token(scope))
+    if found is None:
+        await respond(send, 401, b"Invalid or missing token")
+        return
+    user_id, following = found
+
+    subscriber = events.Subscriber()
+    events.hub.subscribe(
+        subscriber,
+        ["user:%d" % user_id] + ["creator:%d" % pk for pk in following],
+    )
+    # Resolves when the client goes away
+    disconnected = asyncio.ensure_future(receive())
+    try:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/event-stream"),
+                    (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no"),
+                ],
+            }
+        )
+        await send_body(send, b": connected\n\n")
+        while not disconnected.done():
+            await asyncio.wait(
+                (disconnected, subscriber.wait()),
+                timeout=settings.EVENTS_KEEPALIVE,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if disconnected.done():
+                break
+            body = subscriber.drain() or b": keepalive\n\n"
+            await send_body(send, body)
+    finally:
+        events.hub.unsubscribe(subscriber)
+        disconnected.cancel()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if settings.EVENTS_ENABLED:
+                start_broker()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    if not settings.EVENTS_ENABLED:
+        await respond(send, 404, b"Event streams are disabled")
+        return
+    start_broker()
+    if scope["path"] != PATH or scope["method"] != "GET":
+        await respond(send, 404, b"Not found")
+        return
+    # Consume the empty request body, the next message is the disconnect
+    await receive()
+    await stream(scope, receive, send)
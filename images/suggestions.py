@@ -0,0 +1,104 @@
+"""
+Friends-of-friends follow suggestions.
+
+Suggestions are computed offline by ``refresh``: the whole follow graph is
+loaded into ``images.graph`` arrays and the top ``SUGGESTIONS_LIMIT``
+accounts of every user are scored across a process pool and stored as
+``Suggestion`` rows.
+
+Follows and unfollows record their follower as a ``SuggestionPivot``. An
+incremental refresh only recomputes the pivots and the users following them,
+whose friends-of-friends went through the pivots.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db.models import Max
+
+from . import graph
+from .models import Creator, CreatorFollower, Suggestion, SuggestionPivot
+from .transactions import write_atomic
+
+
+def load_graph():
+    size = (Creator.objects.aggregate(Max("pk"))["pk__max"] or 0) + 1
+    edges = (
+        CreatorFollower.objects.order_by("follower_id", "creator_id")
+        .values_list("follower_id", "creator_id")
+        .iterator(chunk_size=10000)
+    )
+    return graph.build(edges, size)
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def compute(offsets, targets, users, workers=None, chunk_size=500):
+    """
+    Yield ``(user id, [(suggested id, score)])`` for ``users``.
+    """
+    score = partial(
+        graph.suggest_many,
+        limit=settings.SUGGESTIONS_LIMIT,
+        max_degree=settings.SUGGESTIONS_MAX_DEGREE,
+    )
+    with ProcessPoolExecutor(
+        max_workers=workers or settings.SUGGESTIONS_WORKERS,
+        initializer=graph.init_worker,
+        initargs=(offsets, targets),
+    ) as pool:
+        for results in pool.map(score, chunks(users, chunk_size)):
+            yield from results
+
+
+def store(results):
+    owners = [owner for owner, _suggestions in results]
+    with write_atomic():
+        Suggestion.objects.filter(owner_id__in=owners).delete()
+        Suggestion.objects.bulk_create(
+            [
+                Suggestion(owner_id=owner, suggested_id=suggested, score=score)
+                for owner, suggestions in results
+                for suggested, score in suggestions
+            ]
+        )
+
+
+def refresh(full=False, workers=None, batch_size=5000):
+    """
+    Recompute the suggestions of changed neighborhoods, or of everybody.
+
+    Returns the number of users refreshed.
+    """
+    last_pivot = SuggestionPivot.objects.aggregate(Max("pk"))["pk__max"] or 0
+    if full:
+        users = list(Creator.objects.order_by("pk").values_list("pk", flat=True))
+    else:
+        pivots = set(
+            SuggestionPivot.objects.filter(pk__lte=last_pivot).values_list(
+                "creator_id", flat=True
+            )
+        )
+        users = pivots | set(
+            CreatorFollower.objects.filter(creator_id__in=pivots).values_list(
+                "follower_id", flat=True
+            )
+        )
+        users = sorted(users)
+
+    if users:
+        # Loaded after reading the pivots, so it holds every change they mark
+        offsets, targets = load_graph()
+        results = []
+        for result in compute(offsets, targets, users, workers):
+            results.append(result)
+            if len(results) >= batch_size:
+                store(results)
+                results = []
+        store(results)
+
+    SuggestionPivot.objects.filter(pk__lte=last_pivot).delete()
+    return len(users)
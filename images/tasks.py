@@ -0,0 +1,48 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.BACKGROUND_TASKS_WORKERS,
+                thread_name_prefix="images-task",
+            )
+        return _executor
+
+
+def _run(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        logger.exception("Background task %s failed", func.__name__)
+    finally:
+        # Worker threads own their connection, do not leak it between tasks
+        connection.close()
+
+
+def submit(func, *args, **kwargs):
+    """
+    Run ``func`` off the request thread, or inline if tasks are eager.
+    """
+    if settings.BACKGROUND_TASKS_EAGER:
+        return func(*args, **kwargs)
+    return get_executor().submit(_run, func, args, kwargs)
+
+
+def defer(func, *args, **kwargs):
+    """
+    Submit ``func`` once the current transaction commits.
+    """
+    transaction.on_commit(lambda: submit(func, *args, **kwargs))
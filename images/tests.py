@@ -1,3 +1,1278 @@
-from django.test import TestCase
+import asyncio
+import base64
+import io
+import json
+import math
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image as PILImage
+
+from . import (
+    activity,
+    counters,
+    derivatives,
+    events,
+    explore,
+    likefilter,
+    search,
+    suggestions,
+)
+from .authentication import issue_token, revocations
+from .autocomplete import PrefixIndex, creator_index
+from .backends.sqlite3.base import is_locked
+from .cache import LRUBackend, ObjectCache
+from .conditional import versions_etag
+from .events import DatabaseBroker
+from .feed import Timeline, backfill_followers, fan_out
+from .likebuffer import LikeBuffer
+from .metrics import QueryCollector, Registry
+from .models import (
+    Activity,
+    Blob,
+    Comment,
+    Creator,
+    ExploreScore,
+    Image,
+    ImageTag,
+    Like,
+    StreamEvent,
+    Suggestion,
+    SuggestionPivot,
+    Tag,
+    TimelineEntry,
+)
+from .serializers import (
+    CreatorRowSerializer,
+    CreatorSerializer,
+    ImageRowSerializer,
+    ImageSerializer,
+    get_cached,
+    load_comment_previews,
+    serialize_cached,
+)
+from .transactions import write_atomic
+from .writequeue import WriteQueue
+
+
+def make_cursor(position, reverse=False):
+    cursor = json.dumps({"p": position, "r": int(reverse)})
+    return base64.urlsafe_b64encode(cursor.encode("ascii")).decode("ascii")
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.creator = Creator.objects.create_user("password", username="creator")
+        self.followers = [
+            Creator.objects.create_user("password", username="follower%d" % index)
+            for index in range(5)
+        ]
+        for follower in self.followers:
+            self.creator.follow(follower)
+        self.url = "/users/creator/followers/"
+
+    def get_ids(self, response):
+        return [creator["id"] for creator in response.json()["results"]]
+
+    def test_pages_round_trip(self):
+        expected = sorted((follower.pk for follower in self.followers), reverse=True)
+        first = self.client.get(self.url, {"page_size": 2})
+        self.assertEqual(self.get_ids(first), expected[:2])
+        self.assertIsNone(first.json()["previous"])
+
+        second = self.client.get(first.json()["next"])
+        self.assertEqual(self.get_ids(second), expected[2:4])
+        third = self.client.get(second.json()["next"])
+        self.assertEqual(self.get_ids(third), expected[4:])
+        self.assertIsNone(third.json()["next"])
+
+        back = self.client.get(third.json()["previous"])
+        self.assertEqual(self.get_ids(back), expected[2:4])
+
+    def test_latest_follows_come_first(self):
+        other = Creator.objects.create_user("password", username="other")
+        for follower in reversed(self.followers):
+            other.follow(follower)
+        with self.assertNumQueries(2):
+            response = self.client.get("/users/other/followers/", {"page_size": 3})
+        expected = [follower.pk for follower in self.followers]
+        self.assertEqual(self.get_ids(response), expected[:3])
+        response = self.client.get(response.json()["next"])
+        self.assertEqual(self.get_ids(response), expected[3:])
+
+    def test_following_pages_round_trip(self):
+        follower = self.followers[0]
+        followed = [
+            Creator.objects.create_user("password", username="followed%d" % index)
+            for index in range(2)
+        ]
+        for creator in followed:
+            creator.follow(follower)
+        url = "/users/%s/following/" % follower.username
+        first = self.client.get(url, {"page_size": 2})
+        self.assertEqual(self.get_ids(first), [followed[1].pk, followed[0].pk])
+        second = self.client.get(first.json()["next"])
+        self.assertEqual(self.get_ids(second), [self.creator.pk])
+        self.assertIsNone(second.json()["next"])
+        self.assertEqual(self.client.get("/users/nobody/following/").status_code, 404)
+
+    def test_unchanged_page_is_not_modified(self):
+        first = self.client.get(self.url)
+        again = self.client.get(self.url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(again.status_code, 304)
+        self.creator.follow(Creator.objects.create_user("password", username="late"))
+        changed = self.client.get(self.url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(changed.status_code, 200)
+
+    def test_following_status_lists_the_followed_ids(self):
+        follower = self.followers[0]
+        url = "/users/following/status/"
+        ids = "%d,%d,0" % (self.creator.pk, self.followers[1].pk)
+        self.assertEqual(self.client.get(url, {"ids": ids}).status_code, 403)
+        self.client.force_login(follower)
+        response = self.client.get(url, {"ids": ids})
+        self.assertEqual(response.json(), {"following": [self.creator.pk]})
+        for ids in ("", "1,x"):
+            self.assertEqual(self.client.get(url, {"ids": ids}).status_code, 400)
+        with self.settings(KEYSET_MAX_PAGE_SIZE=2):
+            response = self.client.get(url, {"ids": "1,2,3"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_malformed_cursor_is_not_found(self):
+        for cursor in ("not-base64!", make_cursor("1"), make_cursor([1, 2, 3])):
+            response = self.client.get(self.url, {"cursor": cursor})
+            self.assertEqual(response.status_code, 404, cursor)
+
+    def test_cursor_values_are_validated(self):
+        created = str(timezone.now())
+        for position in ([created, "notanumber"], ["notadate", "1"], [None, None]):
+            response = self.client.get(self.url, {"cursor": make_cursor(position)})
+            self.assertEqual(response.status_code, 404, position)
+
+    def test_cursor_values_of_other_sources_are_validated(self):
+        self.client.force_login(self.creator)
+        for url, position in (
+            ("/images/", ["notadate", "1"]),
+            ("/images/explore/", ["notascore", "1"]),
+            ("/search/?q=x", ["notarank", "1"]),
+        ):
+            response = self.client.get(url, {"cursor": make_cursor(position)})
+            self.assertEqual(response.status_code, 404, url)
+
+
+class FeedTests(TestCase):
+    def setUp(self):
+        self.creator = Creator.objects.create_user("password", username="creator")
+        self.readers = [
+            Creator.objects.create_user("password", username="reader%d" % index)
+            for index in range(2)
+        ]
+        for reader in self.readers:
+            self.creator.follow(reader)
+
+    def feed_ids(self, reader):
+        return [image.pk for image in Timeline(reader).page(None, False, 10)]
+
+    @override_settings(FEED_FANOUT_THRESHOLD=1)
+    def test_images_stay_when_creator_drops_below_threshold(self):
+        image = Image.objects.create(
+            creator_id=self.creator, file="user_images/test.jpg", caption=""
+        )
+        fan_out(image.pk)
+        reader = self.readers[0]
+        # Above the threshold the image is pulled when the feed is read
+        self.assertEqual(self.feed_ids(reader), [image.pk])
+        self.assertFalse(TimelineEntry.objects.filter(owner=reader).exists())
+
+        with mock.patch("images.tasks.defer") as defer:
+            self.creator.unfollow(self.readers[1])
+        defer.assert_called_once_with(backfill_followers, self.creator.pk)
+        backfill_followers(self.creator.pk)
+        self.assertEqual(self.feed_ids(reader), [image.pk])
+        self.assertTrue(TimelineEntry.objects.filter(owner=reader).exists())
+
+    @override_settings(FEED_FANOUT_THRESHOLD=1)
+    def test_pushed_and_pulled_images_are_merged(self):
+        reader = self.readers[0]
+        small = Creator.objects.create_user("password", username="small")
+        small.follow(reader)
+        images = []
+        for creator in (small, self.creator, small, self.creator):
+            image = Image.objects.create(
+                creator_id=creator, file="user_images/test.jpg", caption=""
+            )
+            fan_out(image.pk)
+            images.append(image.pk)
+        # Pushed when the creator was below the threshold, pulled as well now
+        TimelineEntry.objects.create(
+            owner=reader,
+            image_id=images[1],
+            creator_id=self.creator.pk,
+            created=Image.objects.get(pk=images[1]).created,
+        )
+
+        self.assertEqual(self.feed_ids(reader), images[::-1])
+        first = Timeline(reader).page(None, False, 2)
+        position = (first[-1].created, first[-1].pk)
+        rest = Timeline(reader).page(position, False, 10)
+        self.assertEqual([image.pk for image in rest], images[1::-1])
+
+
+class CommentPreviewTests(TestCase):
+    def setUp(self):
+        self.creator = Creator.objects.create_user("password", username="commenter")
+        self.images = [
+            Image.objects.create(
+                creator_id=self.creator, file="user_images/test.jpg", caption=""
+            )
+            for _ in range(3)
+        ]
+
+    def comment(self, image, count):
+        return [
+            Comment.objects.create(message="hi", creator=self.creator, image_id=image)
+            for _ in range(count)
+        ]
+
+    @override_settings(COMMENTS_PREVIEW_SIZE=2)
+    def test_previews_are_the_newest_comments_of_each_image(self):
+        first, second = self.comment(self.images[0], 3), self.comment(self.images[1], 1)
+        with CaptureQueriesContext(connection) as queries:
+            previews = load_comment_previews(image.pk for image in self.images)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(previews[self.images[0].pk], first[:0:-1])
+        self.assertEqual(previews[self.images[1].pk], second)
+        self.assertNotIn(self.images[2].pk, previews)
+        # Each derived table has its own alias, as databases besides SQLite need
+        for index in range(3):
+            self.assertIn(
+                ") AS %s" % connection.ops.quote_name("newest%d" % index),
+                queries[0]["sql"],
+            )
+
+
+    def test_previews_are_batched_under_the_compound_select_limit(self):
+        for image in self.images:
+            self.comment(image, 1)
+        with mock.patch("images.serializers.COMMENTS_PREVIEW_BATCH_SIZE", 2):
+            with self.assertNumQueries(2):
+                previews = load_comment_previews(image.pk for image in self.images)
+        self.assertEqual(len(previews), 3)
+
+    def test_comment_count_follows_creates_and_deletes(self):
+        image = self.images[0]
+        comments = self.comment(image, 3)
+        stale = Comment.objects.get(pk=comments[0].pk)
+        comments[0].delete()
+        # Deleted already, the count is not decremented twice
+        stale.delete()
+        image.refresh_from_db()
+        self.assertEqual(image.comment_count, 2)
+        data = ImageSerializer(image).data
+        self.assertEqual(data["comment_count"], 2)
+        self.assertEqual(
+            [comment["id"] for comment in data["comments"]],
+            [comment.pk for comment in reversed(comments[1:])],
+        )
+
+
+class CommentPollingTests(TestCase):
+    def setUp(self):
+        self.creator = Creator.objects.create_user("password", username="poller")
+        self.client.force_login(self.creator)
+        self.image, other = [
+            Image.objects.create(
+                creator_id=self.creator, file="user_images/test.jpg", caption=""
+            )
+            for _ in range(2)
+        ]
+        self.comments = [self.comment(self.image) for _ in range(3)]
+        self.other = self.comment(other)
+        self.url = "/images/%d/comments/" % self.image.pk
+
+    def comment(self, image):
+        return Comment.objects.create(
+            message="hi", creator=self.creator, image_id=image
+        )
+
+    def get_ids(self, response):
+        return [comment["id"] for comment in response.json()["results"]]
+
+    def test_pages_are_newest_first_without_after(self):
+        response = self.client.get(self.url)
+        self.assertEqual(
+            self.get_ids(response), [comment.pk for comment in reversed(self.comments)]
+        )
+
+    def test_polling_returns_later_comments_oldest_first(self):
+        first = self.comments[0]
+        response = self.client.get(self.url, {"after": first.pk, "page_size": 1})
+        self.assertEqual(self.get_ids(response), [self.comments[1].pk])
+        self.assertIsNone(response.json()["previous"])
+
+        response = self.client.get(response.json()["next"])
+        self.assertEqual(self.get_ids(response), [self.comments[2].pk])
+        response = self.client.get(response.json()["next"])
+        self.assertEqual(self.get_ids(response), [])
+
+        # Nothing new keeps polling from the same comment
+        latest = self.comment(self.image)
+        response = self.client.get(response.json()["next"])
+        self.assertEqual(self.get_ids(response), [latest.pk])
+
+    def test_unknown_comments_are_not_found(self):
+        for after in ("x", self.other.pk, 0):
+            response = self.client.get(self.url, {"after": after})
+            self.assertEqual(response.status_code, 404, after)
+
+
+class TagTests(TestCase):
+    def setUp(self):
+        self.creator = Creator.objects.create_user("password", username="tagger")
+        self.client.force_login(self.creator)
+
+    def image(self, tags):
+        return Image.objects.create(
+            creator_id=self.creator, file="user_images/test.jpg", caption="", tags=tags
+        )
+
+    def counts(self):
+        counts = Tag.objects.filter(image_count__gt=0)
+        return dict(counts.values_list("name", "image_count"))
+
+    def links(self):
+        return set(ImageTag.objects.values_list("image_id", "tag__name"))
+
+    def test_saves_keep_the_links_and_counts(self):
+        image = self.image("Sun #sea sun")
+        self.assertEqual(self.links(), {(image.pk, "sun"), (image.pk, "sea")})
+        self.assertEqual(self.counts(), {"sun": 1, "sea": 1})
+
+        image.tags = "sea sky"
+        image.save()
+        self.assertEqual(self.links(), {(image.pk, "sea"), (image.pk, "sky")})
+        self.assertEqual(self.counts(), {"sea": 1, "sky": 1})
+
+        image.delete()
+        self.assertEqual(self.links(), set())
+        self.assertEqual(self.counts(), {})
+
+    def test_tag_pages_are_newest_first(self):
+        images = [self.image("sun") for _ in range(3)]
+        self.image("moon")
+        response = self.client.get("/images/tags/SUN/", {"page_size": 2})
+        ids = [image["id"] for image in response.json()["results"]]
+        self.assertEqual(ids, [images[2].pk, images[1].pk])
+        response = self.client.get(response.json()["next"])
+        ids = [image["id"] for image in response.json()["results"]]
+        self.assertEqual(ids, [images[0].pk])
+        self.assertIsNone(response.json()["next"])
+        self.assertEqual(self.client.get("/images/tags/rain/").status_code, 404)
+
+    def test_index_tags_rebuilds_links_and_counts(self):
+        kept, changed = self.image("sun"), self.image("sun sea")
+        # Written without saving, as images were before the tag index
+        Image.objects.filter(pk=changed.pk).update(tags="moon")
+        Image.objects.filter(pk=kept.pk).update(tags="sun sky")
+        call_command("index_tags", batch_size=1, stdout=io.StringIO())
+        self.assertEqual(
+            self.links(),
+            {(kept.pk, "sun"), (kept.pk, "sky"), (changed.pk, "moon")},
+        )
+        self.assertEqual(self.counts(), {"sun": 1, "sky": 1, "moon": 1})
+        created = ImageTag.objects.get(image=kept, tag__name="sky").created
+        self.assertEqual(created, kept.created)
+
+
+class AutocompleteTests(TestCase):
+    def setUp(self):
+        self.creators = [
+            Creator.objects.create_user("password", username="al%d" % index)
+            for index in range(3)
+        ]
+        creator_index.rebuild()
+
+    def ranked(self, prefix):
+        return [match[0] for match in creator_index.search(prefix)]
+
+    def test_prefixes_are_ranked_by_followers_and_cached(self):
+        index = PrefixIndex(limit=2)
+        index.load(
+            [
+                (1, "Anna", "", None, 5),
+                (2, "anton", "", None, 9),
+                (3, "andrew", "", None, 7),
+                (4, "bob", "", None, 100),
+            ]
+        )
+        self.assertEqual([match[0] for match in index.search("AN")], [2, 3])
+        self.assertEqual([match[0] for match in index.search("ann")], [1])
+        self.assertEqual(index.search(""), [])
+        self.assertEqual(set(index.top), {"a", "an", "b", "bo"})
+
+        index.add(5, "anya", "", None, 8)
+        self.assertNotIn("an", index.top)
+        self.assertIn("b", index.top)
+        self.assertEqual([match[0] for match in index.search("an")], [2, 5])
+        index.remove(2)
+        self.assertEqual([match[0] for match in index.search("an")], [5, 3])
+
+    def test_endpoint_lists_the_matches(self):
+        response = self.client.get("/users/autocomplete/", {"q": " AL1 "})
+        self.assertEqual(
+            response.json(),
+            {
+                "results": [
+                    {
+                        "id": self.creators[1].pk,
+                        "username": "al1",
+                        "name": "",
+                        "thumbnail": None,
+                    }
+                ]
+            },
+        )
+
+    @mock.patch("images.tasks.defer")
+    @mock.patch("django.db.transaction.on_commit", lambda func: func())
+    def test_follows_rerank_without_a_rebuild(self, defer):
+        first, second, third = self.creators
+        self.assertEqual(self.ranked("al")[0], first.pk)
+        # The first argument follows the creator
+        second.follow(first)
+        first.follow_many([third.pk])
+        second.follow_many([third.pk])
+        self.assertEqual(self.ranked("al"), [third.pk, second.pk, first.pk])
+        second.unfollow(first)
+        self.assertEqual(self.ranked("al"), [third.pk, first.pk, second.pk])
+
+
+class ObjectCacheTests(TestCase):
+    def setUp(self):
+        self.cache = ObjectCache(LRUBackend())
+        self.render = mock.Mock(side_effect=lambda pks: {pk: "v%d" % pk for pk in pks})
+
+    def get(self, *pks, namespace=""):
+        return self.cache.get_many("kind", list(pks), self.render, namespace)
+
+    def test_objects_are_rendered_once_until_invalidated(self):
+        self.assertEqual(self.get(1, 2), {1: "v1", 2: "v2"})
+        self.assertEqual(self.get(1, 2), {1: "v1", 2: "v2"})
+        self.render.assert_called_once_with([1, 2])
+        self.get(1, namespace="other")
+        self.render.assert_called_with([1])
+
+        self.cache.invalidate("kind", 2)
+        self.get(1, 2)
+        self.render.assert_called_with([2])
+        self.assertEqual(self.cache.get_stats(), {"kind": {"hits": 3, "misses": 4}})
+
+    def test_invalidation_is_repeated_on_commit(self):
+        self.get(1)
+        with mock.patch("django.db.transaction.on_commit") as on_commit:
+            self.cache.invalidate("kind", 1)
+        # A reader caching the rows as they were before the commit
+        self.get(1)
+        self.assertEqual(self.render.call_count, 2)
+        on_commit.call_args[0][0]()
+        self.get(1)
+        self.assertEqual(self.render.call_count, 3)
+
+    def test_lru_backend_evicts_and_expires(self):
+        backend = LRUBackend(max_entries=2)
+        backend.set_many({"a": 1, "b": 2})
+        backend.get_many(["a"])
+        backend.set_many({"c": 3})
+        self.assertEqual(backend.get_many(["a", "b", "c"]), {"a": 1, "c": 3})
+        backend.timeout = -1
+        backend.set_many({"d": 4})
+        self.assertEqual(backend.get_many(["d"]), {})
+
+    def test_writes_invalidate_served_representations(self):
+        creator = Creator.objects.create_user("password", username="cached")
+        image = Image.objects.create(
+            creator_id=creator, file="user_images/test.jpg", caption="old"
+        )
+        self.assertEqual(get_cached(CreatorRowSerializer, creator.pk)["bio"], "")
+        self.assertEqual(get_cached(ImageSerializer, image.pk)["caption"], "old")
+
+        creator.bio = "new"
+        creator.save()
+        image.caption = "new"
+        image.save()
+        Comment.objects.create(message="hi", creator=creator, image_id=image)
+        self.assertEqual(get_cached(CreatorRowSerializer, creator.pk)["bio"], "new")
+        data = get_cached(ImageSerializer, image.pk)
+        self.assertEqual((data["caption"], data["comment_count"]), ("new", 1))
+        self.assertEqual(len(data["comments"]), 1)
+
+        image_id = image.pk
+        image.delete()
+        self.assertIsNone(get_cached(ImageSerializer, image_id))
+
+
+@mock.patch("images.tasks.defer")
+class ExploreTests(TestCase):
+    def setUp(self):
+        self.creators = [
+            Creator.objects.create_user("password", username="explorer%d" % index)
+            for index in range(3)
+        ]
+        self.images = [
+            Image.objects.create(
+                creator_id=creator, file="user_images/test.jpg", caption=""
+            )
+            for creator in self.creators[:2]
+        ]
+
+    def scores(self, kind):
+        scores = ExploreScore.objects.filter(kind=kind).order_by("-score")
+        return dict(scores.values_list("object_id", "score"))
+
+    def test_update_adds_each_new_row_once(self, defer):
+        first, second, third = self.creators
+        for person in self.creators:
+            Like(image=self.images[1], person=person).save()
+        third.follow(first)
+
+        self.assertEqual(
+            explore.update(batch_size=2), {"likes": 3, "follows": 1, "posts": 2}
+        )
+        scores = self.scores("image")
+        self.assertEqual(list(scores), [self.images[1].pk, self.images[0].pk])
+        # Three likes and a post outweigh a follow, which outweighs a post
+        self.assertEqual(
+            list(self.scores("creator")), [second.pk, third.pk, first.pk]
+        )
+
+        self.assertEqual(explore.update(), {"likes": 0, "follows": 0, "posts": 0})
+        self.assertEqual(self.scores("image"), scores)
+
+    def test_scores_are_the_log_of_the_decayed_weights(self, defer):
+        image = self.images[0]
+        like = Like.objects.create(image=image, person=self.creators[1])
+        explore.update()
+        posted, liked = [
+            (moment - explore.EPOCH).total_seconds() / settings.EXPLORE_HALF_LIFE
+            for moment in (image.created, like.created)
+        ]
+        weights = settings.EXPLORE_WEIGHTS
+        # log(post * 2 ** posted + like * 2 ** liked), factoring out 2 ** posted
+        expected = posted * math.log(2) + math.log(
+            weights["post"] + weights["like"] * 2 ** (liked - posted)
+        )
+        self.assertAlmostEqual(self.scores("image")[image.pk], expected)
+
+    def test_prune_drops_decayed_scores(self, defer):
+        explore.update()
+        self.assertEqual(explore.prune(), 0)
+        later = timezone.now() + timedelta(days=30)
+        self.assertEqual(explore.prune(later), 4)
+        self.assertFalse(ExploreScore.objects.exists())
+
+    def test_explore_pages_rank_by_score(self, defer):
+        Like.objects.create(image=self.images[1], person=self.creators[0])
+        explore.update()
+        self.client.force_login(self.creators[0])
+        response = self.client.get("/images/explore/")
+        ids = [image["id"] for image in response.json()["results"]]
+        self.assertEqual(ids, [self.images[1].pk, self.images[0].pk])
+
+
+@mock.patch("images.tasks.defer")
+class SuggestionTests(TestCase):
+    def setUp(self):
+        self.users = {
+            name: Creator.objects.create_user("password", username=name)
+            for name in "abcde"
+        }
+        for follower, followed in ("ab", "ac", "bd", "cd", "ce"):
+            self.follow(follower, followed)
+
+    def follow(self, follower, followed):
+        self.users[followed].follow(self.users[follower])
+
+    def suggested(self, name):
+        suggestions = Suggestion.objects.filter(owner=self.users[name])
+        return list(
+            suggestions.order_by("-score", "suggested__username").values_list(
+                "suggested__username", "score"
+            )
+        )
+
+    def test_full_refresh_scores_friends_of_friends(self, defer):
+        self.assertEqual(suggestions.refresh(full=True, workers=1), 5)
+        self.assertEqual(self.suggested("a"), [("d", 2), ("e", 1)])
+        self.assertEqual(self.suggested("b"), [])
+        self.assertFalse(SuggestionPivot.objects.exists())
+
+    def test_incremental_refresh_recomputes_changed_neighborhoods(self, defer):
+        suggestions.refresh(full=True, workers=1)
+        self.follow("b", "e")
+        # b changed, and a follows b
+        self.assertEqual(suggestions.refresh(workers=1), 2)
+        self.assertEqual(self.suggested("a"), [("d", 2), ("e", 2)])
+        self.assertEqual(suggestions.refresh(workers=1), 0)
+
+    def test_followed_suggestions_are_not_listed(self, defer):
+        suggestions.refresh(full=True, workers=1)
+        self.follow("a", "d")
+        self.client.force_login(self.users["a"])
+        response = self.client.get("/users/suggestions/")
+        results = [
+            (result["user"]["username"], result["mutual_count"])
+            for result in response.json()["results"]
+        ]
+        self.assertEqual(results, [("e", 1)])
+
+
+class CounterTests(TestCase):
+    def setUp(self):
+        self.creator = Creator.objects.create_user("password", username="creator")
+        self.image = Image.objects.create(
+            creator_id=self.creator, file="user_images/test.jpg", caption=""
+        )
+
+    def get_value(self, field):
+        return counters.get_value(Image.objects.get(pk=self.image.pk), field)
+
+    def test_like_count_follows_likes(self):
+        likers = [
+            Creator.objects.create_user("password", username="liker%d" % index)
+            for index in range(3)
+        ]
+        likes = [Like(image=self.image, person=liker) for liker in likers]
+        for like in likes:
+            like.save()
+        self.assertEqual(self.get_value("like_count"), 3)
+
+        stale = Like.objects.get(pk=likes[0].pk)
+        likes[0].delete()
+        stale.delete()
+        self.assertEqual(self.get_value("like_count"), 2)
+        self.assertEqual(self.get_value("like_count"), self.image.like_set.count())
+
+    def test_increment_many_applies_shard_deltas_in_bulk(self):
+        images = [self.image] + [
+            Image.objects.create(
+                creator_id=self.creator, file="user_images/test.jpg", caption=""
+            )
+            for _index in range(3)
+        ]
+        deltas = {images[0].pk: 2, images[1].pk: 2, images[2].pk: -1, images[3].pk: 0}
+        with self.assertNumQueries(3):
+            counters.increment_many(Image, "like_count", deltas)
+        counters.increment_many(Image, "like_count", deltas)
+        totals = counters.get_shard_totals(Image, "like_count", list(deltas))
+        expected = {pk: 2 * delta for pk, delta in deltas.items() if delta}
+        self.assertEqual(totals, expected)
+
+    def test_comment_count_follows_comments(self):
+        comment = Comment(message="hi", creator=self.creator, image_id=self.image)
+        comment.save()
+        comment.save()
+        self.assertEqual(self.get_value("comment_count"), 1)
+
+        stale = Comment.objects.get(pk=comment.pk)
+        comment.delete()
+        stale.delete()
+        self.assertEqual(self.get_value("comment_count"), 0)
+
+    def test_reconciled_counts_are_served(self):
+        Image.objects.filter(pk=self.image.pk).update(like_count=5)
+        self.assertEqual(get_cached(ImageSerializer, self.image.pk)["like_count"], 5)
+        call_command("reconcile_counters", stdout=io.StringIO())
+        self.assertEqual(get_cached(ImageSerializer, self.image.pk)["like_count"], 0)
+
+
+@mock.patch.object(LikeBuffer, "start")
+class LikeBufferTests(TestCase):
+    def setUp(self):
+        self.creator = Creator.objects.create_user("password", username="creator")
+        self.image = Image.objects.create(
+            creator_id=self.creator, file="user_images/test.jpg", caption=""
+        )
+        self.buffer = LikeBuffer()
+
+    def is_liked(self):
+        return Like.objects.filter(image=self.image, person=self.creator).exists()
+
+    def test_flush_applies_the_last_intent(self, start):
+        self.buffer.record(self.image.pk, self.creator.pk, True)
+        self.buffer.record(self.image.pk, self.creator.pk, False)
+        self.buffer.record(self.image.pk, self.creator.pk, True)
+        deltas = self.buffer.get_like_deltas([self.image.pk])
+        self.assertEqual(deltas, {self.image.pk: 1})
+        self.assertFalse(self.is_liked())
+
+        self.buffer.flush()
+        self.assertTrue(self.is_liked())
+        self.assertEqual(counters.get_value(Image.objects.get(), "like_count"), 1)
+        self.assertEqual(self.buffer.entries(), {})
+
+    def test_failed_flush_keeps_intents(self, start):
+        self.buffer.record(self.image.pk, self.creator.pk, True)
+        with mock.patch("images.likebuffer.apply", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.buffer.flush()
+        self.assertFalse(self.is_liked())
+        self.assertTrue(self.buffer.is_liked(self.image.pk, self.creator.pk))
+
+        self.buffer.flush()
+        self.assertTrue(self.is_liked())
+
+    def test_failed_flush_keeps_newer_intents(self, start):
+        key = (self.image.pk, self.creator.pk)
+        self.buffer.record(*key, True)
+
+        def apply(entries):
+            # Recorded while the flush runs
+            self.buffer.record(*key, False)
+            self.buffer.record(*key, True)
+            raise RuntimeError
+
+        with mock.patch("images.likebuffer.apply", side_effect=apply):
+            with self.assertRaises(RuntimeError):
+                self.buffer.flush()
+        self.assertEqual(self.buffer.entries(), {key: (True, False)})
+        deltas = self.buffer.get_like_deltas([self.image.pk])
+        self.assertEqual(deltas, {self.image.pk: 1})
+
+
+def make_picture(color="red", **save_options):
+    output = io.BytesIO()
+    PILImage.new("RGB", (40, 30), color).save(output, "JPEG", **save_options)
+    return output.getvalue()
+
+
+def use_temporary_media(test):
+    """
+    Store the uploads of ``test`` in a temporary MEDIA_ROOT, making variants
+    in a single thread.
+    """
+    media_root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, media_root)
+    settings = override_settings(MEDIA_ROOT=media_root)
+    settings.enable()
+    test.addCleanup(settings.disable)
+    pool = ThreadPoolExecutor(1)
+    test.addCleanup(pool.shutdown)
+    patcher = mock.patch("images.derivatives.get_pool", return_value=pool)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+class VariantTests(TestCase):
+    def setUp(self):
+        use_temporary_media(self)
+        self.creator = Creator.objects.create_user("password", username="creator")
+        self.image = Image(creator_id=self.creator, caption="")
+        self.image.file.save("test.jpg", ContentFile(make_picture()), save=False)
+        self.image.save()
+
+    def process(self, force=False):
+        derivatives.process(Image, self.image.pk, "file", "variants", force)
+        return Image.objects.get(pk=self.image.pk)
+
+    def test_variants_are_stored_once(self):
+        image = self.process()
+        names = image.get_file_names()
+        self.assertEqual(len(names), 1 + len(derivatives.stored_names(image.variants)))
+        self.assertEqual(self.process().variants, image.variants)
+
+        self.process(force=True)
+        refcounts = dict(Blob.objects.values_list("name", "refcount"))
+        self.assertEqual(refcounts, {name: 1 for name in names})
+
+    @mock.patch("images.tasks.defer")
+    def test_replaced_upload_is_released(self, defer):
+        first = self.image.file.name
+        self.image.file = ContentFile(make_picture("blue"), name="other.jpg")
+        with mock.patch("django.db.transaction.on_commit", lambda func: func()):
+            self.image.save()
+        refcounts = dict(Blob.objects.values_list("name", "refcount"))
+        self.assertEqual(refcounts, {first: 0, self.image.file.name: 1})
+
+    def test_replaced_profile_variants_are_deleted(self):
+        self.creator.profile_image.save("profile.jpg", ContentFile(make_picture()))
+
+        def process():
+            derivatives.process(
+                Creator,
+                self.creator.pk,
+                "profile_image",
+                "profile_image_variants",
+                force=True,
+            )
+            variants = Creator.objects.get(pk=self.creator.pk).profile_image_variants
+            return derivatives.stored_names(variants)
+
+        first = process()
+        second = process()
+        storage = self.creator.profile_image.storage
+        self.assertFalse(any(storage.exists(name) for name in first))
+        self.assertTrue(all(storage.exists(name) for name in second))
+
+    def test_uploads_are_stored_without_exif(self):
+        exif = PILImage.Exif()
+        exif[0x010F] = "Camera"
+        exif[0x0112] = 6  # Rotated 90 degrees
+        image = Image(
+            creator_id=self.creator,
+            caption="",
+            file=ContentFile(make_picture(exif=exif.tobytes()), name="exif.jpg"),
+        )
+        image.save()
+        with image.file.open("rb") as stored, PILImage.open(stored) as picture:
+            self.assertNotIn("exif", picture.info)
+            self.assertEqual(picture.size, (30, 40))
+
+
+class SerializerParityTests(TestCase):
+    def setUp(self):
+        use_temporary_media(self)
+        self.request = RequestFactory().get("/")
+        self.creator = Creator.objects.create_user(
+            "password", username="parity", bio="bio", website="https://example.com"
+        )
+        self.creator.profile_image.save("profile.jpg", ContentFile(make_picture()))
+        self.image = Image(creator_id=self.creator, caption="caption", tags="a b")
+        self.image.file.save("test.jpg", ContentFile(make_picture()), save=False)
+        self.image.save()
+        derivatives.process(Image, self.image.pk, "file", "variants")
+        derivatives.process(
+            Creator, self.creator.pk, "profile_image", "profile_image_variants"
+        )
+
+    def assertSameRepresentation(self, row, model):
+        self.assertEqual(list(row), list(model))
+        self.assertEqual(json.loads(json.dumps(row)), json.loads(json.dumps(model)))
+
+    def test_creator_rows_match_the_model_serializer(self):
+        creator = Creator.objects.get(pk=self.creator.pk)
+        self.assertTrue(creator.profile_image_variants)
+        row = CreatorRowSerializer(self.request).load([creator.pk])[creator.pk]
+        model = CreatorSerializer(creator, context={"request": self.request}).data
+        self.assertSameRepresentation(row, model)
+
+    def test_image_rows_match_the_model_serializer(self):
+        Comment.objects.create(message="hi", creator=self.creator, image_id=self.image)
+        Like(image=self.image, person=self.creator).save()
+        image = Image.objects.get(pk=self.image.pk)
+        self.assertTrue(image.variants)
+        row = ImageRowSerializer(self.request).load([image.pk])[image.pk]
+        context = {"request": self.request, "shared": True}
+        model = ImageSerializer(image, context=context).data
+        self.assertSameRepresentation(row, model)
+        self.assertEqual((row["like_count"], len(row["comments"])), (1, 1))
+
+
+class ConditionalTests(TestCase):
+    def setUp(self):
+        self.creator = Creator.objects.create_user("password", username="creator")
+        self.image = Image.objects.create(
+            creator_id=self.creator, file="user_images/test.jpg", caption=""
+        )
+
+    def test_profile_etag_follows_stored_state(self):
+        self.client.force_login(self.creator)
+        etag = self.client.get("/users/creator/")["ETag"]
+        response = self.client.get("/users/creator/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.creator.bio = "changed"
+        self.creator.save()
+        changed = self.client.get("/users/creator/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+
+        follower = Creator.objects.create_user("password", username="follower")
+        self.creator.follow(follower)
+        followed = self.client.get(
+            "/users/creator/", HTTP_IF_NONE_MATCH=changed["ETag"]
+        )
+        self.assertEqual(followed.status_code, 200)
+
+    def test_image_etag_follows_likes_and_comments(self):
+        etags = [versions_etag(Image, [self.image.pk])]
+        Like(image=self.image, person=self.creator).save()
+        etags.append(versions_etag(Image, [self.image.pk]))
+        comment = Comment(message="hi", creator=self.creator, image_id=self.image)
+        comment.save()
+        etags.append(versions_etag(Image, [self.image.pk]))
+        comment.message = "edited"
+        comment.save()
+        etags.append(versions_etag(Image, [self.image.pk]))
+        self.assertEqual(len(set(etags)), len(etags))
+        self.assertEqual(versions_etag(Image, [self.image.pk]), etags[-1])
+
+
+class LikedByMeTests(TestCase):
+    def setUp(self):
+        creator = Creator.objects.create_user("password", username="creator")
+        viewer = Creator.objects.create_user("password", username="viewer")
+        self.images = [
+            Image.objects.create(
+                creator_id=creator, file="user_images/test.jpg", caption=""
+            )
+            for _ in range(2)
+        ]
+        # Ids are reused between tests, filters of earlier ones are stale
+        likefilter.invalidate(viewer.pk)
+        Like(image=self.images[0], person=viewer).save()
+        self.request = RequestFactory().get("/")
+        self.request.user = viewer
+        self.viewer = viewer
+
+    def liked(self):
+        image_ids = [image.pk for image in self.images]
+        return likefilter.liked_image_ids(self.viewer, image_ids)
+
+    def test_flag_is_filled_for_the_viewer(self):
+        data = ImageSerializer(
+            self.images, many=True, context={"request": self.request}
+        ).data
+        self.assertEqual([image["liked_by_me"] for image in data], [True, False])
+
+    def test_likes_are_added_to_the_filter_in_place(self):
+        self.assertEqual(self.liked(), {self.images[0].pk})
+        Like(image=self.images[1], person=self.viewer).save()
+        # Only the query checking the candidates
+        with self.assertNumQueries(1):
+            self.assertEqual(self.liked(), {image.pk for image in self.images})
+
+    def test_filters_are_rebuilt_after_unlikes_and_other_processes(self):
+        self.liked()
+        Like.objects.get(image=self.images[0], person=self.viewer).delete()
+        self.assertEqual(self.liked(), set())
+
+        self.liked()
+        # A like made through another process, which moves the version on
+        Like.objects.bulk_create([Like(image=self.images[1], person=self.viewer)])
+        likefilter.object_cache.bump(likefilter.KIND, self.viewer.pk)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.liked(), {self.images[1].pk})
+
+    def test_cached_representations_leave_the_flag_out(self):
+        data = serialize_cached(ImageSerializer, self.images, self.request)
+        self.assertNotIn("liked_by_me", data[0])
+
+
+class MetricsTests(TestCase):
+    def test_metrics_need_staff_or_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        with self.settings(METRICS_TOKEN="secret"):
+            scraped = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+            self.assertEqual(scraped.status_code, 200)
+            guessed = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer guess")
+            self.assertEqual(guessed.status_code, 403)
+
+        staff = Creator.objects.create_superuser("password", username="staff")
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
+
+    def test_concurrent_flushes_write_whole_files(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        registry = Registry()
+        registry.observe("images/", "GET", 200, 0.01, QueryCollector(), 10)
+        with self.settings(METRICS_DIR=directory):
+            with ThreadPoolExecutor(4) as pool:
+                list(pool.map(lambda _: registry.flush(), range(20)))
+            (name,) = os.listdir(directory)
+            self.assertEqual(name, os.path.basename(registry.get_path()))
+            self.assertEqual(registry.collect()["images/"]["GET"]["requests"], 1)
+
+    def test_serialization_is_timed(self):
+        creator = Creator.objects.create_user("password", username="creator")
+        image = Image.objects.create(
+            creator_id=creator, file="user_images/test.jpg", caption=""
+        )
+        request = RequestFactory().get("/")
+        request.user = creator
+        request.metrics_collector = QueryCollector()
+        ImageSerializer(image, context={"request": request}).data
+        self.assertGreater(request.metrics_collector.serialize_seconds, 0)
+
+
+class SignedTokenTests(TestCase):
+    def setUp(self):
+        self.creator = Creator.objects.create_user("password", username="creator")
+
+    def get(self, token):
+        # 403 rather than 401, as the session comes first in API_AUTHENTICATION
+        return self.client.get("/activity/", HTTP_AUTHORIZATION="Bearer %s" % token)
+
+    def test_token_authenticates(self):
+        token, _expires = issue_token(self.creator)
+        self.assertEqual(self.get(token).status_code, 200)
+        self.assertEqual(self.get(token[:-2] + "xx").status_code, 403)
+
+    def test_expired_token_is_refused(self):
+        token, _expires = issue_token(self.creator, lifetime=-1)
+        self.assertEqual(self.get(token).json()["detail"], "Token has expired.")
+
+    def test_zero_lifetime_is_not_the_default(self):
+        _token, expires = issue_token(self.creator, lifetime=0)
+        self.assertLessEqual(expires, time.time())
+
+    def test_revoked_token_is_refused(self):
+        token, _expires = issue_token(self.creator)
+        response = self.client.post(
+            "/users/token/revoke/", HTTP_AUTHORIZATION="Bearer %s" % token
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(token).json()["detail"], "Token has been revoked.")
+
+        # Also once the revocations are loaded from the database again
+        revocations.refresh()
+        self.assertEqual(self.get(token).status_code, 403)
+
+    def test_password_change_invalidates_tokens(self):
+        token, _expires = issue_token(self.creator)
+        self.creator.set_password("changed")
+        self.creator.save()
+        self.assertEqual(self.get(token).status_code, 403)
+
+    def test_tokens_are_only_issued_for_primary_credentials(self):
+        token, _expires = issue_token(self.creator)
+        response = self.client.post(
+            "/users/token/", HTTP_AUTHORIZATION="Bearer %s" % token
+        )
+        self.assertIn(response.status_code, (401, 403))
+
+        self.client.force_login(self.creator)
+        issued = self.client.post("/users/token/").json()["token"]
+        self.assertEqual(self.get(issued).status_code, 200)
+
+
+class DatabaseBrokerTests(TestCase):
+    @mock.patch("django.db.transaction.on_commit", lambda func: func())
+    def test_events_are_only_published_when_enabled(self):
+        with mock.patch.object(events.broker, "publish") as publish:
+            events.publish(("user:1", "like", {}))
+            publish.assert_not_called()
+            with self.settings(EVENTS_ENABLED=True):
+                events.publish(("user:1", "like", {}))
+            publish.assert_called_once_with((("user:1", "like", {}),))
+
+    def test_publish_purges_expired_events(self):
+        broker = DatabaseBroker()
+        broker.publish([("user:1", "like", {}), ("user:1", "follow", {})])
+        StreamEvent.objects.update(created=timezone.now() - timedelta(days=1))
+        # Purged at most once per retention period
+        broker.publish([])
+        self.assertEqual(StreamEvent.objects.count(), 2)
+
+        broker.purged -= settings.EVENTS_RETENTION + 1
+        broker.publish([("user:1", "comment", {})])
+        self.assertEqual(
+            list(StreamEvent.objects.values_list("kind", flat=True)), ["comment"]
+        )
+
+    @override_settings(EVENTS_POLL_INTERVAL=0)
+    def test_polling_survives_errors(self):
+        broker = DatabaseBroker()
+        event = (5, "user:1", "like", {})
+        hub = mock.Mock()
+
+        async def run():
+            task = asyncio.ensure_future(broker.run(hub))
+            while not hub.dispatch.called:
+                await asyncio.sleep(0)
+            task.cancel()
+
+        polls = [RuntimeError("database is locked"), (5, [event])]
+        with mock.patch.object(broker, "poll", side_effect=polls):
+            with self.assertLogs("images.events", "ERROR"):
+                asyncio.run(run())
+        hub.dispatch.assert_called_once_with([event])
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.backend = search.get_backend()
+        self.creator = Creator.objects.create_user("password", username="searcher")
+
+    def image(self, caption):
+        return Image.objects.create(
+            creator_id=self.creator, file="user_images/test.jpg", caption=caption
+        )
+
+    def matches(self, query):
+        ranked = self.backend.search("images", query, None, False, 10)
+        return [pk for pk, _rank in ranked]
+
+    def get_ids(self, response):
+        return [result["id"] for result in response.json()["results"]]
+
+    def test_pages_follow_the_ranking_across_cursors(self):
+        for caption in ("sunset beach", "sunset", "sunset sunset sea", "sunny day"):
+            self.image(caption)
+        self.image("harbour")
+        ranked = self.matches("suns")
+        self.assertEqual(len(ranked), 3)
+
+        self.client.force_login(self.creator)
+        first = self.client.get("/search/", {"q": "Suns", "page_size": 2})
+        self.assertEqual(self.get_ids(first), ranked[:2])
+        second = self.client.get(first.json()["next"])
+        self.assertEqual(self.get_ids(second), ranked[2:])
+        self.assertIsNone(second.json()["next"])
+        back = self.client.get(second.json()["previous"])
+        self.assertEqual(self.get_ids(back), ranked[:2])
+
+    def test_index_follows_saves_and_deletes(self):
+        image = self.image("sunset")
+        image.caption = "harbour"
+        image.save()
+        self.assertEqual(self.matches("sunset"), [])
+        self.assertEqual(self.matches("harbour"), [image.pk])
+        image.delete()
+        self.assertEqual(self.matches("harbour"), [])
+
+    def test_users_are_searched_by_profile(self):
+        self.client.force_login(self.creator)
+        response = self.client.get("/search/", {"q": "search", "type": "users"})
+        self.assertEqual(self.get_ids(response), [self.creator.pk])
+        response = self.client.get("/search/", {"q": "x", "type": "tags"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get("/search/", {"q": "!"})
+        self.assertEqual(self.get_ids(response), [])
+
+    def test_rebuild_replaces_the_index_batch_by_batch(self):
+        images = [self.image("sunset %d" % i) for i in range(3)]
+        self.backend.clear("images")
+        self.backend.index("images", [Image(pk=images[-1].pk + 1, caption="sunset")])
+        with mock.patch(
+            "images.management.commands.rebuild_search_index.write_atomic",
+            wraps=write_atomic,
+        ) as atomic:
+            call_command("rebuild_search_index", batch_size=2, stdout=io.StringIO())
+        # A transaction per batch and one to find the end, for each kind
+        self.assertEqual(atomic.call_count, 3 + 2)
+        self.assertCountEqual(self.matches("sunset"), [image.pk for image in images])
+
+
+class ActivityTests(TestCase):
+    def setUp(self):
+        self.owner = Creator.objects.create_user("password", username="owner")
+        self.actors = [
+            Creator.objects.create_user("password", username="actor%d" % index)
+            for index in range(3)
+        ]
+        self.image = Image.objects.create(
+            creator_id=self.owner, file="user_images/test.jpg", caption=""
+        )
+
+    def like(self, *actors):
+        activity.write(
+            [(self.owner.pk, "like", actor.pk, self.image.pk) for actor in actors]
+        )
+
+    def rows(self):
+        return list(
+            Activity.objects.filter(recipient=self.owner)
+            .order_by("id")
+            .values_list("kind", "actor_id", "actor_count")
+        )
+
+    def unread_count(self):
+        return Creator.objects.get(pk=self.owner.pk).unread_activity_count
+
+    def test_actions_are_aggregated_per_kind_and_image(self):
+        self.like(self.actors[0], self.actors[1])
+        self.like(self.actors[2])
+        activity.write([(self.owner.pk, "follow", self.actors[0].pk, None)])
+        self.assertEqual(
+            self.rows(),
+            [("like", self.actors[2].pk, 3), ("follow", self.actors[0].pk, 1)],
+        )
+        self.assertEqual(self.unread_count(), 2)
+
+    def test_repeated_actors_are_counted_once(self):
+        self.like(self.actors[0])
+        self.like(self.actors[1])
+        self.like(self.actors[0], self.actors[0])
+        self.assertEqual(self.rows(), [("like", self.actors[1].pk, 2)])
+
+    def test_read_rows_are_not_changed(self):
+        self.like(self.actors[0])
+        activity.mark_read(self.owner.pk)
+        self.like(self.actors[1])
+        self.assertEqual(
+            self.rows(),
+            [("like", self.actors[0].pk, 1), ("like", self.actors[1].pk, 1)],
+        )
+        self.assertEqual(self.unread_count(), 1)
+
+    def test_activity_leaves_the_profile_version(self):
+        version = Creator.objects.get(pk=self.owner.pk).version
+        self.like(self.actors[0])
+        activity.mark_read(self.owner.pk)
+        self.assertEqual(Creator.objects.get(pk=self.owner.pk).version, version)
+
+
+class WriteTransactionTests(TransactionTestCase):
+    def test_only_write_blocks_begin_immediate(self):
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                Creator.objects.count()
+            with write_atomic():
+                with write_atomic():
+                    Creator.objects.count()
+        begins = [query["sql"] for query in queries if query["sql"].startswith("BEGIN")]
+        self.assertEqual(begins, ["BEGIN", "BEGIN IMMEDIATE"])
+
+    def test_only_busy_errors_are_locks(self):
+        self.assertTrue(is_locked(OperationalError("database is locked")))
+        self.assertFalse(is_locked(OperationalError("database table is locked")))
+        self.assertFalse(is_locked(OperationalError("no such table: locked")))
+
+        busy = sqlite3.OperationalError("database is locked")
+        # SQLITE_BUSY_SNAPSHOT, an extended code of SQLITE_BUSY
+        busy.sqlite_errorcode = 517
+        error = OperationalError(*busy.args)
+        error.__cause__ = busy
+        self.assertTrue(is_locked(error))
+
+
+@override_settings(SQLITE_WRITE_QUEUE=True)
+@mock.patch("images.tasks.submit")
+class WriteQueueTests(TransactionTestCase):
+    def test_failed_call_only_rolls_back_its_own_writes(self, submit):
+        queue = WriteQueue()
+
+        def fail():
+            Creator.objects.create_user("password", username="rolled-back")
+            raise ValueError("failed")
+
+        with ThreadPoolExecutor(2) as pool:
+            created = pool.submit(
+                queue.run, Creator.objects.create_user, "password", username="kept"
+            )
+            failed = pool.submit(queue.run, fail)
+            self.assertEqual(created.result().username, "kept")
+            with self.assertRaises(ValueError):
+                failed.result()
+        self.assertTrue(Creator.objects.filter(username="kept").exists())
+        self.assertFalse(Creator.objects.filter(username="rolled-back").exists())
+
+    def test_calls_in_atomic_blocks_run_in_the_caller(self, submit):
+        queue = WriteQueue()
+        with transaction.atomic():
+            queue.run(Creator.objects.create_user, "password", username="inline")
+        self.assertIsNone(queue.writer)
+        self.assertTrue(Creator.objects.filter(username="inline").exists())
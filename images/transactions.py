@@ -0,0 +1,35 @@
+"""
+Atomic blocks that write.
+
+SQLite lets one transaction write at a time. A transaction that begins with a
+deferred ``BEGIN`` and reads before it writes fails with "database is locked"
+without waiting when another process committed in between, so the blocks of
+this project that write use ``write_atomic`` instead of
+``transaction.atomic``: on ``images.backends.sqlite3`` the transaction it
+begins takes the write lock up front with ``BEGIN IMMEDIATE``. Read-only
+blocks keep a deferred ``BEGIN`` and run alongside the writer. Other backends
+get a plain atomic block.
+"""
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+
+class WriteAtomic(transaction.Atomic):
+    def __enter__(self):
+        connection = transaction.get_connection(self.using)
+        if connection.in_atomic_block:
+            # Nested, the transaction has begun already
+            return super(WriteAtomic, self).__enter__()
+        connection.begin_immediate = True
+        try:
+            return super(WriteAtomic, self).__enter__()
+        finally:
+            connection.begin_immediate = False
+
+
+def write_atomic(using=None, savepoint=True):
+    """
+    ``transaction.atomic`` for blocks that write, usable the same ways.
+    """
+    if callable(using):
+        return WriteAtomic(DEFAULT_DB_ALIAS, savepoint)(using)
+    return WriteAtomic(using, savepoint)
@@ -1,19 +1,67 @@
 from functools import partial
 
+from django.conf import settings
 from django.contrib.auth import authenticate, login
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
+from oauth2_provider.contrib.rest_framework import OAuth2Authentication
 from rest_framework import status, viewsets
-from rest_framework.authentication import SessionAuthentication
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.authentication import BasicAuthentication, SessionAuthentication
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from .activity import mark_read
+from .authentication import SignedTokenAuthentication, issue_token, revocations
+from .autocomplete import creator_index
+from .cache import object_cache
+from .conditional import conditional, page_etag, state_etag, versions_etag
+from .feed import Timeline
 from .filters import CreatorFilter, ImageFilter
-from .models import Comment, Creator, Image, Like
+from .likebuffer import apply as apply_likes
+from .likebuffer import like_buffer
+from .models import (
+    Activity,
+    Comment,
+    Creator,
+    CreatorFollower,
+    ExploreScore,
+    Image,
+    ImageTag,
+    Like,
+    Suggestion,
+    Tag,
+)
+from .pagination import (
+    ActivityPagination,
+    CommentPagination,
+    ExplorePagination,
+    FeedPagination,
+    FollowPagination,
+    LikePagination,
+    SearchPagination,
+    TagPagination,
+)
 from .permissions import CanEditOnlyItself
-from .serializers import CommentSerializer, CreatorSerializer, ImageSerializer, LikeSerializer
+from .search import SearchResults
+from .serializers import (
+    ActivitySerializer,
+    CommentSerializer,
+    CreatorRowSerializer,
+    CreatorSerializer,
+    FollowRowSerializer,
+    ImageRowSerializer,
+    ImageSerializer,
+    LikerRowSerializer,
+    LikeSerializer,
+    add_liked_by_me,
+    get_cached,
+    get_cached_many,
+    serialize_cached,
+)
+from .transactions import write_atomic
 
 
 class CsrfExemptSessionAuthentication(SessionAuthentication):
@@ -21,30 +69,49 @@ class CsrfExemptSessionAuthentication(SessionAuthentication):
         return None
 
 
-class CreatorViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Creator.objects.all()
-    serializer_class = CreatorSerializer
-    authentication_classes = (CsrfExemptSessionAuthentication,)
+API_AUTHENTICATION = (CsrfExemptSessionAuthentication, SignedTokenAuthentication)
 
 
 class CreateNewUser(viewsets.ModelViewSet):
     queryset = Creator.objects.all()
     serializer_class = CreatorSerializer
-    authentication_classes = (CsrfExemptSessionAuthentication,)
+    authentication_classes = API_AUTHENTICATION
 
 
 class CreatorSearch(viewsets.ModelViewSet):
     queryset = Creator.objects.all()
     serializer_class = CreatorSerializer
     filter_class = CreatorFilter
-    authentication_classes = (CsrfExemptSessionAuthentication,)
+    authentication_classes = API_AUTHENTICATION
+
+    def list(self, request, *args, **kwargs):
+        creators = self.filter_queryset(self.get_queryset())
+        return Response(CreatorRowSerializer(request).serialize(creators))
+
+
+class CreatorAutocomplete(APIView):
+    authentication_classes = API_AUTHENTICATION
+
+    def get(self, request, *args, **kwargs):
+        """
+        Suggest users whose username starts with ?q=, most followed first
+        """
+        matches = creator_index.search(request.query_params.get("q", "").strip())
+        return Response(
+            {
+                "results": [
+                    {"id": pk, "username": username, "name": name, "thumbnail": thumb}
+                    for pk, username, name, thumb in matches
+                ]
+            }
+        )
 
 
 class CreatorView(APIView):
     serializer_class = CreatorSerializer
     queryset = Creator.objects.all()
     lookup_url_kwarg = "username"
-    authentication_classes = (CsrfExemptSessionAuthentication,)
+    authentication_classes = API_AUTHENTICATION
     permission_classes = (partial(CanEditOnlyItself, ["PUT"]),)
 
     def get_object(self, username):
@@ -56,10 +123,19 @@ class CreatorView(APIView):
     def get(self, request, *args, **kwargs):
         username = kwargs.get("username")
 
-        creator = self.get_object(username)
+        creator_id = (
+            self.queryset.filter(username=username).values_list("pk", flat=True).first()
+        )
+        if creator_id is None:
+            raise Http404
 
-        creator_serialized = CreatorSerializer(creator).data
-        return Response(creator_serialized)
+        def render():
+            creator_serialized = get_cached(CreatorSerializer, creator_id)
+            if creator_serialized is None:
+                raise Http404
+            return Response(creator_serialized)
+
+        return conditional(request, versions_etag(Creator, [creator_id]), render)
 
     def put(self, request, *args, **kwargs):
         username = kwargs.get("username")
@@ -75,7 +151,7 @@ class CreatorView(APIView):
 
 class FollowView(APIView):
     object_manager = Creator.objects
-    authentication_classes = (CsrfExemptSessionAuthentication,)
+    authentication_classes = API_AUTHENTICATION
     permission_classes = (IsAuthenticated,)
 
     def get_object(self, o_id):
@@ -96,7 +172,7 @@ class FollowView(APIView):
 
 class UnFollowView(APIView):
     object_manager = Creator.objects
-    authentication_classes = (CsrfExemptSessionAuthentication,)
+    authentication_classes = API_AUTHENTICATION
     permission_classes = (IsAuthenticated,)
 
     def get_object(self, o_id):
@@ -115,63 +191,189 @@ class UnFollowView(APIView):
         return Response({"status": "ok"})
 
 
-class FollowersList(APIView):
-    authentication_classes = (CsrfExemptSessionAuthentication,)
-    serializer_class = CreatorSerializer
+class FollowList(APIView):
+    """
+    One side of the follows of a creator, paged over ``CreatorFollower``.
+    """
+
+    authentication_classes = API_AUTHENTICATION
+    pagination_class = FollowPagination
     queryset = Creator.objects.all()
+    # The follow field holding the creator, the one holding the listed profiles
+    lookup = relation = None
 
     def get_object(self, username):
         try:
-            return self.queryset.get(username=username)
+            return self.queryset.only("id").get(username=username)
         except ObjectDoesNotExist:
             raise Http404
 
+    def get(self, request, *args, **kwargs):
+        creator = self.get_object(kwargs.get("username"))
+        serializer = FollowRowSerializer(self.relation, request)
+        follows = CreatorFollower.objects.filter(**{self.lookup: creator}).values(
+            self.relation + "__version", *serializer.fields
+        )
+        paginator = self.pagination_class()
+        follows = paginator.paginate_queryset(follows, request, self)
+        versions = {
+            follow[serializer.prefix + "id"]: follow[serializer.prefix + "version"]
+            for follow in follows
+        }
+        etag = state_etag(
+            Creator, versions, paginator.get_next_link(), paginator.get_previous_link()
+        )
+        return conditional(
+            request,
+            etag,
+            lambda: paginator.get_paginated_response(
+                serializer.serialize_rows(follows)
+            ),
+        )
+
+
+class FollowersList(FollowList):
+    """
+    Get all user followers
+    """
+
+    lookup = "creator"
+    relation = "follower"
+
+
+class FollowingList(FollowList):
+    """
+    Get all users followed by the user
+    """
+
+    lookup = "follower"
+    relation = "creator"
+
+
+class FollowingStatus(APIView):
+    authentication_classes = API_AUTHENTICATION
+    permission_classes = (IsAuthenticated,)
+
     def get(self, request, *args, **kwargs):
         """
-        Get all user followers
+        Tell which of the ?ids=1,2,3 users the current user follows
         """
-        username = kwargs.get("username")
-        creator = self.get_object(username)
-        followers = creator.get_followers()
-        return Response(self.serializer_class(followers, many=True).data)
+        try:
+            creator_ids = {int(o_id) for o_id in request.query_params["ids"].split(",")}
+        except (KeyError, ValueError):
+            raise ValidationError({"ids": "Expected a comma separated list of ids"})
+        if len(creator_ids) > settings.KEYSET_MAX_PAGE_SIZE:
+            raise ValidationError(
+                {"ids": "At most %d ids are allowed" % settings.KEYSET_MAX_PAGE_SIZE}
+            )
+        following = request.user.get_following_ids(creator_ids)
+        return Response({"following": sorted(following)})
+
+
+class SuggestionList(APIView):
+    authentication_classes = API_AUTHENTICATION
+    permission_classes = (IsAuthenticated,)
 
+    def get(self, request, *args, **kwargs):
+        """
+        Suggest users followed by many of the users the current user follows
+        """
+        suggestions = dict(
+            Suggestion.objects.filter(owner=request.user)
+            .order_by("-score", "suggested_id")
+            .values_list("suggested_id", "score")
+        )
+        # Drop those followed since the suggestions were computed
+        followed = request.user.get_following_ids(suggestions)
+        creator_ids = [pk for pk in suggestions if pk not in followed]
+        creators = get_cached_many(CreatorRowSerializer, creator_ids)
+        return Response(
+            {
+                "results": [
+                    {"user": creators[pk], "mutual_count": suggestions[pk]}
+                    for pk in creator_ids
+                    if pk in creators
+                ]
+            }
+        )
 
-class FollowingList(APIView):
-    authentication_classes = (CsrfExemptSessionAuthentication,)
-    serializer_class = CreatorSerializer
-    queryset = Creator.objects.all()
 
-    def get_object(self, username):
-        try:
-            return self.queryset.get(username=username)
-        except ObjectDoesNotExist:
-            raise Http404
+class ActivityList(APIView):
+    authentication_classes = API_AUTHENTICATION
+    permission_classes = (IsAuthenticated,)
+    pagination_class = ActivityPagination
 
     def get(self, request, *args, **kwargs):
         """
-        Get all user followers
+        Get the likes, comments and follows received by the current user
         """
-        username = kwargs.get("username")
-        follower = self.get_object(username)
-        followers = follower.get_following()
-        return Response(self.serializer_class(followers, many=True).data)
+        # Not request.user, which may come from the token user cache
+        user = Creator.objects.only("activity_read_at", "unread_activity_count").get(
+            pk=request.user.pk
+        )
+        paginator = self.pagination_class()
+        rows = paginator.paginate_queryset(
+            Activity.objects.filter(recipient=user), request, self
+        )
+        actors = get_cached_many(CreatorRowSerializer, {row.actor_id for row in rows})
+        context = {
+            "request": request,
+            "actors": actors,
+            "read_at": user.activity_read_at,
+        }
+        serializer = ActivitySerializer(rows, many=True, context=context)
+        response = paginator.get_paginated_response(serializer.data)
+        response.data["unread_count"] = user.unread_activity_count
+        return response
+
+
+class ActivityReadView(APIView):
+    authentication_classes = API_AUTHENTICATION
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Mark all the activity of the current user as read
+        """
+        mark_read(request.user.pk)
+        return Response({"unread_count": 0})
 
 
 class ImageViewSet(viewsets.ModelViewSet):
     queryset = Image.objects.all()
     serializer_class = ImageSerializer
-    authentication_classes = (CsrfExemptSessionAuthentication,)
+    authentication_classes = API_AUTHENTICATION
     permission_classes = (IsAuthenticated,)
+    pagination_class = FeedPagination
 
     def get_queryset(self):
-        user = self.request.user
-        return user.get_following_images()
+        return Timeline(self.request.user)
+
+    def list(self, request, *args, **kwargs):
+        images = self.paginate_queryset(self.get_queryset())
+        return conditional(
+            request,
+            page_etag(self.paginator, Image, images, request.user.pk),
+            lambda: self.get_paginated_response(
+                add_liked_by_me(
+                    serialize_cached(ImageRowSerializer, images, request),
+                    request.user,
+                )
+            ),
+        )
 
 
 class CommentViewSet(viewsets.ModelViewSet):
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
-    authentication_classes = (CsrfExemptSessionAuthentication,)
+    authentication_classes = API_AUTHENTICATION
+    pagination_class = CommentPagination
+
+    def get_queryset(self):
+        try:
+            return self.queryset.filter(image_id=self.kwargs.get("image_id"))
+        except ValueError:
+            raise Http404
 
     def get_object(self):
         comment_id = self.kwargs.get("comment_id")
@@ -197,7 +399,13 @@ class ImageSearch(viewsets.ModelViewSet):
     queryset = Image.objects.all()
     serializer_class = ImageSerializer
     filter_class = ImageFilter
-    authentication_classes = (CsrfExemptSessionAuthentication,)
+    authentication_classes = API_AUTHENTICATION
+
+    def list(self, request, *args, **kwargs):
+        images = self.filter_queryset(self.get_queryset())
+        return Response(
+            add_liked_by_me(ImageRowSerializer(request).serialize(images), request.user)
+        )
 
     def get_object(self):
         image_id = self.kwargs.get("image_id")
@@ -206,11 +414,169 @@ class ImageSearch(viewsets.ModelViewSet):
         except ObjectDoesNotExist:
             raise Http404
 
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            image_id = int(self.kwargs.get("image_id"))
+        except ValueError:
+            raise Http404
+
+        def render():
+            image = get_cached(self.serializer_class, image_id, request)
+            if image is None:
+                raise Http404
+            return Response(add_liked_by_me([image], request.user)[0])
+
+        etag = versions_etag(Image, [image_id], request.user.pk)
+        return conditional(request, etag, render)
+
+
+class SearchView(APIView):
+    authentication_classes = API_AUTHENTICATION
+    pagination_class = SearchPagination
+    serializers = {"images": ImageRowSerializer, "users": CreatorRowSerializer}
+
+    def get(self, request, *args, **kwargs):
+        """
+        Full-text search of ?type=images (captions) or ?type=users (profiles)
+        """
+        kind = request.query_params.get("type", "images")
+        if kind not in self.serializers:
+            raise ValidationError({"type": "Expected one of images, users"})
+        query = request.query_params.get("q", "")
+
+        paginator = self.pagination_class()
+        results = paginator.paginate_queryset(SearchResults(kind, query), request, self)
+        serializer_class = self.serializers[kind]
+        return conditional(
+            request,
+            page_etag(paginator, serializer_class.Meta.model, results, request.user.pk),
+            lambda: paginator.get_paginated_response(
+                self.personalize(
+                    kind, serialize_cached(serializer_class, results, request)
+                )
+            ),
+        )
+
+    def personalize(self, kind, results):
+        if kind == "images":
+            return add_liked_by_me(results, self.request.user)
+        return results
+
+
+class ExploreView(APIView):
+    authentication_classes = API_AUTHENTICATION
+    pagination_class = ExplorePagination
+    serializer_class = None
+    kind = None
+    with_request = True
+
+    def personalize(self, results):
+        return results
+
+    def get(self, request, *args, **kwargs):
+        """
+        Get the most popular of late, see images.explore
+        """
+        paginator = self.pagination_class()
+        scores = ExploreScore.objects.filter(kind=self.kind)
+        scores = paginator.paginate_queryset(scores, request, self)
+        object_ids = [score.object_id for score in scores]
+
+        def render():
+            found = get_cached_many(
+                self.serializer_class,
+                object_ids,
+                request if self.with_request else None,
+            )
+            return paginator.get_paginated_response(
+                self.personalize([found[pk] for pk in object_ids if pk in found])
+            )
+
+        model = self.serializer_class.Meta.model
+        etag = versions_etag(
+            model,
+            object_ids,
+            paginator.get_next_link(),
+            paginator.get_previous_link(),
+            request.user.pk,
+        )
+        return conditional(request, etag, render)
+
+
+class CreatorExplore(ExploreView):
+    serializer_class = CreatorRowSerializer
+    kind = "creator"
+    with_request = False
+
+
+class ImageExplore(ExploreView):
+    serializer_class = ImageRowSerializer
+    kind = "image"
+
+    def personalize(self, results):
+        return add_liked_by_me(results, self.request.user)
+
+
+class TagImageList(APIView):
+    authentication_classes = API_AUTHENTICATION
+    serializer_class = ImageRowSerializer
+    pagination_class = TagPagination
+
+    def get(self, request, *args, **kwargs):
+        """
+        Get the newest images with a tag
+        """
+        try:
+            tag = Tag.objects.get(name=kwargs.get("tag").lower())
+        except ObjectDoesNotExist:
+            raise Http404
+
+        paginator = self.pagination_class()
+        links = ImageTag.objects.filter(tag=tag).only("created", "image_id")
+        links = paginator.paginate_queryset(links, request, self)
+        images = [Image(pk=link.image_id) for link in links]
+        return conditional(
+            request,
+            page_etag(paginator, Image, images, request.user.pk),
+            lambda: paginator.get_paginated_response(
+                add_liked_by_me(
+                    serialize_cached(self.serializer_class, images, request),
+                    request.user,
+                )
+            ),
+        )
+
+
+class CacheStats(APIView):
+    authentication_classes = API_AUTHENTICATION
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        """
+        Object cache hits and misses per kind since the process started
+        """
+        return Response(object_cache.get_stats())
+
 
 class LikeView(viewsets.ModelViewSet):
     queryset = Like.objects.all()
     serializer_class = LikeSerializer
-    authentication_classes = (CsrfExemptSessionAuthentication,)
+    authentication_classes = API_AUTHENTICATION
+    pagination_class = LikePagination
+
+    def list(self, request, *args, **kwargs):
+        """
+        Who liked an image, newest first, with their profiles
+        """
+        try:
+            image = Image.objects.only("id").get(pk=int(kwargs.get("image_id")))
+        except (ValueError, ObjectDoesNotExist):
+            raise Http404
+        likes = self.queryset.filter(image=image).values(*LikerRowSerializer.fields)
+        likes = self.paginate_queryset(likes)
+        return self.get_paginated_response(
+            LikerRowSerializer(request).serialize_rows(likes)
+        )
 
     def get_object(self):
         like_id = self.kwargs.get("image_id")
@@ -220,6 +586,8 @@ class LikeView(viewsets.ModelViewSet):
             raise Http404
 
     def create(self, request, *args, **kwargs):
+        if settings.LIKE_WRITE_BEHIND:
+            return self.buffer(request, liked=True)
         image_id = kwargs.get("image_id")
         data = {"image": image_id}
         serializer = self.get_serializer(data=data)
@@ -228,12 +596,199 @@ class LikeView(viewsets.ModelViewSet):
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
+    def destroy(self, request, *args, **kwargs):
+        if settings.LIKE_WRITE_BEHIND:
+            return self.buffer(request, liked=False)
+        return super(LikeView, self).destroy(request, *args, **kwargs)
+
+    def buffer(self, request, liked):
+        """
+        Queue the like for the write-behind flusher and answer right away
+        """
+        if not request.user.is_authenticated:
+            self.permission_denied(request)
+        try:
+            image_id = int(self.kwargs.get("image_id"))
+            like_buffer.record(image_id, request.user.pk, liked)
+        except (ValueError, Image.DoesNotExist):
+            raise Http404
+        return Response(
+            {"image": image_id, "person": request.user.pk, "liked": liked},
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+
+# Outcome of one batch item by whether it changed anything, None when not found
+BATCH_STATUS = {True: "ok", False: "unchanged", None: "not_found"}
+
+
+class TokenView(APIView):
+    # Not signed tokens themselves, which could then be renewed forever
+    authentication_classes = (
+        SessionAuthentication,
+        BasicAuthentication,
+        OAuth2Authentication,
+    )
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Exchange a session, a password or an OAuth2 token for a signed token
+        """
+        token, expires = issue_token(request.user)
+        return Response({"token": token, "expires": expires})
+
+
+class RevokeTokenView(APIView):
+    authentication_classes = (SignedTokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Revoke the signed token the request was made with
+        """
+        revocations.revoke(request.auth)
+        return Response({"status": "ok"})
+
+
+def parse_ids(value, field):
+    """
+    Read ids given as a list or a comma separated string, dropping repeats.
+    """
+    if isinstance(value, str):
+        value = value.split(",") if value else []
+    try:
+        return list(dict.fromkeys(int(pk) for pk in value))
+    except (TypeError, ValueError):
+        raise ValidationError({field: "Expected a list of ids"})
+
+
+def parse_batch(data, *fields):
+    """
+    Return the id lists of ``fields``, at most ``BATCH_MAX_SIZE`` ids in all.
+    """
+    batches = [parse_ids(data.get(field, []), field) for field in fields]
+    if sum(len(ids) for ids in batches) > settings.BATCH_MAX_SIZE:
+        raise ValidationError(
+            {"detail": "At most %d ids are allowed" % settings.BATCH_MAX_SIZE}
+        )
+    if len(fields) == 2 and set(batches[0]) & set(batches[1]):
+        raise ValidationError({"detail": "%s and %s overlap" % fields})
+    return batches
+
+
+class BatchLikeView(APIView):
+    authentication_classes = API_AUTHENTICATION
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Like and unlike many images: {"like": [ids], "unlike": [ids]}
+        """
+        like, unlike = parse_batch(request.data, "like", "unlike")
+        intents = [(image_id, True) for image_id in like]
+        intents += [(image_id, False) for image_id in unlike]
+
+        if settings.LIKE_WRITE_BEHIND:
+            results = []
+            for image_id, liked in intents:
+                try:
+                    like_buffer.record(image_id, request.user.pk, liked)
+                    outcome = "accepted"
+                except Image.DoesNotExist:
+                    outcome = "not_found"
+                results.append({"image": image_id, "liked": liked, "status": outcome})
+            return Response({"results": results}, status=status.HTTP_202_ACCEPTED)
+
+        changed = apply_likes(
+            {(image_id, request.user.pk): (liked, None) for image_id, liked in intents}
+        )
+        results = [
+            {
+                "image": image_id,
+                "liked": liked,
+                "status": BATCH_STATUS[changed.get((image_id, request.user.pk))],
+            }
+            for image_id, liked in intents
+        ]
+        return Response({"results": results})
+
+
+class BatchFollowView(APIView):
+    authentication_classes = API_AUTHENTICATION
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Follow and unfollow many users: {"follow": [ids], "unfollow": [ids]}
+        """
+        follow, unfollow = parse_batch(request.data, "follow", "unfollow")
+        with write_atomic():
+            followed = request.user.follow_many(follow)
+            unfollowed = request.user.unfollow_many(unfollow)
+
+        results = []
+        for creator_ids, changed, following in (
+            (follow, followed, True),
+            (unfollow, unfollowed, False),
+        ):
+            for creator_id in creator_ids:
+                results.append(
+                    {
+                        "user": creator_id,
+                        "following": following,
+                        "status": BATCH_STATUS[changed.get(creator_id)],
+                    }
+                )
+        return Response({"results": results})
+
+
+class BatchLookupView(APIView):
+    authentication_classes = API_AUTHENTICATION
+    permission_classes = (IsAuthenticated,)
+    serializer_class = None
+    with_request = True
+
+    def personalize(self, results):
+        return results
+
+    def get(self, request, *args, **kwargs):
+        """
+        Fetch many objects by id: ?ids=1,2,3
+        """
+        (ids,) = parse_batch(request.query_params, "ids")
+        found = get_cached_many(
+            self.serializer_class, ids, request if self.with_request else None
+        )
+        return Response(
+            {
+                "results": self.personalize([found[pk] for pk in ids if pk in found]),
+                "not_found": [pk for pk in ids if pk not in found],
+            }
+        )
+
+
+class BatchCreatorView(BatchLookupView):
+    serializer_class = CreatorRowSerializer
+    # Profiles are serialized like CreatorView, without absolute URLs
+    with_request = False
+
+
+class BatchImageView(BatchLookupView):
+    serializer_class = ImageRowSerializer
+
+    def personalize(self, results):
+        return add_liked_by_me(results, self.request.user)
+
 
 @csrf_exempt
 def auth_view(request):
     username = request.POST["username"]
     password = request.POST["password"]
     user = authenticate(request, username=username, password=password)
+    if user is not None and request.POST.get("token"):
+        token, expires = issue_token(user)
+        return JsonResponse({"status": "ok", "token": token, "expires": expires})
     if user is not None:
         login(request, user)
         return HttpResponse("{'status': 'ok'}")
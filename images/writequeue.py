@@ -0,0 +1,123 @@
+"""
+Optional single-writer queue for small write transactions.
+
+SQLite runs one write transaction at a time, so concurrent requests mostly
+wait on the write lock and on each other's commits. With
+``SQLITE_WRITE_QUEUE`` enabled, methods decorated with ``queued`` are handed
+to one writer thread per process instead. The writer runs whatever is queued,
+up to ``SQLITE_WRITE_QUEUE_BATCH_SIZE`` calls, in one transaction with a
+savepoint per call: a call that raises only rolls back its own savepoint and
+its error is raised in its caller. Callers wait for the commit, and the
+``on_commit`` hooks of their calls run in the writer thread.
+
+Calls made inside an atomic block run right away in the caller, as the
+queue could not commit them with the caller's transaction.
+"""
+import functools
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .transactions import write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class Call:
+    __slots__ = ("func", "args", "kwargs", "done", "result", "error")
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WriteQueue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = queue.Queue()
+        self.writer = None
+
+    def run(self, func, *args, **kwargs):
+        """
+        Return ``func(*args, **kwargs)``, run by the writer when enabled.
+        """
+        if (
+            not settings.SQLITE_WRITE_QUEUE
+            or threading.current_thread() is self.writer
+            or transaction.get_connection().in_atomic_block
+        ):
+            return func(*args, **kwargs)
+        call = Call(func, args, kwargs)
+        self.start()
+        self.calls.put(call)
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def start(self):
+        if self.writer is not None:
+            return
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(
+                    target=self.loop, name="write-queue", daemon=True
+                )
+                self.writer.start()
+
+    def take(self):
+        """
+        Wait for a call and return it with those queued behind it.
+        """
+        batch = [self.calls.get()]
+        while len(batch) < settings.SQLITE_WRITE_QUEUE_BATCH_SIZE:
+            try:
+                batch.append(self.calls.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def loop(self):
+        while True:
+            batch = self.take()
+            try:
+                self.execute(batch)
+            except Exception as error:
+                logger.exception("Committing %d queued writes failed", len(batch))
+                for call in batch:
+                    call.error = call.error or error
+            finally:
+                for call in batch:
+                    call.done.set()
+                connection.close_if_unusable_or_obsolete()
+
+    def execute(self, batch):
+        with write_atomic():
+            for call in batch:
+                try:
+                    with transaction.atomic():
+                        call.result = call.func(*call.args, **call.kwargs)
+                except Exception as error:
+                    call.error = error
+
+
+write_queue = WriteQueue()
+
+
+def queued(method):
+    """
+    Run ``method`` through the write queue when it is enabled.
+    """
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        return write_queue.run(method, *args, **kwargs)
+
+    return wrapper
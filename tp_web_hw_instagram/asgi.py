@@ -0,0 +1,19 @@
+"""
+ASGI config for tp_web_hw_instagram project.
+
+Django 2.2 has no ASGI request handler, so this only serves the live event
+stream at ``/events/`` (see ``images.streams``); the API stays on the WSGI
+application. Run it next to it, e.g.::
+
+    uvicorn tp_web_hw_instagram.asgi:application --lifespan on
+"""
+
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tp_web_hw_instagram.settings")
+
+django.setup()
+
+from images.streams import application  # noqa: E402, F401 isort:skip
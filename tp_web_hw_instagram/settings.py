@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -47,6 +48,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so it measures the whole chain, see images.metrics
+    "images.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -81,10 +84,15 @@ WSGI_APPLICATION = "tp_web_hw_instagram.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
+# WAL journaling, immediate write transactions and lock retries, see
+# images.backends.sqlite3.base. "timeout" is how long SQLite waits for the
+# write lock, in seconds.
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
+        "ENGINE": "images.backends.sqlite3",
         "NAME": os.path.join(BASE_DIR, "db.sqlite3"),
+        "CONN_MAX_AGE": 10 * 60,
+        "OPTIONS": {"timeout": 5, "lock_retries": 3, "lock_backoff": 0.05},
     }
 }
 
@@ -124,6 +132,7 @@ MEDIA_URL = "/media/"
 REST_FRAMEWORK = {
     "DEFAULT_FILTER_BACKENDS": ["django_filters.rest_framework.DjangoFilterBackend"],
     "DEFAULT_AUTHENTICATION_CLASSES": [
+        "images.authentication.SignedTokenAuthentication",
         "rest_framework.authentication.BasicAuthentication",
         "rest_framework.authentication.SessionAuthentication",
         "oauth2_provider.contrib.rest_framework.OAuth2Authentication",  # django-oauth-toolkit >= 1.0.0
@@ -132,6 +141,114 @@ REST_FRAMEWORK = {
     ],
 }
 
+KEYSET_PAGE_SIZE = 20
+KEYSET_MAX_PAGE_SIZE = 100
+
+# Explore ranking, see images.explore. Run update_explore --rebuild after
+# changing the half-life
+EXPLORE_HALF_LIFE = 3 * 24 * 60 * 60
+EXPLORE_WEIGHTS = {"like": 1.0, "follow": 3.0, "post": 2.0}
+EXPLORE_MIN_SCORE = 0.01
+
+# Friends-of-friends suggestions, see images.suggestions
+SUGGESTIONS_LIMIT = 20
+SUGGESTIONS_MAX_DEGREE = 5000
+SUGGESTIONS_WORKERS = 2
+
+# Live event streams, see images.events and tp_web_hw_instagram.asgi. Enable
+# them where the ASGI application is deployed; otherwise nothing is published.
+EVENTS_ENABLED = False
+EVENTS_BROKER = "images.events.DatabaseBroker"
+EVENTS_POLL_INTERVAL = 1.0
+EVENTS_KEEPALIVE = 15
+# Frames kept for a subscriber that reads slower than events arrive
+EVENTS_QUEUE_SIZE = 100
+EVENTS_RETENTION = 60 * 60
+
+# Activity within this many seconds is aggregated into one unread row, see
+# images.activity
+ACTIVITY_AGGREGATE_WINDOW = 24 * 60 * 60
+
+# Signed bearer tokens, see images.authentication
+AUTH_TOKEN_LIFETIME = 60 * 60
+AUTH_TOKEN_USER_CACHE_SIZE = 10000
+AUTH_TOKEN_USER_CACHE_TIMEOUT = 60
+AUTH_REVOCATION_REFRESH_INTERVAL = 30
+
+# Most ids accepted by one request to the batch/ endpoints
+BATCH_MAX_SIZE = 100
+FEED_PAGE_SIZE = 20
+# Creators above this many followers are merged into feeds at read time
+FEED_FANOUT_THRESHOLD = 10000
+FEED_FANOUT_BATCH_SIZE = 1000
+FEED_BACKFILL_SIZE = 100
+
+# Newest comments embedded into every serialized image
+COMMENTS_PREVIEW_SIZE = 3
+
+# Hot counters spread over this many CounterShard rows, summed on read
+COUNTER_SHARDS = {"images.image.like_count": 8}
+
+# Resized copies made for every uploaded picture, see images.derivatives
+IMAGE_VARIANTS = {
+    "thumbnail": {
+        "width": 150,
+        "height": 150,
+        "crop": True,
+        "format": "JPEG",
+        "quality": 80,
+    },
+    "feed": {"width": 1080, "format": "JPEG", "quality": 85},
+    "webp": {"width": 1080, "format": "WEBP", "quality": 80},
+}
+IMAGE_VARIANT_WORKERS = 2
+
+SEARCH_BACKEND = "images.search.SQLiteFTS5Backend"
+
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_REBUILD_INTERVAL = 15 * 60
+
+# Buffer likes in memory and write them in bulk, see images.likebuffer
+LIKE_WRITE_BEHIND = False
+LIKE_BUFFER_FLUSH_INTERVAL = 1.0
+LIKE_BUFFER_BATCH_SIZE = 500
+
+# The objects cache is shared by the worker processes of one host, point it
+# at memcached or redis to share it between hosts
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "objects": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.path.join(tempfile.gettempdir(), "tp_web_hw_instagram_objects"),
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+
+# Serialized creators and images, see images.cache. "images.cache.LRUBackend"
+# is faster but only correct with a single worker process
+OBJECT_CACHE = {
+    "BACKEND": "images.cache.DjangoCacheBackend",
+    "OPTIONS": {"alias": "objects", "timeout": 5 * 60},
+}
+
+# Request metrics served at /metrics to staff users and to scrapers sending
+# the METRICS_TOKEN as a bearer token, see images.metrics. Set METRICS_DIR to
+# a directory shared by all worker processes to add up their metrics.
+METRICS_TOKEN = None
+METRICS_DIR = None
+METRICS_FLUSH_INTERVAL = 5
+METRICS_SLOW_REQUEST = 0.5
+METRICS_SLOW_SAMPLE_RATE = 0.1
+METRICS_SLOW_TOP_QUERIES = 5
+
+# Batch small write transactions of a process in one writer thread, see
+# images.writequeue
+SQLITE_WRITE_QUEUE = False
+SQLITE_WRITE_QUEUE_BATCH_SIZE = 100
+
+BACKGROUND_TASKS_EAGER = False
+BACKGROUND_TASKS_WORKERS = 4
+
 AUTHENTICATION_BACKENDS = (
     # Facebook OAuth2
     "social_core.backends.facebook.FacebookAppOAuth2",
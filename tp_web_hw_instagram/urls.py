@@ -13,13 +13,16 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import path, re_path, include
+from django.urls import include, path, re_path
 from rest_framework import routers
 
 import images.views as image_views
+from images.conditional import serve_media
+from images.metrics import metrics_view
 
 router = routers.DefaultRouter()
 
@@ -27,7 +30,7 @@ urlpatterns = [
     path("admin/", admin.site.urls),
 
     # Users
-    path(r"users/explore/", image_views.CreatorViewSet.as_view({"get": "list"})),
+    path(r"users/explore/", image_views.CreatorExplore.as_view()),
     path(
         r"users/search/",
         image_views.CreatorSearch.as_view({"get": "list"}),
@@ -39,6 +42,11 @@ urlpatterns = [
         name="create_user",
     ),
     path(r"users/login/", image_views.auth_view),
+    path(r"users/token/", image_views.TokenView.as_view()),
+    path(r"users/token/revoke/", image_views.RevokeTokenView.as_view()),
+    path(r"users/autocomplete/", image_views.CreatorAutocomplete.as_view()),
+    path(r"users/following/status/", image_views.FollowingStatus.as_view()),
+    path(r"users/suggestions/", image_views.SuggestionList.as_view()),
     re_path(r"users/(?P<username>[-\w]+)/$", image_views.CreatorView.as_view()),
     re_path(r"users/follow/(?P<user_id>.+)/$", image_views.FollowView.as_view()),
     re_path(r"users/unfollow/(?P<user_id>.+)/$", image_views.UnFollowView.as_view()),
@@ -51,7 +59,7 @@ urlpatterns = [
     # Comments
     re_path(
         r"images/(?P<image_id>.+)/comments/$",
-        image_views.CommentViewSet.as_view({"post": "create"}),
+        image_views.CommentViewSet.as_view({"post": "create", "get": "list"}),
     ),
     re_path(
         r"images/(?P<image_id>.+)/comments/(?P<comment_id>.+)$",
@@ -79,6 +87,8 @@ urlpatterns = [
         image_views.ImageSearch.as_view({"get": "list"}),
         name="search_images",
     ),
+    path(r"images/explore/", image_views.ImageExplore.as_view()),
+    re_path(r"images/tags/(?P<tag>[^/]+)/$", image_views.TagImageList.as_view()),
     re_path(
         r"images/(?P<image_id>.+)/$",
         image_views.ImageSearch.as_view(
@@ -87,7 +97,28 @@ urlpatterns = [
         name="search_images",
     ),
 
+    path(r"search/", image_views.SearchView.as_view(), name="search"),
+    path(r"activity/", image_views.ActivityList.as_view()),
+    path(r"activity/read/", image_views.ActivityReadView.as_view()),
+    path(r"cache/stats/", image_views.CacheStats.as_view()),
+    path(r"metrics", metrics_view),
+
+    # Batches
+    path(r"batch/likes/", image_views.BatchLikeView.as_view()),
+    path(r"batch/follows/", image_views.BatchFollowView.as_view()),
+    path(r"batch/users/", image_views.BatchCreatorView.as_view()),
+    path(r"batch/images/", image_views.BatchImageView.as_view()),
+
     re_path(r'auth/', include('rest_framework_social_oauth2.urls')),
 
 
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
+
+if settings.DEBUG:
+    urlpatterns += [
+        re_path(
+            r"^%s(?P<path>.*)$" % re.escape(settings.MEDIA_URL.lstrip("/")),
+            serve_media,
+            {"document_root": settings.MEDIA_ROOT},
+        )
+    ]